@@ -9,14 +9,19 @@ and continuously aggregates a collection of Atom and RSS feeds, parses them and
 republishes them via Jabber publish-subscribe.
 """
 
+import hashlib
 import re
 import simplejson
+import struct
+import time
+import zlib
 
 from zope.interface import Interface, implements
 
 from twisted.application import service
-from twisted.internet import reactor, defer
-from twisted.python import components, log
+from twisted.enterprise import adbapi
+from twisted.internet import reactor, defer, threads
+from twisted.python import components, failure, log
 from twisted.python.filepath import FilePath
 from twisted.words.protocols.jabber import xmlstream
 from twisted.words.protocols.jabber.error import StanzaError
@@ -29,11 +34,38 @@ from wokkel import pubsub
 from wokkel.iwokkel import IXMPPHandler
 from wokkel.subprotocols import XMPPHandler
 
-from mimir import __version__
-from mimir.aggregator import fetcher, writer
+from mimir import __version__, profiling
+from mimir.aggregator import fetcher, metrics, scheduler, writer
 from mimir.monitor.news import FeedParserEncoder
 
 INTERVAL = 1800
+MIN_INTERVAL = 300
+MAX_INTERVAL = 86400
+STAGGER = 5
+MAX_NODE_CREATIONS = 10
+PLACEMENTS = ('spread', 'stagger')
+
+# Minimum number of changes to the list of feeds that are kept in its
+# journal, before the list is rewritten.
+JOURNAL_SIZE = 1000
+
+# Formats for storing cached feeds, and the file name suffix for each.
+FEED_FORMATS = {'json': '.feed.json',
+                'compact': '.feed.json.z'}
+
+# Factors applied to the polling interval of a feed, after a poll that
+# discovered fresh entries, one that did not, or one that failed.
+INTERVAL_FACTORS = {'fresh': 0.5,
+                    'stale': 1.25,
+                    'error': 2.0}
+
+# Entry fields that are taken into account for detecting updated entries.
+ENTRY_FIELDS = ('title', 'link', 'author', 'summary', 'content',
+                'enclosures', 'tags', 'published', 'updated')
+
+# Parts of the feed, besides the entry, that writers render entries from.
+RENDER_FEED_FIELDS = ('feed', 'bozo', 'namespaces', 'version')
+
 NS_AGGREGATOR = 'http://mimir.ik.nu/protocol/aggregator'
 
 RE_HANDLE = re.compile('^[-a-z0-9_]+$')
@@ -43,6 +75,11 @@ class InvalidHandleError(Exception):
     Handle contains invalid characters.
     """
 
+class InvalidRequestError(Exception):
+    """
+    Request to add feeds is malformed.
+    """
+
 
 class IFeedHandler(Interface):
     """
@@ -78,16 +115,61 @@ class IAggregatorService(Interface):
         @type url: L{str}
         """
 
+    def setFeeds(feeds):
+        """
+        Associate feed URLs to handles, in bulk.
+
+        All handles are checked before any feed is stored.
+
+        @param feeds: feeds as tuples of handle and URL.
+        @type feeds: C{list}
+        """
+
 
 class FileFeedStorage(object):
-    def __init__(self, feedsDir):
+    """
+    Storage of feeds in a directory.
+
+    Cached feeds are stored in a file per feed, in one of the formats from
+    L{FEED_FORMATS}: C{'json'} is indented JSON, C{'compact'} is compact
+    JSON, compressed with zlib. Feeds are read in either format.
+
+    Files are written in a thread, to a temporary file that then replaces
+    the previous version. Writes for the same feed are done in order.
+
+    The list of feeds is kept in the file C{feeds}, with a line
+    C{handle url} per feed. Changes are appended, in the same format, to
+    the journal in C{feeds.journal}. When the journal has grown beyond
+    L{journalSize} lines and beyond the number of feeds, and on startup,
+    the journal is merged into a new version of C{feeds}.
+
+    @ivar format: format for storing cached feeds.
+    @type format: C{str}
+    @ivar journalSize: minimum number of changes in the journal before it
+                       is merged.
+    @type journalSize: C{int}
+    """
+
+    journalSize = JOURNAL_SIZE
+
+    def __init__(self, feedsDir, format='json'):
         self.feedsDir = FilePath(feedsDir)
         self.feedListFile = self.feedsDir.child('feeds')
+        self.journalFile = self.feedsDir.child('feeds.journal')
         self.feeds = None
+        self.format = format
+        self._locks = {}
+        self._journalLength = 0
+
+    def _feedFile(self, handle, format):
+        return self.feedsDir.child(handle + FEED_FORMATS[format])
 
     def _readFeedList(self):
         """
-        Initialize list of feeds
+        Initialize list of feeds, replaying the changes in the journal.
+
+        A last journal line without line ending was cut short while being
+        written, and is ignored.
         """
 
         fh = self.feedListFile.open()
@@ -96,6 +178,19 @@ class FileFeedStorage(object):
         finally:
             fh.close()
 
+        self._journalLength = 0
+        if self.journalFile.exists():
+            fh = self.journalFile.open()
+            try:
+                for line in fh.readlines():
+                    self._journalLength += 1
+                    if line.endswith('\n') and len(line.split()) == 2:
+                        feedList.append(line.split())
+                    else:
+                        log.msg("Ignoring incomplete journal entry %r" % line)
+            finally:
+                fh.close()
+
         self.feeds = {}
         for handle, url in feedList:
             self.feeds[handle] = {'handle': handle,
@@ -103,18 +198,44 @@ class FileFeedStorage(object):
 
     def _writeFeedList(self):
         """
-        Write out list of feeds
+        Write out list of feeds, and clear the journal.
+
+        The list is written to a temporary file that then replaces the
+        previous version, before the journal is removed. Replaying the
+        journal on the new version is harmless, should that be interrupted.
         """
 
         feedList = ["%s %s\n" % (f['handle'], f['href'])
                      for f in self.feeds.itervalues()]
         feedList.sort()
 
-        fh = self.feedListFile.open('w')
+        tempFile = self.feedListFile.temporarySibling()
+        fh = tempFile.open('w')
         try:
             fh.writelines(feedList)
         finally:
             fh.close()
+        tempFile.moveTo(self.feedListFile)
+
+        if self.journalFile.exists():
+            self.journalFile.remove()
+        self._journalLength = 0
+
+    def _appendFeedList(self, feeds):
+        """
+        Append changes to the list of feeds to the journal.
+        """
+
+        fh = self.journalFile.open('a')
+        try:
+            fh.writelines(["%s %s\n" % (feed['handle'], feed['href'])
+                           for feed in feeds])
+        finally:
+            fh.close()
+
+        self._journalLength += len(feeds)
+        if self._journalLength > max(self.journalSize, len(self.feeds)):
+            self._writeFeedList()
 
     def getFeedList(self):
         """
@@ -123,6 +244,8 @@ class FileFeedStorage(object):
         if self.feeds is None:
             try:
                 self._readFeedList()
+                if self._journalLength:
+                    self._writeFeedList()
             except:
                 return defer.fail()
 
@@ -132,60 +255,321 @@ class FileFeedStorage(object):
         """
         Add or update the feed.
         """
-        feed = {'handle': handle,
-                 'href': url}
+        d = self.setFeedURLs([(handle, url)])
+        d.addCallback(lambda feeds: feeds[0])
+        return d
+
+    def setFeedURLs(self, feeds):
+        """
+        Add or update feeds, appending all changes to the journal at once.
+        """
+        feeds = [{'handle': handle,
+                  'href': url} for handle, url in feeds]
 
-        self.feeds[handle] = feed
+        for feed in feeds:
+            self.feeds[feed['handle']] = feed
 
-        try:
-            self.storeFeed(feed)
-            self._writeFeedList()
-        except:
-            return defer.fail()
+        def unwrapFirstError(failure):
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
 
-        return defer.succeed(feed)
+        d = defer.gatherResults([self.storeFeed(feed) for feed in feeds],
+                                consumeErrors=True)
+        d.addErrback(unwrapFirstError)
+        d.addCallback(lambda _: self._appendFeedList(feeds))
+        d.addCallback(lambda _: feeds)
+        return d
 
     def getFeed(self, handle):
         """
         Retrieve the feed as it was last aggregated.
+
+        If the feed is being written, it is read after that has finished.
         """
 
+        if handle in self._locks:
+            return self._runLocked(handle, self._readFeed, handle)
+
         try:
-            feedFile = self.feedsDir.child("%s.feed.json" % handle)
+            feed = self._readFeed(handle)
+        except:
+            return defer.fail()
 
-            feed = self.feeds[handle]
+        return defer.succeed(feed)
+
+    def _readFeed(self, handle):
+        feed = self.feeds[handle]
+        for format in (self.format, 'json', 'compact'):
+            feedFile = self._feedFile(handle, format)
             if feedFile.exists():
-                fh = feedFile.open()
+                data = feedFile.getContent()
                 try:
-                    try:
-                        feed = simplejson.load(fh)
-                    except ValueError:
-                        pass
-                finally:
-                    fh.close()
+                    if format == 'compact':
+                        data = zlib.decompress(data)
+                    feed = simplejson.loads(data)
+                except (ValueError, zlib.error):
+                    pass
+                break
+
+        return feed
+
+    def storeFeed(self, feed):
+        """
+        Write out a feed in the configured format.
+
+        The feed is serialized right away, and written in a thread.
+        """
+
+        handle = feed['handle']
+
+        try:
+            if self.format == 'compact':
+                data = simplejson.dumps(feed, cls=FeedParserEncoder,
+                                        separators=(',', ':'))
+            else:
+                data = simplejson.dumps(feed, cls=FeedParserEncoder, indent=4)
         except:
             return defer.fail()
 
-        return defer.succeed(feed)
+        d = self._runLocked(handle, threads.deferToThread, self._writeFeed,
+                            handle, data, self.format)
+        d.addCallback(lambda _: feed)
+        return d
 
-    def storeFeed(self, feed):
+    def _runLocked(self, handle, f, *args):
         """
-        Write out a feed as a JSON file.
+        Run C{f} after earlier reads and writes of the feed have finished.
         """
 
         try:
-            feedFile = self.feedsDir.child("%s.feed.json" % feed['handle'])
-            if feedFile.exists():
-                feedFile.moveTo(FilePath(feedFile.path + '.1'))
-            fh = feedFile.open("w")
+            lock = self._locks[handle]
+        except KeyError:
+            lock = self._locks[handle] = defer.DeferredLock()
+
+        def done(result):
+            if (self._locks.get(handle) is lock and
+                not lock.locked and not lock.waiting):
+                del self._locks[handle]
+            return result
+
+        d = lock.run(f, *args)
+        d.addBoth(done)
+        return d
+
+    def _writeFeed(self, handle, data, format):
+        """
+        Write a serialized feed to its file, atomically.
+
+        Files of the feed in other formats are removed.
+        """
+
+        if format == 'compact':
+            data = zlib.compress(data)
+
+        feedFile = self._feedFile(handle, format)
+        tempFile = feedFile.temporarySibling()
+        tempFile.setContent(data)
+        tempFile.moveTo(feedFile)
+
+        for other in FEED_FORMATS:
+            if other != format:
+                otherFile = self._feedFile(handle, other)
+                if otherFile.exists():
+                    otherFile.remove()
+
+
+
+class SQLiteFeedStorage(object):
+    """
+    Storage of feeds in an SQLite database.
+
+    The list of feeds and the cached feeds are kept in a single table. Cached
+    feeds are stored as compact JSON, compressed with zlib, like the
+    C{'compact'} format of L{FileFeedStorage}. A second table has
+    metadata, like whether feeds were imported, see L{migrateFeeds}.
+
+    @ivar _dbpool: pool of database connections, that should have a single
+                   connection for SQLite. See L{connect}.
+    @type _dbpool: L{adbapi.ConnectionPool}
+    """
+
+    schema = """CREATE TABLE IF NOT EXISTS feeds (
+                    handle TEXT PRIMARY KEY,
+                    href TEXT NOT NULL,
+                    feed BLOB
+                )"""
+
+    metaSchema = """CREATE TABLE IF NOT EXISTS meta (
+                        key TEXT PRIMARY KEY,
+                        value TEXT
+                    )"""
+
+    def __init__(self, dbpool):
+        self._dbpool = dbpool
+        d = self._dbpool.runOperation(self.schema)
+        d.addErrback(log.err, "Could not create feeds table")
+        d = self._dbpool.runOperation(self.metaSchema)
+        d.addErrback(log.err, "Could not create meta table")
+
+    @classmethod
+    def connect(cls, path):
+        """
+        Create a storage for the database in the file at C{path}.
+        """
+
+        dbpool = adbapi.ConnectionPool('sqlite3', path,
+                                       check_same_thread=False,
+                                       cp_min=1,
+                                       cp_max=1)
+        return cls(dbpool)
+
+    def getFeedList(self):
+        """
+        Get the list of feeds.
+        """
+        return self._dbpool.runInteraction(self._getFeedList)
+
+    def _getFeedList(self, cursor):
+        cursor.execute("SELECT handle, href FROM feeds")
+        feeds = {}
+        for handle, href in cursor.fetchall():
+            feeds[handle] = {'handle': handle,
+                             'href': href}
+        return feeds
+
+    def setFeedURL(self, handle, url):
+        """
+        Add or update the feed.
+        """
+        d = self.setFeedURLs([(handle, url)])
+        d.addCallback(lambda feeds: feeds[0])
+        return d
+
+    def setFeedURLs(self, feeds):
+        """
+        Add or update feeds, in a single transaction.
+        """
+        feeds = [{'handle': handle,
+                  'href': url} for handle, url in feeds]
+
+        d = self._dbpool.runInteraction(self._setFeedURLs,
+                                        [(feed['handle'], feed['href'],
+                                          self._dump(feed))
+                                         for feed in feeds])
+        d.addCallback(lambda _: feeds)
+        return d
+
+    def _setFeedURLs(self, cursor, rows):
+        cursor.executemany("""INSERT OR REPLACE INTO feeds (handle, href, feed)
+                              VALUES (?, ?, ?)""",
+                           [(handle, url, buffer(zlib.compress(data)))
+                            for handle, url, data in rows])
+
+    def getFeed(self, handle):
+        """
+        Retrieve the feed as it was last aggregated.
+        """
+        return self._dbpool.runInteraction(self._getFeed, handle)
+
+    def _getFeed(self, cursor, handle):
+        cursor.execute("SELECT href, feed FROM feeds WHERE handle=?",
+                       (handle,))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(handle)
+
+        href, data = row
+        if data is not None:
             try:
-                simplejson.dump(feed, fh, indent=4, cls=FeedParserEncoder)
-            finally:
-                fh.close()
+                return simplejson.loads(zlib.decompress(str(data)))
+            except (ValueError, zlib.error):
+                pass
+
+        return {'handle': handle,
+                'href': href}
+
+    def storeFeed(self, feed):
+        """
+        Store a feed.
+
+        The feed is serialized right away, and compressed and stored in a
+        thread.
+        """
+        try:
+            data = self._dump(feed)
         except:
             return defer.fail()
-        else:
-            return defer.succeed(feed)
+
+        d = self._dbpool.runInteraction(self._storeFeed, feed['handle'], data)
+        d.addCallback(lambda _: feed)
+        return d
+
+    def _storeFeed(self, cursor, handle, data):
+        cursor.execute("UPDATE feeds SET feed=? WHERE handle=?",
+                       (buffer(zlib.compress(data)), handle))
+
+    def _dump(self, feed):
+        return simplejson.dumps(feed, cls=FeedParserEncoder,
+                                separators=(',', ':'))
+
+    def importFeeds(self, feedsDir):
+        """
+        Import the feeds from a directory used by L{FileFeedStorage}.
+
+        The list of feeds and the cached feeds are read and stored in a
+        single transaction, in a thread, that also records that the import
+        has finished. Feeds that are already in the database are kept.
+        Cached feeds that cannot be read are skipped.
+
+        @param feedsDir: path to the directory.
+        @type feedsDir: C{str}
+        @return: deferred that fires with the number of imported feeds.
+        @rtype: L{defer.Deferred}
+        """
+        return self._dbpool.runInteraction(self._importFeeds,
+                                           FileFeedStorage(feedsDir))
+
+    def migrateFeeds(self, feedsDir):
+        """
+        Import the feeds from a directory, unless an import has finished.
+
+        @param feedsDir: path to the directory.
+        @type feedsDir: C{str}
+        @return: deferred that fires with the number of imported feeds, or
+            C{None} if the feeds were imported before.
+        @rtype: L{defer.Deferred}
+        """
+        return self._dbpool.runInteraction(self._migrateFeeds,
+                                           FileFeedStorage(feedsDir))
+
+    def _migrateFeeds(self, cursor, fileStorage):
+        cursor.execute("SELECT value FROM meta WHERE key='imported'")
+        if cursor.fetchone() is not None:
+            return None
+
+        return self._importFeeds(cursor, fileStorage)
+
+    def _importFeeds(self, cursor, fileStorage):
+        fileStorage._readFeedList()
+
+        for handle, entry in fileStorage.feeds.iteritems():
+            try:
+                feed = fileStorage._readFeed(handle)
+                data = zlib.compress(self._dump(feed))
+            except Exception:
+                log.err(None, "%s: Could not import cached feed" % handle)
+                data = None
+            else:
+                data = buffer(data)
+
+            cursor.execute("""INSERT OR IGNORE INTO feeds (handle, href, feed)
+                              VALUES (?, ?, ?)""",
+                           (handle, entry['href'], data))
+
+        cursor.execute("""INSERT OR REPLACE INTO meta (key, value)
+                          VALUES ('imported', ?)""",
+                       (fileStorage.feedsDir.path,))
+        return len(fileStorage.feeds)
 
 
 
@@ -197,15 +581,48 @@ class AggregatorService(service.Service):
     @type feedListFile: L{str}
     @ivar handler: handler of new and changed feed items.
     @type handler: object implementing L{IFeedHandler}
+    @ivar placement: how the first polls are placed after startup. With
+                     C{'spread'}, each feed is first polled at a
+                     deterministic, pseudo-random point within
+                     L{initialInterval}, after which its adaptive interval
+                     takes over. With C{'stagger'}, feeds are polled one
+                     after the other, L{STAGGER} seconds apart.
+    @type placement: C{str}
+    @ivar initialInterval: interval to spread the first polls over.
+    @type initialInterval: C{int}
+    @ivar minInterval: lower bound for the adaptive polling interval.
+    @type minInterval: C{int}
+    @ivar maxInterval: upper bound for the adaptive polling interval.
+    @type maxInterval: C{int}
+    @ivar dispatcher: dispatcher that limits concurrent feed retrievals.
+    @type dispatcher: L{fetcher.FetchDispatcher}
+    @ivar subscribers: handles of the feeds by the canonical form of their
+                       URL, see L{fetcher.canonicalURL}.
+    @type subscribers: C{dict}
+    @ivar entryFields: entry fields that make up the digest of an entry,
+                       see L{entryDigest}. Changes in other fields do not
+                       cause an entry to be considered updated.
+    @type entryFields: C{tuple}
+    @ivar metrics: runtime metrics of retrievals, entries and publishing.
+    @type metrics: L{metrics.Metrics}
     """
 
     implements(IAggregatorService)
 
     agent = "MimirAggregator/%s (http://mimir.ik.nu/)" % __version__
+    placement = 'spread'
+    initialInterval = INTERVAL
+    minInterval = MIN_INTERVAL
+    maxInterval = MAX_INTERVAL
+    entryFields = ENTRY_FIELDS
 
     def __init__(self, storage):
         self.handler = None
         self.storage = storage
+        self.dispatcher = fetcher.FetchDispatcher()
+        self.subscribers = {}
+        self.metrics = metrics.Metrics()
+        self._feedKeys = {}
 
     def _callLater(self, *args, **kwargs):
         """
@@ -214,6 +631,13 @@ class AggregatorService(service.Service):
 
         return reactor.callLater(*args, **kwargs)
 
+    def _seconds(self):
+        """
+        Make seconds calls indirect for testing purposes.
+        """
+
+        return reactor.seconds()
+
     def startService(self):
         """
         Read feeds from file and initialize service.
@@ -222,91 +646,210 @@ class AggregatorService(service.Service):
         log.msg('Starting Aggregator')
         service.Service.startService(self)
 
-        self.schedule = {}
+        self.scheduler = scheduler.PollScheduler(self._callLater,
+                                                 self._seconds)
+        self.scheduler.lagObserver = self.observeLag
 
         def scheduleFeeds(feeds):
-            delay = 5
-            for handle in feeds:
-                self.reschedule(delay, handle)
-                delay += 5
+            for handle, feed in feeds.iteritems():
+                self.subscribe(handle, feed['href'])
+
+            if self.placement == 'stagger':
+                delay = STAGGER
+                for handle in feeds:
+                    self.reschedule(delay, handle)
+                    delay += STAGGER
+            else:
+                # The adapted polling interval is kept in the cached feed,
+                # which is too expensive to read for every feed here.
+                for handle in feeds:
+                    self.reschedule(self.initialDelay(handle,
+                                                      self.initialInterval),
+                                    handle)
 
         d = self.storage.getFeedList()
         d.addCallback(scheduleFeeds)
 
+    def initialDelay(self, handle, interval):
+        """
+        Calculate the delay for the first poll of a feed after startup.
+
+        The delay is derived from a hash of the handle, so that first polls
+        are spread uniformly over the interval, but end up at the same spot
+        on every restart.
+        """
+
+        if isinstance(handle, unicode):
+            handle = handle.encode('utf-8')
+
+        digest = hashlib.md5(handle).digest()
+        fraction = struct.unpack('>I', digest[:4])[0] / 4294967296.0
+        return fraction * interval
+
     def stopService(self):
         log.msg('Stopping Aggregator')
         service.Service.stopService(self)
 
-        calls = self.schedule.values()
-        self.schedule = {}
-        for call in calls:
-            call.cancel()
+        self.scheduler.stop()
+        return self.dispatcher.close()
 
     def setFeed(self, handle, url):
-        if not RE_HANDLE.match(handle):
-            return defer.fail(InvalidHandleError())
+        d = self.setFeeds([(handle, url)])
+        d.addCallback(lambda feeds: feeds[0])
+        return d
 
-        try:
-            self.schedule[handle].cancel()
-        except KeyError:
-            pass
+    def setFeeds(self, feeds):
+        """
+        Add or update feeds, and schedule their first retrieval.
+
+        The first retrievals are spread over L{STAGGER} seconds per feed,
+        capped at the default polling interval. A single feed is
+        retrieved right away.
+        """
+        for handle, url in feeds:
+            if not RE_HANDLE.match(handle):
+                return defer.fail(InvalidHandleError(handle))
+
+        for handle, url in feeds:
+            self.scheduler.cancel(handle)
+
+        def scheduleFeeds(result):
+            for handle, url in feeds:
+                self.subscribe(handle, url)
 
-        def scheduleFeed(result):
             if self.running:
-                self.reschedule(0, handle, useCache=0)
+                window = min(INTERVAL, STAGGER * (len(feeds) - 1))
+                for handle, url in feeds:
+                    self.reschedule(self.initialDelay(handle, window),
+                                    handle, useCache=0)
             return result
 
-        d = self.storage.setFeedURL(handle, url)
-        d.addCallback(scheduleFeed)
+        d = self.storage.setFeedURLs(feeds)
+        d.addCallback(scheduleFeeds)
         return d
 
+    def subscribe(self, handle, url):
+        """
+        Register the URL of a feed, for sharing retrievals.
+        """
+        key = fetcher.canonicalURL(url)
+        oldKey = self._feedKeys.get(handle)
+        if oldKey == key:
+            return
+
+        if oldKey is not None:
+            self.subscribers[oldKey].discard(handle)
+            if not self.subscribers[oldKey]:
+                del self.subscribers[oldKey]
+
+        self._feedKeys[handle] = key
+        self.subscribers.setdefault(key, set()).add(handle)
+
     def aggregate(self, handle, useCache=1):
-        def setInterval(feed, cachedFeed):
-            feed['interval'] = cachedFeed['interval']
-            return feed
+        """
+        Aggregate a feed, together with the feeds that share its URL.
 
-        def aggregateFeed(cachedFeed):
-            headers = {}
+        Feeds with the same URL that are waiting for their next poll are
+        polled right away, so that they share a single retrieval. This
+        keeps their polls aligned from then on.
+        """
+
+        handles = [handle]
+        if useCache:
+            for other in self.subscribers.get(self._feedKeys.get(handle), ()):
+                if other != handle and other in self.scheduler:
+                    self.scheduler.cancel(other)
+                    handles.append(other)
+
+        if len(handles) == 1:
+            return self.pollFeed(handle, useCache)
+        else:
+            return defer.DeferredList([self.pollFeed(other, useCache)
+                                       for other in handles])
+
+    def pollFeed(self, handle, useCache=1):
+        """
+        Retrieve a feed, and publish its new and updated entries.
+        """
+
+        def keepHints(result, cachedFeed):
+            cachedFeed['hints'] = result.get('hints', {})
+            return result
 
+        def aggregateFeed(cachedFeed):
             if 'interval' not in cachedFeed:
                 cachedFeed['interval'] = INTERVAL
 
+            # Validators from the stored feed seed the fetcher's validator
+            # cache, for when it has none for this feed's URL.
             if useCache:
-                etag = cachedFeed.get('etag', None)
-                updated = cachedFeed.get('updated', None)
-                if etag:
-                    headers['If-None-Match'] = str(etag)
-                if updated:
-                    short_weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri',
-                                      'Sat', 'Sun']
-                    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
-                              'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-                    headers['If-Modified-Since'] = \
-                        '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
-                                short_weekdays[updated[6]],
-                                updated[2],
-                                months[updated[1] - 1],
-                                updated[0],
-                                updated[3], updated[4], updated[5])
-
-            d = defer.maybeDeferred(fetcher.getFeed, str(cachedFeed['href']),
-                                                     agent=self.agent,
-                                                     headers=headers,
-                                                     useCache=useCache)
-            d.addCallback(self.workOnFeed, handle)
-            d.addCallback(self.findFreshEntries, handle, cachedFeed)
-            d.addCallback(setInterval, cachedFeed)
-            d.addCallback(self.updateCache)
-            d.addErrback(self.notModified, handle)
-            d.addErrback(self.logNoFeed, handle)
-            d.addErrback(self.munchError, handle)
-            d.addBoth(lambda _: self.reschedule(cachedFeed['interval'], handle))
+                digest = cachedFeed.get('digest', None)
+                validators = fetcher.getValidators(cachedFeed)
+            else:
+                digest = None
+                validators = None
+
+            d = self.dispatcher.getFeed(str(cachedFeed['href']),
+                                        agent=self.agent,
+                                        useCache=useCache,
+                                        digest=digest,
+                                        validators=validators)
+            d.addBoth(self.recordFetch, handle, self._seconds())
+            d.addCallback(keepHints, cachedFeed)
+            d.addCallback(profiling.wrap('work', handle, self.workOnFeed),
+                          handle)
+            d.addCallback(profiling.wrap('fresh', handle,
+                                         self.findFreshEntries),
+                          handle, cachedFeed)
+            d.addCallback(profiling.wrap('store', handle, self.updateCache))
+            d.addErrback(self.notModified, handle, cachedFeed)
+            d.addErrback(self.fetchAborted, handle, cachedFeed)
+            d.addErrback(self.logNoFeed, handle, cachedFeed)
+            d.addErrback(self.munchError, handle, cachedFeed)
+            d.addBoth(lambda _: self.reschedule(self.nextDelay(cachedFeed),
+                                                handle))
             return d
 
         d = self.storage.getFeed(handle)
         d.addCallback(aggregateFeed)
         return d
 
+    def observeLag(self, handle, lag):
+        self.metrics.observe('scheduleLag', lag, handle)
+
+    def recordFetch(self, result, handle, start):
+        """
+        Record the latency and outcome of a retrieval in the metrics.
+        """
+        self.metrics.increment('fetches', handle)
+        self.metrics.observe('fetchLatency', self._seconds() - start, handle)
+
+        if not isinstance(result, failure.Failure):
+            self.metrics.countStatus(result.get('status', '200'), handle)
+        elif result.check(fetcher.Unchanged):
+            self.metrics.countStatus('200', handle)
+            self.metrics.increment('unchanged', handle)
+        elif result.check(fetcher.NotModified):
+            self.metrics.countStatus('304', handle)
+            self.metrics.increment('notModified', handle)
+        else:
+            if result.check(error.Error):
+                self.metrics.countStatus(result.value.status, handle)
+            self.metrics.increment('errors', handle)
+
+        return result
+
+    def recordPublish(self, result, handle, start):
+        """
+        Record the latency and outcome of publishing in the metrics.
+        """
+        self.metrics.increment('publishes', handle)
+        self.metrics.observe('publishLatency', self._seconds() - start,
+                             handle)
+        if isinstance(result, failure.Failure):
+            self.metrics.increment('publishErrors', handle)
+        return result
+
     def workOnFeed(self, result, handle):
         result['handle'] = handle
 
@@ -314,6 +857,7 @@ class AggregatorService(service.Service):
             log.msg("%s: Feed's location changed permanently to %s" %
                     (handle, result.href))
             self.storage.setFeedURL(handle, result.href)
+            self.subscribe(handle, result.href)
 
         if result.feed:
             log.msg("%s: Got feed." % handle)
@@ -340,11 +884,18 @@ class AggregatorService(service.Service):
                 log.msg("%s:   title (%s): %r" % (handle,
                                                   entry.title_detail.type,
                                                   entry.title_detail.value))
+            if kind == 'new':
+                self.metrics.increment('entriesNew', handle)
+            else:
+                self.metrics.increment('entriesUpdated', handle)
             discoveredEntries.append(entry)
 
         cacheIndexes = cachedFeed.get('indexes', {})
+        cacheDigests = cachedFeed.get('digests', {})
+        cacheEntries = cachedFeed.get('entries')
 
         newCacheIndexes = {}
+        newCacheDigests = {}
         discoveredEntries = []
 
         index = len(result.entries)
@@ -354,48 +905,174 @@ class AggregatorService(service.Service):
             if 'id' not in entry:
                 continue
 
+            digest = self.entryDigest(entry)
+
             if entry.id not in cacheIndexes:
                 add(entry, 'new')
             else:
-                jsonEntry = simplejson.dumps(entry, cls=FeedParserEncoder)
-                newEntry = simplejson.loads(jsonEntry)
-                if cachedFeed['entries'][cacheIndexes[entry.id]] != newEntry:
+                cacheDigest = cacheDigests.get(entry.id)
+                if cacheDigest is None and cacheEntries:
+                    # Cached before digests were kept.
+                    cacheDigest = self.entryDigest(
+                        cacheEntries[cacheIndexes[entry.id]])
+                if cacheDigest is not None and cacheDigest != digest:
                     add(entry, 'updated')
 
             newCacheIndexes[entry.id] = index
+            newCacheDigests[entry.id] = digest
 
         result['indexes'] = newCacheIndexes
+        result['digests'] = newCacheDigests
+
+        if discoveredEntries:
+            outcome = 'fresh'
+        else:
+            outcome = 'stale'
+        interval = self.adaptInterval(cachedFeed['interval'], outcome)
+        result['interval'] = cachedFeed['interval'] = interval
 
         if discoveredEntries:
+            start = self._seconds()
             d = self.handler.entriesDiscovered(handle, result,
                                                discoveredEntries)
+            if getattr(self.handler, 'spool', None) is None:
+                # A spool records the publish requests it sends itself.
+                d.addBoth(self.recordPublish, handle, start)
         else:
             d = defer.succeed(None)
 
         d.addCallback(lambda _: result)
         return d
 
+    def entryDigest(self, entry):
+        """
+        Calculate the digest of an entry over the fields in L{entryFields}.
+
+        The digest is the same for an entry as parsed and for that entry
+        as read back from its JSON serialization.
+
+        @rtype: C{str}
+        """
+        values = [entry.get(field) for field in self.entryFields]
+        data = simplejson.dumps(values, cls=FeedParserEncoder, sort_keys=True)
+        return hashlib.sha1(data).hexdigest()
+
     def updateCache(self, result):
+        """
+        Store the feed, without its entries.
+
+        Entries are recognized by the C{'indexes'} and C{'digests'} that
+        were added by L{findFreshEntries}.
+        """
         log.msg("%s: updating cache" % result["handle"])
-        return self.storage.storeFeed(result)
+        cachedFeed = dict([(key, value) for key, value in result.iteritems()
+                                        if key != 'entries'])
+        return self.storage.storeFeed(cachedFeed)
+
+    def adaptInterval(self, interval, outcome):
+        """
+        Calculate the next polling interval of a feed.
+
+        The interval shrinks for feeds that keep having fresh entries, and
+        grows for feeds that don't change or fail, within the bounds set by
+        L{minInterval} and L{maxInterval}.
+
+        @param interval: the current polling interval.
+        @param outcome: the outcome of the last poll, one of the keys of
+                        L{INTERVAL_FACTORS}.
+        """
+
+        interval = int(interval * INTERVAL_FACTORS[outcome])
+        return max(self.minInterval, min(self.maxInterval, interval))
+
+    def updateInterval(self, cachedFeed, outcome):
+        """
+        Adapt the polling interval of a feed that was not updated in cache.
+
+        The cached feed is only stored if its interval actually changed.
+        """
+
+        interval = self.adaptInterval(cachedFeed['interval'], outcome)
+        if interval == cachedFeed['interval']:
+            return None
+
+        cachedFeed['interval'] = interval
+        return self.storage.storeFeed(cachedFeed)
+
+    def nextDelay(self, cachedFeed):
+        """
+        Calculate the delay until the next poll of a feed.
+
+        This starts out with the feed's polling interval, and honors the
+        scheduling hints of the last response, see L{fetcher.getHeaderHints}
+        and L{fetcher.getFeedHints}. Hints that would postpone the next
+        poll are capped at L{maxInterval}. A poll that would fall in one of
+        the feed's C{skipHours} is postponed to the next hour that is not.
+        """
+
+        delay = cachedFeed['interval']
+        hints = cachedFeed.get('hints') or {}
+
+        for key in ('maxAge', 'retryAfter', 'ttl', 'updatePeriod'):
+            if key in hints:
+                delay = max(delay, min(hints[key], self.maxInterval))
 
-    def notModified(self, failure, handle):
+        skipHours = hints.get('skipHours')
+        if skipHours and len(skipHours) < 24:
+            now = self._seconds()
+            due = now + delay
+            while time.gmtime(due)[3] in skipHours:
+                due += 3600 - due % 3600
+            delay = due - now
+
+        return delay
+
+    def updateHeaderHints(self, cachedFeed, hints):
+        """
+        Replace the header hints of a feed, keeping the feed hints.
+
+        Responses without a feed document only carry the hints from the
+        response headers, see L{fetcher.getHeaderHints}. The hints from the
+        feed itself, see L{fetcher.getFeedHints}, still apply.
+        """
+
+        newHints = dict((key, value)
+                        for key, value in (cachedFeed.get('hints') or
+                                           {}).iteritems()
+                        if key not in fetcher.HEADER_HINTS)
+        newHints.update(hints)
+        cachedFeed['hints'] = newHints
+
+    def notModified(self, failure, handle, cachedFeed):
         failure.trap(fetcher.NotModified)
-        log.msg("%s: Not Modified" % handle)
+        if failure.check(fetcher.Unchanged):
+            log.msg("%s: Unchanged" % handle)
+        else:
+            log.msg("%s: Not Modified" % handle)
+        self.updateHeaderHints(cachedFeed, failure.value.hints)
+        return self.updateInterval(cachedFeed, 'stale')
 
-    def reschedule(self, delay, handle, useCache=1):
-        def cb():
-            del self.schedule[handle]
-            self.aggregate(handle, useCache=useCache)
+    def fetchAborted(self, failure, handle, cachedFeed):
+        failure.trap(fetcher.FetchAborted)
+        log.msg("%s: Retrieval aborted: %s(%s)" % (handle,
+                                                 failure.value.__class__.__name__,
+                                                 failure.value))
+        return self.updateInterval(cachedFeed, 'error')
 
-        self.schedule[handle] = self._callLater(delay, cb)
+    def reschedule(self, delay, handle, useCache=1):
+        self.scheduler.schedule(delay, handle,
+                                self.aggregate, handle, useCache=useCache)
 
-    def logNoFeed(self, failure, handle):
+    def logNoFeed(self, failure, handle, cachedFeed):
         failure.trap(error.Error)
         log.err(failure, "%s: No feed" % handle)
+        if failure.check(fetcher.Throttled):
+            self.updateHeaderHints(cachedFeed, failure.value.hints)
+        return self.updateInterval(cachedFeed, 'error')
 
-    def munchError(self, failure, handle):
+    def munchError(self, failure, handle, cachedFeed):
         log.err(failure, "%s: Unhandled Error" % handle)
+        return self.updateInterval(cachedFeed, 'error')
 
 
 class XMPPControl(XMPPHandler):
@@ -408,12 +1085,34 @@ class XMPPControl(XMPPHandler):
         self.xmlstream.addObserver(xpath, self.onFeed, 0)
 
     def onFeed(self, iq):
-        handle = str(iq.aggregator.feed.handle or '')
-        url = str(iq.aggregator.feed.url or '')
+        """
+        Add or update the feeds in the request, and create their nodes.
+        """
+        feeds = []
+        for element in iq.aggregator.elements(NS_AGGREGATOR, 'feed'):
+            handle = str(element.handle or '')
+            url = str(element.url or '')
+            if not (handle and url):
+                feeds = None
+                break
+            feeds.append((handle, url))
 
         iq.handled = True
 
-        def success(_):
+        def checkNodes(_):
+            return self.service.handler.checkNodes([handle for handle, url
+                                                           in feeds])
+
+        def success(results):
+            failed = False
+            for succeeded, result in results:
+                if not succeeded:
+                    log.err(result, "Could not create node")
+                    failed = True
+
+            if failed:
+                raise StanzaError('internal-error')
+
             return xmlstream.toResponse(iq, 'result')
 
         def trapInvalidHandle(failure):
@@ -428,8 +1127,9 @@ class XMPPControl(XMPPHandler):
                 exc = StanzaError('internal-error')
             return exc.toResponse(iq)
 
-        if handle and url:
-            d = self.service.setFeed(handle, url)
+        if feeds:
+            d = self.service.setFeeds(feeds)
+            d.addCallback(checkNodes)
             d.addCallback(success)
             d.addErrback(trapInvalidHandle)
         else:
@@ -445,6 +1145,12 @@ components.registerAdapter(XMPPControl, IAggregatorService,
 class AddFeedResource(resource.Resource):
     """
     Resource to add a new feed to be aggregated.
+
+    The request body is a JSON object with C{handle} and C{url}, and the
+    response has the C{uri} of the node the feed is published to. To add
+    feeds in bulk, the request body is a JSON array of such objects, and
+    the response an array with an object per feed, with its C{handle} and
+    either the C{uri} of its node, or an C{error}.
     """
 
     def __init__(self, service):
@@ -453,17 +1159,46 @@ class AddFeedResource(resource.Resource):
     http_GET = None
 
     def http_POST(self, request):
+        def getFeeds(item):
+            try:
+                return (str(item['handle']), str(item['url']))
+            except (KeyError, TypeError):
+                raise InvalidRequestError()
+
         def gotRequest(result):
-            url = result['url']
-            handle = result['handle']
-            d = self.service.setFeed(handle, url)
-            d.addCallback(lambda _: self.service.handler.checkNode(handle))
+            if isinstance(result, list):
+                feeds = [getFeeds(item) for item in result]
+                if not feeds:
+                    raise InvalidRequestError()
+                d = self.service.setFeeds(feeds)
+                d.addCallback(lambda _: self.service.handler.checkNodes(
+                    [handle for handle, url in feeds]))
+                d.addCallback(createBulkResponse, feeds)
+            else:
+                handle, url = getFeeds(result)
+                d = self.service.setFeed(handle, url)
+                d.addCallback(lambda _: self.service.handler.checkNode(handle))
+                d.addCallback(createResponse)
             return d
 
+        def getURI(node):
+            return 'xmpp:%s?;node=%s' % (self.service.handler.service.full(),
+                                         node)
+
         def createResponse(result):
-            response = {'uri': 'xmpp:%s?;node=%s' % (
-                self.service.handler.service.full(),
-                result)}
+            response = {'uri': getURI(result)}
+            return http.Response(responsecode.OK, stream=simplejson.dumps(response))
+
+        def createBulkResponse(results, feeds):
+            response = []
+            for (handle, url), (succeeded, result) in zip(feeds, results):
+                if succeeded:
+                    response.append({'handle': handle,
+                                     'uri': getURI(result)})
+                else:
+                    log.err(result, "%s: Could not create node" % handle)
+                    response.append({'handle': handle,
+                                     'error': 'Could not create node'})
             return http.Response(responsecode.OK, stream=simplejson.dumps(response))
 
         def trapInvalidHandle(failure):
@@ -471,50 +1206,150 @@ class AddFeedResource(resource.Resource):
             return http.StatusResponse(responsecode.BAD_REQUEST,
                                        """Invalid handle""")
 
+        def trapInvalidRequest(failure):
+            failure.trap(InvalidRequestError, ValueError)
+            return http.StatusResponse(responsecode.BAD_REQUEST,
+                                       """Invalid request""")
+
         data = []
         d = readStream(request.stream, data.append)
         d.addCallback(lambda _: ''.join(data))
         d.addCallback(simplejson.loads)
         d.addCallback(gotRequest)
-        d.addCallback(createResponse)
         d.addErrback(trapInvalidHandle)
+        d.addErrback(trapInvalidRequest)
         return d
 
 
 
+class ProfileResource(resource.Resource):
+    """
+    Resource to inspect a profiler.
+
+    A GET request returns the report of the stage timings. A POST request
+    with a C{sampling} query argument of C{on} starts sampling with
+    C{cProfile}, and with C{off} stops it and returns the samples.
+
+    @ivar profiler: the profiler.
+    @type profiler: L{profiling.Profiler}
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+
+    def http_GET(self, request):
+        return http.Response(responsecode.OK, stream=self.profiler.report())
+
+
+    def http_POST(self, request):
+        sampling = request.args.get('sampling', [None])[0]
+        if sampling == 'on':
+            self.profiler.startSampling()
+            return http.Response(responsecode.OK, stream="Sampling\n")
+        elif sampling == 'off':
+            samples = self.profiler.stopSampling() or "Not sampling\n"
+            return http.Response(responsecode.OK, stream=samples)
+        else:
+            return http.StatusResponse(responsecode.BAD_REQUEST,
+                                       """Invalid request""")
+
+
+
 class AtomPublisher(object):
+    """
+    Feed handler that publishes entries as Atom to a node per feed.
+
+    @ivar spool: spool that publishes the entries, or C{None} to publish
+        them directly.
+    @type spool: L{spool.PublishSpool}
+    @ivar renderCache: cache of rendered entries, or C{None}.
+    @type renderCache: L{rendercache.RenderCache}
+    """
 
     implements(IFeedHandler)
 
+    maxNodeCreations = MAX_NODE_CREATIONS
+
     def __init__(self, protocol):
         self.protocol = protocol
         self.service = None
+        self.spool = None
+        self.renderCache = None
         self.writer = writer.ReconstituteWriter()
+        self.nodeSemaphore = defer.DeferredSemaphore(self.maxNodeCreations)
 
 
     def _getNode(self, handle):
         return 'mimir/news/%s' % handle
 
 
+    def renderDigest(self, feed, entry):
+        """
+        Calculate the digest of what an entry is rendered from.
+
+        Unlike L{AggregatorService.entryDigest}, this covers all of the
+        entry, and the parts of the feed in L{RENDER_FEED_FIELDS}, like the
+        feed metadata that goes into the entry's source.
+
+        @rtype: C{str}
+        """
+        values = [entry] + [feed.get(field) for field in RENDER_FEED_FIELDS]
+        data = simplejson.dumps(values, cls=FeedParserEncoder, sort_keys=True)
+        return hashlib.sha1(data).hexdigest()
+
+
+    def render(self, handle, feed, entry):
+        """
+        Render an entry to serialized XML.
+
+        If there is a render cache, a previous rendering of the entry from
+        the same contents, see L{renderDigest}, is used.
+
+        @rtype: C{unicode}
+        """
+        if self.renderCache is None:
+            key = None
+        else:
+            key = self.renderCache.key(self.writer.__class__.__name__,
+                                       handle, entry.id,
+                                       self.renderDigest(feed, entry))
+            xml = self.renderCache.get(key)
+            if xml is not None:
+                return xml
+
+        entryDoc = profiling.call('write', handle,
+                                  self.writer.generate, feed, entry)
+        xml = entryDoc.toXml()
+        if key is not None:
+            self.renderCache.put(key, xml)
+        return xml
+
+
     def entriesDiscovered(self, handle, feed, entries):
         log.msg("%s: publishing items" % handle)
 
         node = self._getNode(handle)
 
-        items = []
+        payloads = []
         for entry in entries:
             try:
-                entryDoc = self.writer.generate(feed, entry)
+                xml = self.render(handle, feed, entry)
             except domish.ParserError:
                 log.err(None, '%s: Error processing entry: %r' % (handle,
                                                                   entry.title))
             else:
-                items.append(pubsub.Item(entry.id, entryDoc))
+                payloads.append((entry.id, xml))
 
-        if items:
-            return self.protocol.publish(self.service, node, items)
-        else:
+        if not payloads:
             return defer.succeed(None)
+        elif self.spool is not None:
+            return profiling.call('spool', handle, self.spool.enqueue, node,
+                                  payloads)
+        else:
+            items = [pubsub.Item(itemId, xml) for itemId, xml in payloads]
+            return profiling.call('publish', handle, self.protocol.publish,
+                                  self.service, node, items)
 
     def checkNode(self, handle):
         def trapConflict(failure, node):
@@ -530,5 +1365,18 @@ class AtomPublisher(object):
         d.addErrback(trapConflict, node)
         return d
 
+    def checkNodes(self, handles):
+        """
+        Make sure the nodes for the feeds exist, with a limited number of
+        node creation requests outstanding.
+
+        @return: deferred that fires with a list of tuples of success and
+                 node or failure, like L{defer.DeferredList}.
+        """
+        return defer.DeferredList([self.nodeSemaphore.run(self.checkNode,
+                                                          handle)
+                                   for handle in handles],
+                                  consumeErrors=True)
+
 components.registerAdapter(AtomPublisher, pubsub.IPubSubClient,
                                           IFeedHandler)
@@ -0,0 +1,299 @@
+# -*- test-case-name: mimir.aggregator.test.test_benchmark -*-
+#
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Benchmarks for the per-entry work of the aggregator.
+
+Measures the throughput of parsing feeds, with the Universal Feed Parser
+and with the fast parser of L{mimir.aggregator.fastparser}, of the writers
+that generate the published entries and of the change detection in
+L{aggregator.AggregatorService.findFreshEntries}, over a corpus of feed
+documents. The default corpus is the set of feeds used by the tests, which
+has RSS 0.9x and 2.0, Atom 0.3 and 1.0 and malformed feeds.
+
+Run it with::
+
+    python -m mimir.aggregator.benchmark [options] [benchmark ...]
+
+For every benchmark, this reports the number of entries processed per
+second, for the fastest of a number of runs, and the number of objects
+retained per entry. The latter counts the objects tracked by the garbage
+collector that are still alive after a single run over the corpus, with
+the results of that run kept. Temporary objects are not counted. This is
+what a writer leaves behind for the publisher, which is what sets writer
+variants apart.
+"""
+
+import gc
+import simplejson
+import sys
+import timeit
+
+from twisted.internet import defer
+from twisted.python import usage
+from twisted.python.filepath import FilePath
+
+from mimir.aggregator import aggregator, fetcher, writer
+
+CORPUS = FilePath(__file__).sibling('test').child('feeds')
+NUMBER = 10
+REPEAT = 3
+
+class Corpus(object):
+    """
+    Feed documents to run benchmarks on.
+
+    @ivar documents: the raw documents, as tuples of name and contents.
+    @type documents: C{list}
+    @ivar feeds: the parsed documents.
+    @type feeds: C{list} of L{fetcher.feedparser.FeedParserDict}
+    @ivar entries: the total number of entries in the parsed documents.
+    @type entries: C{int}
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.feeds = [parse(name, data) for name, data in documents]
+        self.entries = sum([len(feed.entries) for feed in self.feeds])
+
+
+    @classmethod
+    def fromPath(cls, path=CORPUS):
+        """
+        Load all C{.xml} documents in a directory.
+        """
+        documents = [(child.basename(), child.getContent())
+                     for child in sorted(path.globChildren('*.xml'))]
+        return cls(documents)
+
+
+
+def parse(name, data, fast=False):
+    """
+    Parse a document like a retrieved feed.
+    """
+    return fetcher.parseDocument(data, 'http://example.org/' + name, '200',
+                                 {}, fast)
+
+
+
+class NullFeedHandler(object):
+    """
+    Feed handler that drops all discovered entries.
+    """
+
+    def entriesDiscovered(self, handle, feed, entries):
+        return defer.succeed(None)
+
+
+
+def benchmarkParse(fast):
+    """
+    Parse and scrub all documents.
+
+    @param fast: if set, use the fast parser, falling back to the Universal
+        Feed Parser for documents it does not handle.
+    @type fast: C{bool}
+    """
+    def benchmark(corpus):
+        def run():
+            return [parse(name, data, fast)
+                    for name, data in corpus.documents]
+        return run
+    return benchmark
+
+
+
+def benchmarkWriter(writerClass):
+    """
+    Generate all entries with an instance of C{writerClass}.
+    """
+    def benchmark(corpus):
+        instance = writerClass()
+
+        def run():
+            return [instance.generate(feed, entry)
+                    for feed in corpus.feeds
+                    for entry in feed.entries]
+        return run
+    return benchmark
+
+
+
+def benchmarkFreshEntries(cached):
+    """
+    Find fresh entries in all feeds.
+
+    @param cached: if set, the feeds have been seen before, without changes.
+        Otherwise, all entries are new.
+    @type cached: C{bool}
+    """
+    def benchmark(corpus):
+        service = aggregator.AggregatorService(None)
+        service.handler = NullFeedHandler()
+
+        caches = []
+        for feed in corpus.feeds:
+            cachedFeed = {'interval': aggregator.INTERVAL}
+            if cached:
+                cachedFeed['indexes'] = dict(
+                    [(entry.id, index)
+                     for index, entry in enumerate(feed.entries)
+                     if 'id' in entry])
+                cachedFeed['digests'] = dict(
+                    [(entry.id, service.entryDigest(entry))
+                     for entry in feed.entries
+                     if 'id' in entry])
+            caches.append(cachedFeed)
+
+        def run():
+            return [service.findFreshEntries(feed, 'benchmark', cachedFeed)
+                    for feed, cachedFeed in zip(corpus.feeds, caches)]
+        return run
+    return benchmark
+
+
+
+def available(benchmark):
+    """
+    Return whether a benchmark can be run, given the installed packages.
+    """
+    if benchmark == 'reconstitute':
+        try:
+            from planet import reconstitute
+        except ImportError:
+            return False
+    return True
+
+
+
+# Benchmarks, by name, in the order they are run by default.
+BENCHMARKS = [
+    ('parse', benchmarkParse(fast=False)),
+    ('fastparse', benchmarkParse(fast=True)),
+    ('atom', benchmarkWriter(writer.AtomWriter)),
+    ('mimir', benchmarkWriter(writer.MimirWriter)),
+    ('reconstitute', benchmarkWriter(writer.ReconstituteWriter)),
+    ('direct', benchmarkWriter(writer.DirectAtomWriter)),
+    ('fresh-new', benchmarkFreshEntries(cached=False)),
+    ('fresh-cached', benchmarkFreshEntries(cached=True)),
+    ]
+
+
+
+def countRetained(run):
+    """
+    Count the objects retained by one call to C{run}.
+
+    Garbage is collected before counting, so that objects in unreachable
+    reference cycles are not counted.
+    """
+    gc.collect()
+    before = len(gc.get_objects())
+    result = run()
+    gc.collect()
+    after = len(gc.get_objects())
+
+    # Don't count the list of results itself.
+    del result
+    return after - before - 1
+
+
+
+def measure(name, corpus, number=NUMBER, repeat=REPEAT):
+    """
+    Run a benchmark on a corpus.
+
+    @param number: the number of passes over the corpus in a single run.
+    @type number: C{int}
+    @param repeat: the number of runs, of which the fastest is reported.
+    @type repeat: C{int}
+    @return: the benchmark name, the number of entries, the number of
+        entries per second and the number of objects retained per entry.
+    @rtype: C{dict}
+    """
+    run = dict(BENCHMARKS)[name](corpus)
+
+    retained = countRetained(run)
+    timer = timeit.Timer(run)
+    best = min(timer.repeat(repeat, number))
+
+    entries = corpus.entries or 1
+    return {'benchmark': name,
+            'entries': corpus.entries,
+            'rate': corpus.entries * number / best,
+            'retained': float(retained) / entries}
+
+
+
+class Options(usage.Options):
+    synopsis = "[options] [benchmark ...]"
+
+    optParameters = [
+        ('corpus', None, CORPUS.path,
+            'Directory with the feed documents to run the benchmarks on'),
+        ('number', 'n', NUMBER,
+            'Number of passes over the corpus in a single run', int),
+        ('repeat', 'r', REPEAT,
+            'Number of runs, of which the fastest is reported', int),
+    ]
+
+    optFlags = [
+        ('json', None, 'Report results as JSON, one object per line'),
+    ]
+
+    def parseArgs(self, *benchmarks):
+        names = [name for name, _ in BENCHMARKS]
+        for benchmark in benchmarks:
+            if benchmark not in names:
+                raise usage.UsageError("Unknown benchmark %r, choose from: %s" %
+                                       (benchmark, ', '.join(names)))
+
+        self['benchmarks'] = list(benchmarks) or names
+
+
+    def postOptions(self):
+        if self['number'] < 1 or self['repeat'] < 1:
+            raise usage.UsageError("The number of passes and runs "
+                                   "must be positive")
+
+
+
+def formatResult(result):
+    return "%(benchmark)-14s %(entries)8d %(rate)12.1f %(retained)10.1f" % (
+                result)
+
+
+
+def main(argv=None, stdout=sys.stdout):
+    config = Options()
+    try:
+        config.parseOptions(argv)
+    except usage.UsageError, e:
+        raise SystemExit("%s\n%s" % (config, e))
+
+    corpus = Corpus.fromPath(FilePath(config['corpus']))
+
+    if not config['json']:
+        stdout.write("%-14s %8s %12s %10s\n" % ('benchmark', 'entries',
+                                               'entries/s', 'retained'))
+
+    for name in config['benchmarks']:
+        if not available(name):
+            if not config['json']:
+                stdout.write("%-14s skipped, not available\n" % name)
+            continue
+
+        result = measure(name, corpus, config['number'], config['repeat'])
+        if config['json']:
+            stdout.write(simplejson.dumps(result) + "\n")
+        else:
+            stdout.write(formatResult(result) + "\n")
+        stdout.flush()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,978 @@
+# -*- test-case-name: mimir.aggregator.test.test_fastparser -*-
+#
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Fast parser for well-formed Atom 1.0 and RSS 2.0 feeds.
+
+Most feeds are well-formed, so the Universal Feed Parser parses them with
+its strict, SAX based parser. Still, that is the most expensive step in
+handling a retrieved feed, mostly because of the generic way it dispatches
+elements and stores values. The parser in this module streams the
+document through C{cElementTree.iterparse}, replaying the events in the
+order a SAX parser would report them, and mirrors the element handlers of
+the Universal Feed Parser that matter for Atom 1.0 and RSS 2.0. The result
+has the same L{feedparser.FeedParserDict} structure.
+
+Anything outside of that subset raises L{Unsupported}, and L{parse} then
+falls back to the Universal Feed Parser. This includes documents that are
+not well-formed, that have a document type declaration or an encoding
+problem, other versions of RSS and Atom, elements in namespaces the
+Universal Feed Parser does not know, elements it has handlers for that
+are not mirrored here, like C{source} and C{textInput}, inline XHTML and
+base64 encoded content. As the Universal Feed Parser is set up to leave
+embedded HTML alone by L{mimir.aggregator.fetcher}, this parser does the
+same, and falls back if that setting was changed.
+"""
+
+import re
+from cStringIO import StringIO
+from xml.etree import cElementTree
+
+from planet import feedparser
+
+NS_ATOM = 'http://www.w3.org/2005/Atom'
+NS_XML = 'http://www.w3.org/XML/1998/namespace'
+
+_Mixin = feedparser._FeedParserMixin
+
+# Standard prefixes of the namespaces known to the Universal Feed Parser,
+# by lower case namespace URI.
+_PREFIXES = dict([(uri.lower(), prefix)
+                  for uri, prefix in _Mixin.namespaces.iteritems()])
+
+# Keys that feedparser.FeedParserDict stores under another key.
+_KEYMAP = {}
+for _key, _value in feedparser.FeedParserDict.keymap.iteritems():
+    if isinstance(_value, list):
+        _value = _value[0]
+    _KEYMAP[_key] = _value
+del _key, _value
+
+# Elements the Universal Feed Parser has handlers for.
+_HANDLED = set([name[len('_start_'):] for name in dir(_Mixin)
+                                      if name.startswith('_start_')] +
+               [name[len('_end_'):] for name in dir(_Mixin)
+                                    if name.startswith('_end_')])
+
+_RELATIVE_URIS = frozenset(_Mixin.can_be_relative_uri)
+_HTML_TYPES = _Mixin.html_types
+
+_IMAGE_ELEMENTS = frozenset(['title', 'link', 'description', 'url', 'href',
+                             'width', 'height'])
+
+_RE_EMAIL = re.compile(r'''(([a-zA-Z0-9\_\-\.\+]+)@((\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|(([a-zA-Z0-9\-]+\.)+))([a-zA-Z]{2,4}|[0-9]{1,3})(\]?))''')
+
+class Unsupported(Exception):
+    """
+    The document cannot be parsed by the fast parser.
+    """
+
+
+
+def _has(context, key):
+    """
+    Return whether a key is set, like C{FeedParserDict.has_key}.
+    """
+    realKey = feedparser.FeedParserDict.keymap.get(key, key)
+    if isinstance(realKey, list):
+        for otherKey in realKey:
+            if otherKey in context:
+                return True
+        return False
+    return key in context or realKey in context
+
+
+
+def _wrap(value):
+    """
+    Turn the dictionaries in a parse result into C{FeedParserDict}s.
+    """
+    if isinstance(value, dict):
+        return feedparser.FeedParserDict(dict([(key, _wrap(item))
+                                               for key, item
+                                               in value.iteritems()]))
+    elif isinstance(value, list):
+        return [_wrap(item) for item in value]
+    else:
+        return value
+
+
+
+_names = {}
+
+def _elementName(tag):
+    """
+    Return the name the Universal Feed Parser knows an element by.
+
+    @return: the lower case local name, prefixed with the standard prefix
+        of its namespace and an underscore, and whether it has a prefix.
+    @rtype: C{tuple}
+    """
+    try:
+        return _names[tag]
+    except KeyError:
+        pass
+
+    if tag[0] == '{':
+        namespace, localName = tag[1:].split('}', 1)
+        lowerNamespace = namespace.lower()
+        if lowerNamespace.find('backend.userland.com/rss') != -1:
+            lowerNamespace = 'http://backend.userland.com/rss'
+        try:
+            prefix = _PREFIXES[lowerNamespace]
+        except KeyError:
+            raise Unsupported("Element in unknown namespace %r" % namespace)
+    else:
+        prefix, localName = '', tag
+
+    if isinstance(localName, unicode):
+        raise Unsupported("Non-ASCII element name")
+
+    localName = localName.lower()
+    if prefix:
+        name = (prefix.lower() + '_' + localName, True)
+    else:
+        name = (localName, False)
+    _names[tag] = name
+    return name
+
+
+
+class _FastFeedParser(object):
+    """
+    Parser that mirrors the strict parser of the Universal Feed Parser.
+
+    The methods have the names of their counterparts in
+    C{feedparser._FeedParserMixin}, and store the values in plain
+    dictionaries, that L{parseFast} turns into C{FeedParserDict}s.
+    """
+
+    def __init__(self, baseuri, baselang):
+        self.feeddata = {}
+        self.entries = []
+        self.namespacesInUse = {}
+        self.version = ''
+        self.infeed = 0
+        self.inentry = 0
+        self.inimage = 0
+        self.inauthor = 0
+        self.incontributor = 0
+        self.incontent = 0
+        self.contentparams = {}
+        self.summaryKey = None
+        self.guidislink = 0
+        self.elementstack = []
+        self.basestack = []
+        self.langstack = []
+        self.baseuri = feedparser._urljoin(baseuri or '', baseuri or '')
+        self.lang = baselang or None
+        if baselang:
+            self.feeddata['language'] = baselang
+
+
+    def feed(self, data):
+        """
+        Parse a document, encoded in UTF-8.
+
+        Character data is passed to L{handle_data} in document order: the
+        text of an element before its first child starts, or when it ends
+        without children, and the tail of a child when its next sibling
+        starts, or when its parent ends. Elements are emptied once their
+        children have been handled.
+        """
+        elements = []
+        lastChildren = []
+
+        for event, item in cElementTree.iterparse(StringIO(data),
+                                                  ('start-ns', 'start',
+                                                   'end')):
+            if event == 'start':
+                if elements:
+                    lastChild = lastChildren[-1]
+                    if lastChild is None:
+                        text = elements[-1].text
+                    else:
+                        text = lastChild.tail
+                    if text:
+                        self.handle_data(text)
+                elif item.tag not in ('rss', '{%s}feed' % NS_ATOM):
+                    raise Unsupported("Unsupported root element %r" %
+                                      item.tag)
+
+                elements.append(item)
+                lastChildren.append(None)
+                self.unknown_starttag(item)
+            elif event == 'end':
+                lastChild = lastChildren.pop()
+                if lastChild is None:
+                    text = item.text
+                else:
+                    text = lastChild.tail
+                if text:
+                    self.handle_data(text)
+
+                self.unknown_endtag(item)
+                elements.pop()
+                del item[:]
+                if lastChildren:
+                    lastChildren[-1] = item
+            else:
+                self.trackNamespace(item[0] or None, item[1])
+
+
+    def attributes(self, element):
+        """
+        Return the attributes of an element, like the strict parser does.
+        """
+        attrsD = {}
+        for key, value in element.attrib.iteritems():
+            if key[0] == '{':
+                namespace, localName = key[1:].split('}', 1)
+                if namespace != NS_XML:
+                    raise Unsupported("Attribute in namespace %r" %
+                                      namespace)
+                key = 'xml:' + localName
+            if isinstance(key, unicode):
+                raise Unsupported("Non-ASCII attribute name")
+
+            key = key.lower()
+            if key in ('rel', 'type'):
+                value = value.lower()
+            attrsD[key] = unicode(value)
+        return attrsD
+
+
+    def trackNamespace(self, prefix, uri):
+        loweruri = uri.lower()
+        if ((prefix, loweruri) == (None,
+                                   'http://my.netscape.com/rdf/simple/0.9/')
+            and not self.version):
+            self.version = 'rss090'
+        if loweruri == 'http://purl.org/rss/1.0/' and not self.version:
+            self.version = 'rss10'
+        if loweruri == 'http://www.w3.org/2005/atom' and not self.version:
+            self.version = 'atom10'
+        if loweruri.find('backend.userland.com/rss') != -1:
+            uri = 'http://backend.userland.com/rss'
+            loweruri = uri
+        if loweruri in _PREFIXES:
+            self.namespacesInUse[_PREFIXES[loweruri]] = unicode(uri)
+        else:
+            self.namespacesInUse[prefix or ''] = unicode(uri)
+
+
+    def unknown_starttag(self, element):
+        name, prefixed = _elementName(element.tag)
+        attrsD = self.attributes(element)
+
+        # track xml:base and xml:lang
+        baseuri = attrsD.get('xml:base', attrsD.get('base'))
+        if baseuri:
+            self.baseuri = feedparser._urljoin(self.baseuri, baseuri)
+        lang = attrsD.get('xml:lang', attrsD.get('lang'))
+        if lang == '':
+            lang = None
+        elif lang is None:
+            lang = self.lang
+        if lang and name in ('feed', 'rss'):
+            self.feeddata['language'] = lang
+        self.lang = lang
+        self.basestack.append(self.baseuri)
+        self.langstack.append(lang)
+
+        if self.incontent:
+            raise Unsupported("Inline markup in %r" % name)
+
+        if not prefixed and name not in _IMAGE_ELEMENTS:
+            self.inimage = 0
+
+        try:
+            method = _STARTS[name]
+        except KeyError:
+            if name in _HANDLED:
+                raise Unsupported("Unsupported element %r" % name)
+            self.push(name, 1)
+        else:
+            method(self, attrsD)
+
+
+    def unknown_endtag(self, element):
+        name, _ = _elementName(element.tag)
+
+        try:
+            method = _ENDS[name]
+        except KeyError:
+            self.pop(name)
+        else:
+            method(self)
+
+        # track xml:base and xml:lang going out of scope
+        if self.basestack:
+            self.basestack.pop()
+            if self.basestack and self.basestack[-1]:
+                self.baseuri = self.basestack[-1]
+        if self.langstack:
+            self.langstack.pop()
+            if self.langstack:
+                self.lang = self.langstack[-1]
+
+
+    def handle_data(self, text):
+        if self.elementstack:
+            self.elementstack[-1][2].append(text)
+
+
+    def mapContentType(self, contentType):
+        contentType = contentType.lower()
+        if contentType == 'text':
+            contentType = 'text/plain'
+        elif contentType == 'html':
+            contentType = 'text/html'
+        elif contentType == 'xhtml':
+            contentType = 'application/xhtml+xml'
+        return contentType
+
+
+    def resolveURI(self, uri):
+        return feedparser._urljoin(self.baseuri or '', uri)
+
+
+    def push(self, element, expectingText):
+        self.elementstack.append([element, expectingText, []])
+
+
+    def pop(self, element):
+        if not self.elementstack:
+            return
+        if self.elementstack[-1][0] != element:
+            return
+
+        element, expectingText, pieces = self.elementstack.pop()
+        output = unicode(''.join(pieces)).strip()
+        if not expectingText:
+            return output
+
+        if element in _RELATIVE_URIS and output:
+            output = self.resolveURI(output)
+            if not isinstance(output, unicode):
+                output = unicode(output, 'utf-8')
+
+        # categories are handled in _end_category
+        if element == 'category':
+            return output
+
+        if self.inentry:
+            context = self.entries[-1]
+            if element == 'content':
+                detail = dict(self.contentparams)
+                detail['value'] = output
+                context.setdefault('content', []).append(detail)
+            elif element == 'link':
+                context['link'] = output
+                if output:
+                    context['links'][-1]['href'] = output
+            else:
+                if element == 'description':
+                    element = 'summary'
+                context[_KEYMAP.get(element, element)] = output
+                if self.incontent:
+                    detail = dict(self.contentparams)
+                    detail['value'] = output
+                    key = element + '_detail'
+                    context[_KEYMAP.get(key, key)] = detail
+        elif self.infeed and not self.inimage:
+            context = self.feeddata
+            if element == 'description':
+                element = 'subtitle'
+            context[_KEYMAP.get(element, element)] = output
+            if element == 'link':
+                context['links'][-1]['href'] = output
+            elif self.incontent:
+                detail = dict(self.contentparams)
+                detail['value'] = output
+                key = element + '_detail'
+                context[_KEYMAP.get(key, key)] = detail
+        return output
+
+
+    def pushContent(self, tag, attrsD, defaultContentType, expectingText):
+        self.incontent += 1
+        contentType = self.mapContentType(attrsD.get('type',
+                                                     defaultContentType))
+        if (attrsD.get('mode', '') == 'base64' or
+            not (contentType.startswith('text/') or
+                 contentType.endswith('+xml') or
+                 contentType.endswith('/xml'))):
+            raise Unsupported("Base64 encoded content")
+        if contentType == 'application/xhtml+xml':
+            raise Unsupported("XHTML content")
+
+        self.contentparams = {'type': contentType,
+                              'language': self.lang,
+                              'base': self.baseuri}
+        self.push(tag, expectingText)
+
+
+    def popContent(self, tag):
+        value = self.pop(tag)
+        self.incontent -= 1
+        self.contentparams = {}
+        return value
+
+
+    def _itsAnHrefDamnIt(self, attrsD):
+        href = attrsD.get('url', attrsD.get('uri', attrsD.get('href', None)))
+        if href:
+            attrsD.pop('url', None)
+            attrsD.pop('uri', None)
+            attrsD['href'] = href
+        return attrsD
+
+
+    def _getContext(self):
+        if self.inentry:
+            return self.entries[-1]
+        else:
+            return self.feeddata
+
+
+    def _save(self, key, value):
+        context = self._getContext()
+        if not _has(context, key):
+            context[_KEYMAP.get(key, key)] = value
+
+
+    def _cdf_common(self, attrsD):
+        if 'lastmod' in attrsD or 'href' in attrsD:
+            raise Unsupported("CDF attributes")
+
+
+    def _start_rss(self, attrsD):
+        if not attrsD.get('version', '').startswith('2.'):
+            raise Unsupported("RSS version %r" % attrsD.get('version'))
+        if not self.version:
+            self.version = 'rss20'
+
+
+    def _start_channel(self, attrsD):
+        self.infeed = 1
+        self._cdf_common(attrsD)
+
+
+    def _start_feed(self, attrsD):
+        self.infeed = 1
+        if not self.version:
+            self.version = {'0.1': 'atom01',
+                            '0.2': 'atom02',
+                            '0.3': 'atom03'}.get(attrsD.get('version'),
+                                                 'atom')
+
+
+    def _end_channel(self):
+        self.infeed = 0
+    _end_feed = _end_channel
+
+
+    def _start_image(self, attrsD):
+        self.inimage = 1
+        self.push('image', 0)
+        self._getContext().setdefault('image', {})
+
+
+    def _end_image(self):
+        self.pop('image')
+        self.inimage = 0
+
+
+    def _start_author(self, attrsD):
+        self.inauthor = 1
+        self.push('author', 1)
+    _start_managingeditor = _start_author
+    _start_dc_author = _start_author
+    _start_dc_creator = _start_author
+
+
+    def _end_author(self):
+        self.pop('author')
+        self.inauthor = 0
+        self._sync_author_detail()
+    _end_managingeditor = _end_author
+    _end_dc_author = _end_author
+    _end_dc_creator = _end_author
+
+
+    def _start_contributor(self, attrsD):
+        self.incontributor = 1
+        self._getContext().setdefault('contributors', []).append({})
+        self.push('contributor', 0)
+
+
+    def _end_contributor(self):
+        self.pop('contributor')
+        self.incontributor = 0
+
+
+    def _start_name(self, attrsD):
+        self.push('name', 0)
+
+
+    def _end_name(self):
+        value = self.pop('name')
+        if self.inauthor:
+            self._save_author('name', value)
+        elif self.incontributor:
+            self._save_contributor('name', value)
+
+
+    def _start_width(self, attrsD):
+        self.push('width', 0)
+
+
+    def _end_width(self):
+        self._saveDimension('width')
+
+
+    def _start_height(self, attrsD):
+        self.push('height', 0)
+
+
+    def _end_height(self):
+        self._saveDimension('height')
+
+
+    def _saveDimension(self, name):
+        value = self.pop(name)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = 0
+        if self.inimage:
+            self._getContext()['image'][name] = value
+
+
+    def _start_url(self, attrsD):
+        self.push('href', 1)
+    _start_homepage = _start_url
+    _start_uri = _start_url
+
+
+    def _end_url(self):
+        value = self.pop('href')
+        if self.inauthor:
+            self._save_author('href', value)
+        elif self.incontributor:
+            self._save_contributor('href', value)
+        elif self.inimage:
+            self._getContext()['image']['href'] = value
+    _end_homepage = _end_url
+    _end_uri = _end_url
+
+
+    def _start_email(self, attrsD):
+        self.push('email', 0)
+
+
+    def _end_email(self):
+        value = self.pop('email')
+        if self.inauthor:
+            self._save_author('email', value)
+        elif self.incontributor:
+            self._save_contributor('email', value)
+
+
+    def _save_author(self, key, value, prefix='author'):
+        context = self._getContext()
+        context.setdefault(prefix + '_detail', {})[key] = value
+        self._sync_author_detail()
+
+
+    def _save_contributor(self, key, value):
+        context = self._getContext()
+        context.setdefault('contributors', [{}])[-1][key] = value
+
+
+    def _sync_author_detail(self, key='author'):
+        context = self._getContext()
+        detail = context.get('%s_detail' % key)
+        if detail:
+            name = detail.get('name')
+            email = detail.get('email')
+            if name and email:
+                context[key] = '%s (%s)' % (name, email)
+            elif name:
+                context[key] = name
+            elif email:
+                context[key] = email
+        else:
+            author = context.get(key)
+            if not author:
+                return
+            emailmatch = _RE_EMAIL.search(author)
+            if not emailmatch:
+                return
+            email = emailmatch.group(0)
+            author = author.replace(email, '')
+            author = author.replace('()', '')
+            author = author.strip()
+            if author and (author[0] == '('):
+                author = author[1:]
+            if author and (author[-1] == ')'):
+                author = author[:-1]
+            author = author.strip()
+            detail = context.setdefault('%s_detail' % key, {})
+            detail['name'] = author
+            detail['email'] = email
+
+
+    def _start_subtitle(self, attrsD):
+        self.pushContent('subtitle', attrsD, 'text/plain', 1)
+
+
+    def _end_subtitle(self):
+        self.popContent('subtitle')
+
+
+    def _start_rights(self, attrsD):
+        self.pushContent('rights', attrsD, 'text/plain', 1)
+    _start_dc_rights = _start_rights
+    _start_copyright = _start_rights
+
+
+    def _end_rights(self):
+        self.popContent('rights')
+    _end_dc_rights = _end_rights
+    _end_copyright = _end_rights
+
+
+    def _start_item(self, attrsD):
+        self.entries.append({})
+        self.push('item', 0)
+        self.inentry = 1
+        self.guidislink = 0
+        self._cdf_common(attrsD)
+    _start_entry = _start_item
+
+
+    def _end_item(self):
+        self.pop('item')
+        self.inentry = 0
+    _end_entry = _end_item
+
+
+    def _start_dc_language(self, attrsD):
+        self.push('language', 1)
+    _start_language = _start_dc_language
+
+
+    def _end_dc_language(self):
+        self.lang = self.pop('language')
+    _end_language = _end_dc_language
+
+
+    def _start_dc_publisher(self, attrsD):
+        self.push('publisher', 1)
+    _start_webmaster = _start_dc_publisher
+
+
+    def _end_dc_publisher(self):
+        self.pop('publisher')
+        self._sync_author_detail('publisher')
+    _end_webmaster = _end_dc_publisher
+
+
+    def _start_published(self, attrsD):
+        self.push('published', 1)
+    _start_dcterms_issued = _start_published
+    _start_issued = _start_published
+
+
+    def _end_published(self):
+        value = self.pop('published')
+        self._save('published_parsed', feedparser._parse_date(value))
+    _end_dcterms_issued = _end_published
+    _end_issued = _end_published
+
+
+    def _start_updated(self, attrsD):
+        self.push('updated', 1)
+    _start_modified = _start_updated
+    _start_dcterms_modified = _start_updated
+    _start_pubdate = _start_updated
+    _start_dc_date = _start_updated
+
+
+    def _end_updated(self):
+        value = self.pop('updated')
+        self._save('updated_parsed', feedparser._parse_date(value))
+    _end_modified = _end_updated
+    _end_dcterms_modified = _end_updated
+    _end_pubdate = _end_updated
+    _end_dc_date = _end_updated
+
+
+    def _start_created(self, attrsD):
+        self.push('created', 1)
+    _start_dcterms_created = _start_created
+
+
+    def _end_created(self):
+        value = self.pop('created')
+        self._save('created_parsed', feedparser._parse_date(value))
+    _end_dcterms_created = _end_created
+
+
+    def _addTag(self, term, scheme, label):
+        tags = self._getContext().setdefault('tags', [])
+        if (not term) and (not scheme) and (not label):
+            return
+        value = {'term': term, 'scheme': scheme, 'label': label}
+        if value not in tags:
+            tags.append(value)
+
+
+    def _start_category(self, attrsD):
+        term = attrsD.get('term')
+        scheme = attrsD.get('scheme', attrsD.get('domain'))
+        label = attrsD.get('label')
+        self._addTag(term, scheme, label)
+        self.push('category', 1)
+    _start_dc_subject = _start_category
+
+
+    def _end_category(self):
+        value = self.pop('category')
+        if not value:
+            return
+        tags = self._getContext()['tags']
+        if value and len(tags) and not tags[-1]['term']:
+            tags[-1]['term'] = value
+        else:
+            self._addTag(value, None, None)
+    _end_dc_subject = _end_category
+
+
+    def _start_cloud(self, attrsD):
+        self._getContext()['cloud'] = dict(attrsD)
+
+
+    def _start_link(self, attrsD):
+        attrsD.setdefault('rel', 'alternate')
+        attrsD.setdefault('type', 'text/html')
+        attrsD = self._itsAnHrefDamnIt(attrsD)
+        if 'href' in attrsD:
+            attrsD['href'] = self.resolveURI(attrsD['href'])
+        expectingText = self.infeed or self.inentry
+        context = self._getContext()
+        context.setdefault('links', []).append(dict(attrsD))
+        if attrsD['rel'] == 'enclosure':
+            self._start_enclosure(attrsD)
+        if 'href' in attrsD:
+            if (attrsD.get('rel') == 'alternate' and
+                self.mapContentType(attrsD.get('type')) in _HTML_TYPES):
+                context['link'] = attrsD['href']
+        else:
+            self.push('link', expectingText)
+
+
+    def _end_link(self):
+        value = self.pop('link')
+        if self.inimage:
+            self._getContext()['image']['link'] = value
+
+
+    def _start_guid(self, attrsD):
+        self.guidislink = (attrsD.get('ispermalink', 'true') == 'true')
+        self.push('id', 1)
+
+
+    def _end_guid(self):
+        value = self.pop('id')
+        self._save('guidislink',
+                   self.guidislink and 'link' not in self._getContext())
+        if self.guidislink:
+            self._save('link', value)
+
+
+    def _start_title(self, attrsD):
+        self.pushContent('title', attrsD, 'text/plain',
+                         self.infeed or self.inentry)
+    _start_dc_title = _start_title
+
+
+    def _end_title(self):
+        value = self.popContent('title')
+        if self.inimage:
+            self._getContext()['image']['title'] = value
+    _end_dc_title = _end_title
+
+
+    def _start_description(self, attrsD):
+        if 'summary' in self._getContext():
+            self.summaryKey = 'content'
+            self._start_content(attrsD)
+        else:
+            self.pushContent('description', attrsD, 'text/html',
+                             self.infeed or self.inentry)
+
+
+    def _end_description(self):
+        if self.summaryKey == 'content':
+            self._end_content()
+        else:
+            value = self.popContent('description')
+            if self.inimage:
+                key = _KEYMAP.get('description', 'description')
+                self._getContext()['image'][key] = value
+        self.summaryKey = None
+
+
+    def _start_generator(self, attrsD):
+        if attrsD:
+            attrsD = self._itsAnHrefDamnIt(attrsD)
+            if 'href' in attrsD:
+                attrsD['href'] = self.resolveURI(attrsD['href'])
+        self._getContext()['generator_detail'] = dict(attrsD)
+        self.push('generator', 1)
+
+
+    def _end_generator(self):
+        value = self.pop('generator')
+        context = self._getContext()
+        if 'generator_detail' in context:
+            context['generator_detail']['name'] = value
+
+
+    def _start_summary(self, attrsD):
+        if 'summary' in self._getContext():
+            self.summaryKey = 'content'
+            self._start_content(attrsD)
+        else:
+            self.summaryKey = 'summary'
+            self.pushContent(self.summaryKey, attrsD, 'text/plain', 1)
+
+
+    def _end_summary(self):
+        if self.summaryKey == 'content':
+            self._end_content()
+        else:
+            self.popContent(self.summaryKey or 'summary')
+        self.summaryKey = None
+
+
+    def _start_enclosure(self, attrsD):
+        attrsD = self._itsAnHrefDamnIt(attrsD)
+        context = self._getContext()
+        context.setdefault('enclosures', []).append(dict(attrsD))
+        href = attrsD.get('href')
+        if href and not context.get('id'):
+            context['id'] = href
+
+
+    def _start_content(self, attrsD):
+        self.pushContent('content', attrsD, 'text/plain', 1)
+        src = attrsD.get('src')
+        if src:
+            self.contentparams['src'] = src
+        # The Universal Feed Parser pushes content twice, and only pops it
+        # once, leaving the outer frame on the stack.
+        self.push('content', 1)
+
+
+    def _start_content_encoded(self, attrsD):
+        self.pushContent('content', attrsD, 'text/html', 1)
+
+
+    def _end_content(self):
+        copyToDescription = (self.mapContentType(self.contentparams['type'])
+                             in ['text/plain'] + _HTML_TYPES)
+        value = self.popContent('content')
+        if copyToDescription:
+            self._save('description', value)
+    _end_content_encoded = _end_content
+
+
+
+_STARTS = {}
+_ENDS = {}
+for _name in dir(_FastFeedParser):
+    if _name.startswith('_start_'):
+        _STARTS[_name[len('_start_'):]] = getattr(_FastFeedParser, _name)
+    elif _name.startswith('_end_'):
+        _ENDS[_name[len('_end_'):]] = getattr(_FastFeedParser, _name)
+del _name
+
+
+
+def parseFast(resource):
+    """
+    Parse a retrieved feed with the fast parser.
+
+    @param resource: the retrieved feed, like
+        L{FeedResource<mimir.aggregator.fetcher.FeedResource>}.
+    @return: the same output as the Universal Feed Parser.
+    @rtype: L{feedparser.FeedParserDict}
+    @raise Unsupported: if the document cannot be parsed on the fast path.
+    """
+    if feedparser.SANITIZE_HTML or feedparser.RESOLVE_RELATIVE_URIS:
+        raise Unsupported("Embedded HTML is not left alone")
+
+    result = feedparser.FeedParserDict()
+    result['bozo'] = 0
+
+    data = resource.read()
+    info = resource.info()
+    result['etag'] = info.getheader('ETag')
+    lastModified = info.getheader('Last-Modified')
+    if lastModified:
+        result['modified'] = feedparser._parse_date(lastModified)
+    result['href'] = resource.url
+    result['status'] = resource.status
+    headers = result['headers'] = resource.headers.dict
+
+    if headers.get('content-encoding', '') in ('gzip', 'deflate'):
+        raise Unsupported("Compressed body")
+    if result['status'] == 304 or not data:
+        raise Unsupported("No document")
+
+    (result['encoding'], _, _, _,
+     acceptableContentType) = feedparser._getCharacterEncoding(headers, data)
+    if headers and not acceptableContentType:
+        raise Unsupported("Not an XML media type")
+    if not result['encoding']:
+        raise Unsupported("No character encoding")
+    if '<!DOCTYPE' in data or '<!ENTITY' in data:
+        raise Unsupported("Document type declaration")
+
+    try:
+        data = feedparser._toUTF8(data, result['encoding'])
+    except Exception:
+        raise Unsupported("Cannot decode as %s" % result['encoding'])
+
+    parser = _FastFeedParser(headers.get('content-location', resource.url),
+                             headers.get('content-language'))
+    try:
+        parser.feed(data)
+    except SyntaxError, e:
+        raise Unsupported("Not well-formed: %s" % e)
+
+    result['feed'] = _wrap(parser.feeddata)
+    result['entries'] = _wrap(parser.entries)
+    result['version'] = parser.version
+    result['namespaces'] = parser.namespacesInUse
+    return result
+
+
+
+def parse(resource):
+    """
+    Parse a retrieved feed, falling back to the Universal Feed Parser.
+
+    This takes the same resource as C{feedparser.parse} and gives the same
+    output.
+    """
+    try:
+        return parseFast(resource)
+    except Unsupported:
+        return feedparser.parse(resource)
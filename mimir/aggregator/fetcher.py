@@ -5,22 +5,311 @@
 Feed retrieval and parsing.
 
 This module implements asynchronous download of RSS and Atom feeds via
-HTTP, that are subsequently parsed using the Universal Feed Parser.
+HTTP, that are subsequently parsed using the Universal Feed Parser, or
+optionally the fast parser in L{mimir.aggregator.fastparser}.
 """
 
+import calendar
 import copy
+import hashlib
+import heapq
+import re
+import simplejson
+import time
+import urlparse
+import zlib
 from planet import feedparser, scrub
 
-from twisted.internet import defer, reactor
-from twisted.web import client
+from twisted.internet import defer, protocol, reactor
+from twisted.python import failure, log
+from twisted.python.filepath import FilePath
+from twisted.web import client, error, http
+from twisted.web import http_headers
+
+from mimir import profiling
+from mimir.aggregator import fastparser
 
 feeds = ['http://test.ralphm.net/blog/atom']
 
 feedparser.SANITIZE_HTML = 0
 feedparser.RESOLVE_RELATIVE_URIS = 0
 
+# Seconds per value of the syndication module's updatePeriod
+UPDATE_PERIODS = {'hourly': 3600,
+                  'daily': 86400,
+                  'weekly': 604800,
+                  'monthly': 2592000,
+                  'yearly': 31536000}
+
+# Scheduling hints taken from the response headers, see getHeaderHints
+HEADER_HINTS = ('maxAge', 'retryAfter')
+
+# Default limits for concurrent retrievals, in total and per host
+MAX_FETCHES = 20
+MAX_HOST_FETCHES = 2
+
+# Default limits for a single retrieval: the maximum size of the (decoded)
+# body in bytes, and the number of seconds to wait for a connection and
+# for the whole retrieval.
+MAX_BODY_SIZE = 10 * 1024 * 1024
+CONNECT_TIMEOUT = 30
+FETCH_TIMEOUT = 120
+
+# Content codings that are decoded while receiving the body
+DECODABLE_ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+# Default maximum number of URLs to keep validators for, and the interval
+# in seconds between writing them to disk.
+VALIDATOR_CACHE_SIZE = 100000
+VALIDATOR_SAVE_INTERVAL = 300
+
+RE_SKIPHOURS = re.compile(r'<skipHours>(.*?)</skipHours>', re.DOTALL)
+RE_HOUR = re.compile(r'<hour>\s*(\d+)\s*</hour>')
+
 class NotModified(Exception):
-    pass
+    """
+    The feed was not modified since it was last retrieved.
+
+    @ivar hints: scheduling hints from the response, see L{getHeaderHints}.
+    @type hints: C{dict}
+    """
+
+    def __init__(self, hints=None):
+        Exception.__init__(self)
+        self.hints = hints or {}
+
+class Unchanged(NotModified):
+    """
+    The feed was retrieved, but its body is identical to the last one.
+
+    This happens for servers that do not support conditional GETs. The body
+    is not parsed in this case.
+    """
+
+class Throttled(error.Error):
+    """
+    The server refused to serve the feed for now, asking to retry later.
+
+    @ivar hints: scheduling hints from the response, see L{getHeaderHints}.
+    @type hints: C{dict}
+    """
+
+    def __init__(self, code, message=None, response=None, hints=None):
+        error.Error.__init__(self, code, message, response)
+        self.hints = hints or {}
+
+class FetchAborted(Exception):
+    """
+    The retrieval of a feed was aborted before it completed.
+    """
+
+class BodyTooLarge(FetchAborted):
+    """
+    The response body exceeded the maximum size.
+    """
+
+class FetchTimeout(FetchAborted):
+    """
+    The retrieval took longer than allowed.
+    """
+
+class ContentDecodingError(FetchAborted):
+    """
+    The response body could not be decoded according to its content coding.
+    """
+
+def bodyDigest(data):
+    """
+    Calculate the digest of a (decoded) response body.
+
+    @rtype: C{str}
+    """
+    return hashlib.sha1(data).hexdigest()
+
+def canonicalURL(url):
+    """
+    Reduce a URL to a key that is the same for URLs of the same resource.
+
+    The scheme, default ports, a trailing slash in the path and the fragment
+    are left out, and the host name is lower cased.
+
+    @rtype: C{str}
+    """
+    parts = urlparse.urlsplit(url)
+
+    netloc = (parts.hostname or '').lower()
+    if parts.username:
+        netloc = parts.username + '@' + netloc
+    if parts.port and parts.port not in (80, 443):
+        netloc += ':%d' % parts.port
+
+    path = parts.path.rstrip('/')
+    if parts.query:
+        path += '?' + parts.query
+
+    return '//' + netloc + path
+
+def _parseDelay(value, now):
+    """
+    Parse a header value that is either a number of seconds or a date.
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    try:
+        return max(0, int(http.stringToDatetime(value) - now))
+    except (ValueError, IndexError, KeyError):
+        return None
+
+def getHeaderHints(headers, now=None):
+    """
+    Extract scheduling hints from HTTP response headers.
+
+    This looks at C{max-age} in C{Cache-Control}, at C{Expires} and at
+    C{Retry-After}.
+
+    @param headers: response headers, mapping lower case header names to
+                    lists of values.
+    @type headers: C{dict}
+    @return: hints, with C{'maxAge'} and C{'retryAfter'} in seconds, if
+             present.
+    @rtype: C{dict}
+    """
+    if now is None:
+        now = time.time()
+
+    hints = {}
+
+    if 'date' in headers:
+        try:
+            now = http.stringToDatetime(headers['date'][-1])
+        except (ValueError, IndexError, KeyError):
+            pass
+
+    noCache = False
+    for value in headers.get('cache-control', []):
+        for directive in value.split(','):
+            directive = directive.strip().lower()
+            if directive in ('no-cache', 'no-store'):
+                noCache = True
+            elif directive.startswith('max-age='):
+                try:
+                    hints['maxAge'] = int(directive[8:].strip('"'))
+                except ValueError:
+                    pass
+
+    if 'maxAge' not in hints and 'expires' in headers:
+        maxAge = _parseDelay(headers['expires'][-1], now)
+        if maxAge is not None:
+            hints['maxAge'] = maxAge
+
+    if noCache:
+        hints.pop('maxAge', None)
+
+    if 'retry-after' in headers:
+        retryAfter = _parseDelay(headers['retry-after'][-1], now)
+        if retryAfter is not None:
+            hints['retryAfter'] = retryAfter
+
+    return hints
+
+def getValidators(result):
+    """
+    Extract validators for conditional GETs from a retrieved feed.
+
+    These are the validators that L{FeedClient} keeps in its cache, taken
+    from a feed as stored by the aggregator, to seed the cache for URLs it
+    has no entry for.
+
+    @param result: output from the Universal Feed Parser, or its JSON
+                   serialization read back.
+    @return: validators, with C{'etag'} and C{'last-modified'}, if present.
+    @rtype: C{dict}
+    """
+    validators = {}
+
+    etag = result.get('etag')
+    if etag:
+        validators['etag'] = str(etag)
+
+    modified = result.get('modified')
+    if modified:
+        validators['last-modified'] = http.datetimeToString(
+                calendar.timegm(tuple(modified)))
+
+    return validators
+
+def getFeedHints(result, data):
+    """
+    Extract scheduling hints from the feed itself.
+
+    This looks at RSS' C{ttl} and C{skipHours} and the syndication module's
+    C{updatePeriod} and C{updateFrequency}.
+
+    @param result: output from the Universal Feed Parser.
+    @param data: the (decoded) feed document.
+    @type data: C{str}
+    @return: hints, with C{'ttl'} and C{'updatePeriod'} in seconds and
+             C{'skipHours'} as a list of hours (in GMT), if present.
+    @rtype: C{dict}
+    """
+    hints = {}
+    feed = result.get('feed', {})
+
+    try:
+        hints['ttl'] = int(feed['ttl']) * 60
+    except (KeyError, ValueError, TypeError):
+        pass
+
+    period = feed.get('sy_updateperiod', '').strip().lower()
+    if period in UPDATE_PERIODS:
+        try:
+            frequency = int(feed.get('sy_updatefrequency', 1)) or 1
+        except ValueError:
+            frequency = 1
+        hints['updatePeriod'] = UPDATE_PERIODS[period] // frequency
+
+    # The Universal Feed Parser does not keep skipHours
+    if 'skiphours' in feed:
+        match = RE_SKIPHOURS.search(data)
+        if match:
+            hours = [int(hour) for hour in RE_HOUR.findall(match.group(1))]
+            hours = sorted(set([hour for hour in hours if 0 <= hour < 24]))
+            if hours:
+                hints['skipHours'] = hours
+
+    return hints
+
+def decodeBody(data, headers):
+    """
+    Undo the content encoding of a response body.
+
+    If the body was compressed, and could be decompressed, the
+    C{Content-Encoding} header is removed from C{headers}.
+
+    @param headers: response headers, mapping lower case header names to
+                    lists of values.
+    @type headers: C{dict}
+    @return: decoded body.
+    @rtype: C{str}
+    """
+    encoding = headers.get('content-encoding', [''])[-1].strip().lower()
+    try:
+        if encoding in ('gzip', 'x-gzip'):
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                data = zlib.decompress(data)
+            except zlib.error:
+                data = zlib.decompress(data, -zlib.MAX_WBITS)
+        else:
+            return data
+    except zlib.error:
+        return data
+
+    del headers['content-encoding']
+    return data
 
 class Headers(object):
     """
@@ -56,118 +345,723 @@ class FeedResource(object):
     def read(self):
         return self.data
 
-class HTTPFeedGetter(client.HTTPPageGetter):
-    """ HTTP page getter for feeds. """
+def parseDocument(data, url, status, headers, fast=False):
+    """
+    Parse a retrieved feed using the Universal Feed Parser, and scrub it.
+
+    This is the synchronous work behind L{parseFeed}, also used by the
+    worker processes of L{mimir.aggregator.parsepool}.
+
+    @param data: the response body.
+    @type data: C{str}
+    @param url: the URL the feed was retrieved from.
+    @type url: C{str}
+    @param status: the HTTP status of the response.
+    @type status: C{str}
+    @param headers: response headers, mapping lower case header names to
+                    lists of values.
+    @type headers: C{dict}
+    @param fast: if set, parse well-formed Atom 1.0 and RSS 2.0 feeds with
+                 L{fastparser.parse}, which falls back to the Universal Feed
+                 Parser for other documents.
+    @type fast: C{bool}
+    @return: output of the Universal Feed Parser.
+    @rtype: L{feedparser.FeedParserDict}
+    """
+    hints = getHeaderHints(headers)
+
+    headers = dict(headers)
+    data = decodeBody(data, headers)
+    resource = FeedResource(data, url, status, headers)
+
+    if fast:
+        parse = fastparser.parse
+    else:
+        parse = feedparser.parse
+
+    result = profiling.call('parse', url, parse, resource)
+    profiling.call('scrub', url, scrub.scrub, url, result)
+
+    hints.update(getFeedHints(result, data))
+    result['hints'] = hints
+    return result
+
+def parseFeed(data, url, status, headers, fast=False):
+    """
+    Parse a retrieved feed in-process.
+
+    Takes the same arguments as L{parseDocument}.
+
+    @rtype: L{defer.Deferred}
+    """
+    return defer.maybeDeferred(parseDocument, data, url, status, headers,
+                               fast)
+
+class ValidatorCache(object):
+    """
+    Bounded cache of validators for conditional GETs, by URL.
+
+    When the cache grows beyond its maximum size, the least recently used
+    entries are evicted. To keep this cheap, a batch of entries is evicted
+    at once, bringing the size back to 90% of the maximum.
+
+    If a path is given, the cache is read from it on creation, and written
+    to it when L{save} is called, or when validators are set and the cache
+    was last saved more than L{saveInterval} seconds ago.
+
+    @ivar path: file to persist the cache to, or C{None}.
+    @type path: L{FilePath}
+    @ivar maxSize: maximum number of URLs to keep validators for.
+    @type maxSize: C{int}
+    @ivar saveInterval: minimum number of seconds between automatic saves.
+    @type saveInterval: C{int}
+    """
+
+    def __init__(self, path=None, maxSize=VALIDATOR_CACHE_SIZE,
+                       saveInterval=VALIDATOR_SAVE_INTERVAL):
+        self.maxSize = maxSize
+        self.saveInterval = saveInterval
+        self._entries = {}
+        self._counter = 0
+        self._changed = False
+        self._lastSaved = time.time()
+
+        if path is None:
+            self.path = None
+        else:
+            self.path = FilePath(path)
+            if self.path.exists():
+                self.load()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, url):
+        return url in self._entries
+
+
+    def __getitem__(self, url):
+        entry = self._entries[url]
+        self._counter += 1
+        entry[0] = self._counter
+        return entry[1]
 
-    def handleResponse(self, response):
-        # Store the response in cache
-        re = self.headers.get("etag", None)
-        rl = self.headers.get("last-modified", None)
-        rd = self.headers.get("date", None)
-        if re or rl or rd:
-            cache = {}
-            if re:
-                cache['etag'] = re[-1]
-            if rl and rd:
-                cache['last-modified'] = rl[-1]
-            elif rd and not rl:
-                cache['last-modified'] = rd[-1]
 
-            self.factory.cache[self.factory.original_url] = cache
+    def get(self, url, default=None):
+        try:
+            return self[url]
+        except KeyError:
+            return default
 
-        # Act like a normal HTTPPageGetter
-        client.HTTPPageGetter.handleResponse(self, response)
 
-    def handleStatus_301(self):
-        """ Handle status 301: Moved Permanently. """
-        client.HTTPPageGetter.handleStatus_301(self)
-        self.factory.original_url = self.factory.url
-        self.factory.real_status = self.status
+    def __setitem__(self, url, validators):
+        self._counter += 1
+        self._entries[url] = [self._counter, validators]
+        self._changed = True
 
-    def handleStatus_302(self):
-        client.HTTPPageGetter.handleStatus_301(self)
-        self.factory.real_status = self.status
+        if len(self._entries) > self.maxSize:
+            self._evict()
 
-    def handleStatus_303(self):
-        self.factory.method = 'GET'
-        client.HTTPPageGetter.handleStatus_301(self)
-        self.factory.real_status = self.status
+        if (self.path is not None and
+            time.time() - self._lastSaved > self.saveInterval):
+            try:
+                self.save()
+            except:
+                log.err(None, "Could not save validator cache")
 
-    def handleStatus_304(self):
-        """ Handle status 304: Not Modified. """
-        self.factory.noPage(NotModified())
 
-    handleStatus_307 = handleStatus_302
+    def _evict(self):
+        """
+        Evict the least recently used entries.
+        """
+        count = len(self._entries) - int(self.maxSize * 0.9)
+        for _, url in heapq.nsmallest(count,
+                                      [(entry[0], url) for url, entry
+                                                       in self._entries.iteritems()]):
+            del self._entries[url]
 
 
-class HTTPClientFeedFactory(client.HTTPClientFactory):
+    def load(self):
+        """
+        Read the cache from disk.
+        """
+        fh = self.path.open()
+        try:
+            try:
+                entries = simplejson.load(fh)
+            except ValueError:
+                log.msg("Ignoring corrupt validator cache %s" %
+                        self.path.path)
+                return
+        finally:
+            fh.close()
+
+        # Entries are stored from least to most recently used
+        self._entries = {}
+        self._counter = 0
+        for url, validators in entries[-self.maxSize:]:
+            self._counter += 1
+            self._entries[str(url)] = [self._counter,
+                                       dict([(str(k), str(v))
+                                             for k, v in validators.iteritems()])]
+
+        self._changed = False
+
+
+    def save(self):
+        """
+        Write the cache to disk, if it changed since it was last written.
+        """
+        self._lastSaved = time.time()
+
+        if self.path is None or not self._changed:
+            return
+
+        entries = [(entry[0], url, entry[1])
+                   for url, entry in self._entries.iteritems()]
+        entries.sort()
+        data = simplejson.dumps([(url, validators)
+                                 for _, url, validators in entries])
+
+        self.path.setContent(data)
+        self._changed = False
+
+class BodyReceiver(protocol.Protocol):
+    """
+    Protocol that collects a response body, while decoding it.
+
+    Bodies compressed with gzip or deflate are decompressed as they come
+    in. If the (decoded) body grows beyond the maximum size, or if
+    L{abort} is called, the connection is dropped and C{finished} fails.
+
+    @ivar finished: fires with the body when it has been received
+                    completely.
+    @type finished: L{defer.Deferred}
+    @ivar maxSize: maximum size of the (decoded) body, or C{None}.
+    @type maxSize: C{int}
+    @ivar decoder: decompressor for the content coding, if any.
+    """
+
+    def __init__(self, finished, maxSize=None, encoding=None):
+        self.finished = finished
+        self.maxSize = maxSize
+        self.data = []
+        self.size = 0
+        self.done = False
+
+        if encoding in ('gzip', 'x-gzip'):
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            # Set up on the first data, see _deflateDecoder
+            self.decoder = True
+        else:
+            self.decoder = None
+
+
+    def _deflateDecoder(self, data):
+        """
+        Pick a decoder for deflate, which is often sent without zlib header.
+        """
+        if (len(data) >= 2 and ord(data[0]) & 0x0f == 8 and
+            (ord(data[0]) << 8 | ord(data[1])) % 31 == 0):
+            return zlib.decompressobj()
+        else:
+            return zlib.decompressobj(-zlib.MAX_WBITS)
+
+
+    def dataReceived(self, data):
+        if self.done:
+            return
+
+        if self.decoder is True:
+            self.decoder = self._deflateDecoder(data)
+
+        if self.decoder is not None:
+            if self.maxSize is None:
+                maxLength = 0
+            else:
+                maxLength = self.maxSize - self.size + 1
+
+            try:
+                data = self.decoder.decompress(data, maxLength)
+            except zlib.error, e:
+                self.abort(ContentDecodingError(str(e)))
+                return
+
+        self.size += len(data)
+        if self.maxSize is not None and self.size > self.maxSize:
+            self.abort(BodyTooLarge(self.maxSize))
+            return
+
+        self.data.append(data)
+
+
+    def abort(self, reason):
+        """
+        Stop receiving the body and fail with C{reason}.
+        """
+        if self.done:
+            return
+
+        self.done = True
+        self.data = []
+        self.transport.stopProducing()
+        self.finished.errback(reason)
+
+
+    def connectionLost(self, reason):
+        if self.done:
+            return
+
+        self.done = True
+        if reason.check(client.ResponseDone, http.PotentialDataLoss):
+            if self.decoder is not None and self.decoder is not True:
+                self.data.append(self.decoder.flush())
+            self.finished.callback(''.join(self.data))
+        else:
+            self.finished.errback(reason)
+
+class FeedClient(object):
     """
-    Factory for retrieving feeds via HTTP and parsing it using the
+    Client for retrieving feeds via HTTP/1.1 and parsing them using the
     Universal Feed Parser.
 
-    The factory keeps a cache, uses HTTP condition GETs (last-modified
-    and etag) and asks for compression to minimize bandwith usage.
+    Connections are kept alive and reused for later requests to the same
+    scheme, host and port. The client keeps a cache, uses HTTP conditional
+    GETs (last-modified and etag) and asks for compression to minimize
+    bandwith usage.
+
+    @ivar pool: pool of persistent connections.
+    @type pool: L{client.HTTPConnectionPool}
+    @ivar cache: validators for conditional GETs, by URL.
+    @type cache: L{ValidatorCache}
+    @ivar parser: function to parse retrieved feeds, taking the same
+                  arguments as L{parseFeed} and returning a deferred.
+    @ivar maxBodySize: maximum size of a (decoded) response body.
+    @type maxBodySize: C{int}
+    @ivar timeout: maximum number of seconds for a retrieval, including
+                   redirects and parsing, or C{None}.
+    @type timeout: C{int}
+    @ivar metrics: metrics to record the size of response bodies and the
+                   time it takes to parse them in, or C{None}.
+    @type metrics: L{mimir.aggregator.metrics.Metrics}
     """
 
-    protocol = HTTPFeedGetter
-    cache = {}
+    parser = staticmethod(parseFeed)
+    metrics = None
+
+    redirectLimit = 20
+
+    def __init__(self, reactor=reactor, maxPersistentPerHost=MAX_HOST_FETCHES,
+                       contextFactory=None, cache=None,
+                       maxBodySize=MAX_BODY_SIZE,
+                       connectTimeout=CONNECT_TIMEOUT,
+                       timeout=FETCH_TIMEOUT):
+        self.reactor = reactor
+        self.maxBodySize = maxBodySize
+        self.timeout = timeout
+        self.pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = maxPersistentPerHost
+        if contextFactory is None:
+            contextFactory = client.WebClientContextFactory()
+        self.agent = client.Agent(reactor, contextFactory,
+                                  connectTimeout=connectTimeout,
+                                  pool=self.pool)
+        if cache is None:
+            cache = ValidatorCache()
+        self.cache = cache
+
+
+    def getFeed(self, url, agent="Twisted PageGetter", headers=None,
+                      useCache=1, digest=None, validators=None):
+        """
+        Download a feed and parse it.
 
-    def __init__(self, url, method='GET', postdata=None, headers=None,
-                 agent="Twisted PageGetter", timeout=0, cookies=None,
-                 followRedirect=1, useCache=1):
+        Redirects are followed. If the feed moved permanently, the status
+        of the result is C{'301'} and its C{href} is the new location.
 
-        self.original_url = copy.copy(url)
-        self.real_status = None
+        The digest of the body, see L{bodyDigest}, is put in the result
+        under the C{'digest'} key. If it matches the passed C{digest}, the
+        body is not parsed, and the retrieval fails with L{Unchanged}
+        instead.
 
-        headers = headers or {}
+        @param url: the URL of the feed.
+        @type url: C{str}
+        @param agent: value for the C{User-Agent} header.
+        @type agent: C{str}
+        @param headers: extra request headers. Validators in the cache
+                        override any conditional headers passed here.
+        @type headers: C{dict}
+        @param useCache: whether to use the validators from the cache to
+                         do a conditional GET.
+        @type useCache: C{bool}
+        @param digest: digest of the body of the previous retrieval.
+        @type digest: C{str}
+        @param validators: validators of the previous retrieval, see
+                           L{getValidators}, used if the cache has none for
+                           this URL.
+        @type validators: C{dict}
+        @return: deferred that fires with the output of the Universal Feed
+                 Parser, or fails with L{NotModified}, L{Throttled},
+                 L{FetchAborted} or L{error.Error}.
+        @rtype: L{defer.Deferred}
+        """
+        headers = dict(headers or {})
+
+        if useCache and validators and url not in self.cache:
+            self.cache[url] = validators
 
         cached = useCache and self.cache.get(url, None)
         if cached:
             etag = cached.get('etag', None)
             last_modified = cached.get('last-modified', None)
             if etag:
-                headers.setdefault('If-None-Match', etag)
+                headers['If-None-Match'] = etag
             if last_modified:
-                headers.setdefault('If-Modified-Since', last_modified)
+                headers['If-Modified-Since'] = last_modified
 
         headers.setdefault('Accept-Encoding', 'gzip, deflate')
         headers.setdefault('Accept', feedparser.ACCEPT_HEADER)
+        headers.setdefault('User-Agent', agent)
+
+        requestHeaders = http_headers.Headers()
+        for name, value in headers.iteritems():
+            requestHeaders.setRawHeaders(name, [value])
+
+        state = {'url': url,
+                 'original_url': url,
+                 'real_status': None,
+                 'redirects': 0,
+                 'receiver': None,
+                 'digest': digest}
+        d = self._request(state, requestHeaders)
+
+        if self.timeout:
+            d = self._deadline(d, state)
+
+        return d
+
+
+    def _deadline(self, d, state):
+        """
+        Fail with L{FetchTimeout} if the retrieval takes too long.
+        """
+        result = defer.Deferred()
+
+        def expire():
+            result.errback(FetchTimeout(self.timeout))
+
+            receiver = state['receiver']
+            if receiver is not None:
+                receiver.abort(FetchTimeout(self.timeout))
+            else:
+                d.cancel()
+
+        def done(outcome):
+            if call.active():
+                call.cancel()
+
+            if not result.called:
+                if isinstance(outcome, failure.Failure):
+                    result.errback(outcome)
+                else:
+                    result.callback(outcome)
+
+        call = self.reactor.callLater(self.timeout, expire)
+        d.addBoth(done)
+        return result
+
+
+    def close(self):
+        """
+        Save the validator cache and close all persistent connections.
+
+        @rtype: L{defer.Deferred}
+        """
+        try:
+            self.cache.save()
+        except:
+            log.err(None, "Could not save validator cache")
+
+        return self.pool.closeCachedConnections()
+
+
+    def _request(self, state, requestHeaders):
+        d = self.agent.request('GET', state['url'], requestHeaders)
+        d.addCallback(self._gotResponse, state, requestHeaders)
+        return d
+
+
+    def _gotResponse(self, response, state, requestHeaders):
+        status = str(response.code)
+        headers = dict([(name.lower(), values) for name, values
+                                          in response.headers.getAllRawHeaders()])
+
+        if response.code in (301, 302, 303, 307) and 'location' in headers:
+            return self._redirect(response, state, requestHeaders, headers)
+
+        if response.code == 304 or 200 <= response.code < 300:
+            self._updateCache(state['original_url'], headers)
+
+        if response.code == 304:
+            self._discardBody(response)
+            raise NotModified(getHeaderHints(headers))
+
+        encoding = headers.get('content-encoding', [''])[-1].strip().lower()
+        if encoding in DECODABLE_ENCODINGS:
+            del headers['content-encoding']
+        else:
+            encoding = None
 
-        client.HTTPClientFactory.__init__(self, url=url, method=method,
-                postdata=postdata, headers=headers, agent=agent,
-                timeout=timeout, cookies=cookies, followRedirect=followRedirect)
+        finished = defer.Deferred()
+        receiver = BodyReceiver(finished, self.maxBodySize, encoding)
+        state['receiver'] = receiver
+        response.deliverBody(receiver)
 
-    def page(self, page):
-        if self.waiting:
-            self.waiting = 0
-            resource = FeedResource(page, self.url,
-                                    self.real_status or self.status,
-                                    self.response_headers)
+        if self.metrics is not None:
+            finished.addCallback(self._countBody)
 
-            def doScrub(data):
-                scrub.scrub(self.url, data)
-                return data
+        if response.code in (429, 503):
+            finished.addCallback(lambda body: defer.fail(
+                Throttled(status, response.phrase, body,
+                          getHeaderHints(headers))))
+        elif not 200 <= response.code < 300:
+            finished.addCallback(lambda body: defer.fail(
+                error.Error(status, response.phrase, body)))
+        else:
+            finished.addCallback(self._parse, state, status, headers)
 
-            d = defer.maybeDeferred(feedparser.parse, resource)
-            d.addCallback(doScrub)
-            d.chainDeferred(self.deferred)
+        return finished
 
-def getFeed(url, contextFactory=None, *args, **kwargs):
+
+    def _parse(self, body, state, status, headers):
+        """
+        Parse the body, unless it is the same as last time.
+
+        Feeds that moved permanently are always parsed, so that the new
+        location is passed on.
+        """
+        status = state['real_status'] or status
+        digest = bodyDigest(body)
+        if digest == state['digest'] and status != '301':
+            raise Unchanged(getHeaderHints(headers))
+
+        def setDigest(result):
+            result['digest'] = digest
+            if self.metrics is not None:
+                self.metrics.observe('parseTime',
+                                     self.reactor.seconds() - start)
+            return result
+
+        start = self.reactor.seconds()
+        d = self.parser(body, state['url'], status, headers)
+        d.addCallback(setDigest)
+        return d
+
+
+    def _countBody(self, body):
+        self.metrics.increment('bytes', amount=len(body))
+        return body
+
+
+    def _redirect(self, response, state, requestHeaders, headers):
+        """
+        Follow a redirect, keeping track of permanent moves.
+        """
+        self._discardBody(response)
+
+        location = urlparse.urljoin(state['url'], headers['location'][-1])
+
+        state['redirects'] += 1
+        if state['redirects'] > self.redirectLimit:
+            raise error.InfiniteRedirection(str(response.code),
+                                            'Infinite redirection detected',
+                                            location=location)
+
+        state['url'] = location
+        state['real_status'] = str(response.code)
+        if response.code == 301:
+            state['original_url'] = location
+
+        return self._request(state, requestHeaders)
+
+
+    def _discardBody(self, response):
+        """
+        Read and discard the body, so the connection can be reused.
+        """
+        finished = defer.Deferred()
+        finished.addErrback(lambda _: None)
+        response.deliverBody(BodyReceiver(finished, self.maxBodySize))
+
+
+    def _updateCache(self, url, headers):
+        """
+        Store validators from the response headers in the cache.
+        """
+        re = headers.get("etag", None)
+        rl = headers.get("last-modified", None)
+        rd = headers.get("date", None)
+        if re or rl or rd:
+            cache = {}
+            if re:
+                cache['etag'] = re[-1]
+            if rl and rd:
+                cache['last-modified'] = rl[-1]
+            elif rd and not rl:
+                cache['last-modified'] = rd[-1]
+
+            self.cache[url] = cache
+
+_defaultClient = None
+
+def getFeed(url, *args, **kwargs):
     """
-    Download a web feed, keep a cache of already downloaded pages.
+    Download a feed using a shared L{FeedClient}.
 
     Download a feed. Return a deferred, which will callback with a feed (parsed
     with the Universal Feed Parser) or errback with a description of the error.
 
-    See HTTPClientCacheFactory to see what extra args can be passed.
+    See L{FeedClient.getFeed} to see what extra args can be passed.
     """
-    scheme, host, port, path = client._parse(url)
-    factory = HTTPClientFeedFactory(url, *args, **kwargs)
-    if scheme == 'https':
-        from twisted.internet import ssl
-        if contextFactory is None:
-            contextFactory = ssl.ClientContextFactory()
-        reactor.connectSSL(host, port, factory, contextFactory)
-    else:
-        reactor.connectTCP(host, port, factory)
-    return factory.deferred
+    global _defaultClient
+    if _defaultClient is None:
+        _defaultClient = FeedClient()
+    return _defaultClient.getFeed(url, *args, **kwargs)
+
+class FetchDispatcher(object):
+    """
+    Dispatcher of feed retrievals that limits the number of concurrent ones.
+
+    Retrievals beyond the global limit, or beyond the limit for the host
+    of the feed URL, are queued until earlier ones have finished. Queued
+    retrievals for one host do not hold up those for other hosts.
+
+    Retrievals of the same resource, see L{canonicalURL}, are coalesced:
+    while one is queued or in progress, later ones share its outcome. Each
+    gets its own copy of the result. Only retrievals with the same value
+    for C{useCache} and C{digest} are coalesced, so that L{NotModified}
+    and L{Unchanged} apply to all of them. When a retrieval ends up at
+    another resource through a redirect, that resource is recorded as an
+    alias, so that retrievals of either are coalesced from then on.
+
+    @ivar maxFetches: maximum number of concurrent retrievals.
+    @type maxFetches: C{int}
+    @ivar maxHostFetches: maximum number of concurrent retrievals per host.
+    @type maxHostFetches: C{int}
+    @ivar client: client used to do the actual retrievals.
+    @type client: L{FeedClient}
+    @ivar aliases: redirect targets, by canonical URL.
+    @type aliases: C{dict}
+    """
+
+    def __init__(self, maxFetches=MAX_FETCHES,
+                       maxHostFetches=MAX_HOST_FETCHES, client=None):
+        self.maxFetches = maxFetches
+        self.maxHostFetches = maxHostFetches
+        if client is None:
+            client = FeedClient(maxPersistentPerHost=maxHostFetches)
+        self.client = client
+        self.semaphore = defer.DeferredSemaphore(maxFetches)
+        self.hosts = {}
+        self.pending = {}
+        self.aliases = {}
+
+
+    def getFeed(self, url, *args, **kwargs):
+        """
+        Download a feed, when the concurrency limits allow it.
+
+        Takes the same arguments as L{FeedClient.getFeed}, with C{useCache}
+        and C{digest} passed as keyword arguments.
+        """
+        canonical = canonicalURL(url)
+        key = (self.aliases.get(canonical, canonical),
+               bool(kwargs.get('useCache', 1)),
+               kwargs.get('digest'))
+
+        d = defer.Deferred()
+
+        try:
+            self.pending[key].append(d)
+        except KeyError:
+            waiting = self.pending[key] = [d]
+
+            def done(result):
+                del self.pending[key]
+                if not isinstance(result, failure.Failure):
+                    self._addAlias(canonical, result)
+
+                for d in waiting:
+                    if isinstance(result, failure.Failure):
+                        d.errback(result)
+                    else:
+                        d.callback(copy.copy(result))
+
+            self._dispatch(url, *args, **kwargs).addBoth(done)
+
+        return d
+
+
+    def _addAlias(self, canonical, result):
+        """
+        Record the resource a retrieval ended up at, if it was redirected.
+        """
+        try:
+            href = result['href']
+        except (KeyError, TypeError):
+            return
+
+        target = canonicalURL(href)
+        if target != canonical:
+            self.aliases[canonical] = target
+
+
+    def _dispatch(self, url, *args, **kwargs):
+        host = (urlparse.urlsplit(url).hostname or '').lower()
+
+        try:
+            hostSemaphore = self.hosts[host]
+        except KeyError:
+            hostSemaphore = defer.DeferredSemaphore(self.maxHostFetches)
+            self.hosts[host] = hostSemaphore
+
+        def release(result):
+            self.semaphore.release()
+            hostSemaphore.release()
+            if (hostSemaphore.tokens == hostSemaphore.limit and
+                not hostSemaphore.waiting):
+                del self.hosts[host]
+            return result
+
+        def fetch(_):
+            d = defer.maybeDeferred(self.client.getFeed, url, *args, **kwargs)
+            d.addBoth(release)
+            return d
+
+        d = hostSemaphore.acquire()
+        d.addCallback(lambda _: self.semaphore.acquire())
+        d.addCallback(fetch)
+        return d
+
+
+    def close(self):
+        """
+        Close all persistent connections of the client.
+
+        @rtype: L{defer.Deferred}
+        """
+        return self.client.close()
+
+
+    def getPending(self):
+        """
+        Return the number of retrievals that are queued.
+
+        Coalesced retrievals are counted once.
+        """
+        return (len(self.semaphore.waiting) +
+                sum([len(hostSemaphore.waiting)
+                     for hostSemaphore in self.hosts.itervalues()]))
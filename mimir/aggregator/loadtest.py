@@ -0,0 +1,715 @@
+# -*- test-case-name: mimir.aggregator.test.test_loadtest -*-
+#
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Load test for the aggregator, against a local feed server.
+
+This starts a web server that serves a number of synthetic feeds, and runs
+a real L{aggregator.AggregatorService}, with its real fetcher, scheduler
+and publisher, for a period of time. Published items go to a fake
+publish-subscribe client instead of an XMPP server. The feeds can be tuned
+in size, in how often they change, in the validators they send for
+conditional requests, and in how many of them are slow or fail.
+
+Run it with::
+
+    python -m mimir.aggregator.loadtest [options]
+
+The test runs in real time, so use short intervals to compress a longer
+period of operation: with a C{--change-interval} of 60 seconds and a
+C{--min-interval} of 30 seconds, a run of ten minutes shows about as many
+polls as a day with the defaults.
+
+At the end, this reports the number of feed retrievals per second, and
+their outcomes, the processor time spent parsing, the number of publish
+requests and items, the lag of the reactor and the peak resident memory
+of the process. The server runs in the same process, so its work counts
+in the processor time and reactor lag, too, but serving a feed is cheap
+compared to retrieving and processing it.
+"""
+
+import simplejson
+import sys
+import time
+from resource import getrusage, RUSAGE_SELF
+
+from twisted.internet import defer, reactor
+from twisted.python import failure, log, usage
+from twisted.web import http, resource, server
+from twisted.words.protocols.jabber.jid import JID
+
+from mimir.aggregator import aggregator, fetcher, writer
+
+FEEDS = 100
+ENTRIES = 20
+ENTRY_SIZE = 1000
+CHANGE_INTERVAL = 300
+DURATION = 600
+LAG_INTERVAL = 0.1
+
+VALIDATORS = ('both', 'etag', 'last-modified', 'none')
+
+TEXT = ("Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do "
+        "eiusmod tempor incididunt ut labore et dolore magna aliqua. ")
+
+def _selected(index, fraction):
+    """
+    Return whether a feed is in the given fraction of all feeds.
+
+    The selected feeds are spread evenly over the feed indexes.
+    """
+    return int((index + 1) * fraction) > int(index * fraction)
+
+
+
+class SyntheticFeed(resource.Resource):
+    """
+    Synthetic RSS 2.0 feed that gets a new entry at regular intervals.
+
+    @ivar slow: whether this feed responds after a delay.
+    @type slow: C{bool}
+    @ivar failing: whether this feed fails with a server error.
+    @type failing: C{bool}
+    """
+
+    isLeaf = True
+
+    def __init__(self, server, index):
+        resource.Resource.__init__(self)
+        self.server = server
+        self.index = index
+        self.slow = _selected(index, server.slow)
+        self.failing = _selected(index, server.failing)
+        self._body = None
+        self._bodyGeneration = None
+
+
+    def generation(self):
+        """
+        Return the number of changes so far, and the time of the last one.
+
+        Feeds change at the same rate, but the changes are spread over the
+        change interval, instead of happening all at once.
+        """
+        interval = self.server.changeInterval
+        if not interval:
+            return 0, self.server.startTime
+
+        offset = interval * self.index / self.server.feeds
+        generation = int((self.server.reactor.seconds() -
+                          self.server.startTime + offset) // interval)
+        return generation, self.changeTime(generation)
+
+
+    def changeTime(self, generation):
+        """
+        Return the time of the change to a generation of the feed.
+
+        Generations before the first are as if the feed had been changing
+        before the server started.
+        """
+        interval = self.server.changeInterval
+        offset = interval * self.index / self.server.feeds
+        return self.server.startTime - offset + generation * interval
+
+
+    def getBody(self, generation):
+        """
+        Generate the document for a generation of the feed.
+
+        Each entry is dated by the change that added it, so that entries
+        do not appear to be updated when later entries are added.
+        """
+        if self._bodyGeneration == generation:
+            return self._body
+
+        base = self.server.url(self.index)
+        items = []
+        for number in xrange(generation + self.server.entries - 1,
+                             generation - 1, -1):
+            added = self.changeTime(number - self.server.entries + 1)
+            link = '%s/%d' % (base, number)
+            text = (('%d ' % number) + TEXT * (self.server.entrySize //
+                                               len(TEXT) + 1))
+            text = text[:self.server.entrySize]
+            items.append(
+                '<item><title>Entry %d of feed %d</title>'
+                '<link>%s</link><guid>%s</guid><pubDate>%s</pubDate>'
+                '<description>&lt;p&gt;%s&lt;/p&gt;</description>'
+                '</item>' % (number, self.index, link, link,
+                             http.datetimeToString(added), text))
+
+        self._body = (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<rss version="2.0"><channel>'
+            '<title>Feed %d</title><link>%s</link>'
+            '<description>Synthetic feed %d</description>'
+            '%s</channel></rss>' % (self.index, base, self.index,
+                                   ''.join(items)))
+        self._bodyGeneration = generation
+        return self._body
+
+
+    def render_GET(self, request):
+        self.server.requests += 1
+
+        if self.failing:
+            return self.respond(request, http.INTERNAL_SERVER_ERROR,
+                                'Synthetic failure')
+
+        generation, changed = self.generation()
+        validators = self.server.validators
+        cached = False
+        if validators in ('both', 'last-modified'):
+            if request.setLastModified(int(changed)) == http.CACHED:
+                cached = True
+        if validators in ('both', 'etag'):
+            if request.setETag('"%d-%d"' % (self.index, generation)) == \
+                    http.CACHED:
+                cached = True
+            elif validators == 'both':
+                cached = False
+
+        request.setHeader('Content-Type', 'application/rss+xml')
+        if cached:
+            return self.respond(request, http.NOT_MODIFIED, '')
+        else:
+            return self.respond(request, http.OK,
+                                self.getBody(generation))
+
+
+    def respond(self, request, code, body):
+        """
+        Send the response, possibly after a delay.
+        """
+        request.setResponseCode(code)
+        self.server.statuses[code] = self.server.statuses.get(code, 0) + 1
+
+        if not self.slow:
+            return body
+
+        def finish():
+            request.write(body)
+            request.finish()
+
+        call = self.server.reactor.callLater(self.server.slowDelay, finish)
+        request.notifyFinish().addErrback(lambda _: call.cancel())
+        return server.NOT_DONE_YET
+
+
+
+class FeedServer(resource.Resource):
+    """
+    Resource that serves synthetic feeds, by index.
+
+    @ivar feeds: the number of feeds.
+    @type feeds: C{int}
+    @ivar entries: the number of entries in each feed.
+    @type entries: C{int}
+    @ivar entrySize: the size of the text of an entry, in bytes.
+    @type entrySize: C{int}
+    @ivar changeInterval: the number of seconds between the changes of a
+        feed, or C{0} for feeds that never change.
+    @type changeInterval: C{float}
+    @ivar validators: the validators sent for conditional requests, one of
+        L{VALIDATORS}.
+    @type validators: C{str}
+    @ivar slow: the fraction of feeds that respond after L{slowDelay}.
+    @type slow: C{float}
+    @ivar failing: the fraction of feeds that fail with a server error.
+    @type failing: C{float}
+    @ivar requests: the number of requests for feeds.
+    @type requests: C{int}
+    @ivar statuses: the number of responses, by status code.
+    @type statuses: C{dict}
+    """
+
+    baseURL = None
+
+    def __init__(self, feeds=FEEDS, entries=ENTRIES, entrySize=ENTRY_SIZE,
+                       changeInterval=CHANGE_INTERVAL, validators='both',
+                       slow=0, slowDelay=10, failing=0, reactor=reactor):
+        resource.Resource.__init__(self)
+        self.feeds = feeds
+        self.entries = entries
+        self.entrySize = entrySize
+        self.changeInterval = changeInterval
+        self.validators = validators
+        self.slow = slow
+        self.slowDelay = slowDelay
+        self.failing = failing
+        self.reactor = reactor
+        self.startTime = reactor.seconds()
+        self.requests = 0
+        self.statuses = {}
+        self._feeds = {}
+
+
+    def url(self, index):
+        return '%s/%d' % (self.baseURL, index)
+
+
+    def getChild(self, name, request):
+        try:
+            index = int(name)
+        except ValueError:
+            return resource.NoResource()
+
+        if not 0 <= index < self.feeds:
+            return resource.NoResource()
+
+        if index not in self._feeds:
+            self._feeds[index] = SyntheticFeed(self, index)
+        return self._feeds[index]
+
+
+
+class MemoryFeedStorage(object):
+    """
+    Feed storage that keeps feeds in memory.
+
+    Stored feeds are serialized like L{aggregator.FileFeedStorage} does,
+    without writing them out.
+    """
+
+    def __init__(self):
+        self.feeds = {}
+        self.feedList = {}
+
+
+    def getFeedList(self):
+        return defer.succeed(self.feedList)
+
+
+    def setFeedURL(self, handle, url):
+        d = self.setFeedURLs([(handle, url)])
+        d.addCallback(lambda feeds: feeds[0])
+        return d
+
+
+    def setFeedURLs(self, feeds):
+        result = []
+        for handle, url in feeds:
+            feed = {'handle': handle, 'href': url}
+            self.feedList[handle] = feed
+            result.append(feed)
+        return defer.succeed(result)
+
+
+    def getFeed(self, handle):
+        if handle in self.feeds:
+            return defer.succeed(simplejson.loads(self.feeds[handle]))
+        else:
+            return defer.succeed(self.feedList[handle])
+
+
+    def storeFeed(self, feed):
+        self.feeds[feed['handle']] = simplejson.dumps(
+                feed, cls=aggregator.FeedParserEncoder)
+        return defer.succeed(None)
+
+
+
+class InstrumentedFeedClient(fetcher.FeedClient):
+    """
+    Feed client that keeps track of parse time and retrieval outcomes.
+
+    @ivar parses: the number of parsed feeds.
+    @type parses: C{int}
+    @ivar parseTime: the processor time spent parsing, in seconds.
+    @type parseTime: C{float}
+    @ivar outcomes: the number of retrievals, by outcome.
+    @type outcomes: C{dict}
+    """
+
+    def __init__(self, *args, **kwargs):
+        fetcher.FeedClient.__init__(self, *args, **kwargs)
+        self.parses = 0
+        self.parseTime = 0.0
+        self.outcomes = {}
+
+
+    def parser(self, data, url, status, headers):
+        start = time.clock()
+        try:
+            return fetcher.parseFeed(data, url, status, headers)
+        finally:
+            self.parses += 1
+            self.parseTime += time.clock() - start
+
+
+    def getFeed(self, url, *args, **kwargs):
+        def count(result):
+            if not isinstance(result, failure.Failure):
+                outcome = 'ok'
+            elif result.check(fetcher.Unchanged):
+                outcome = 'unchanged'
+            elif result.check(fetcher.NotModified):
+                outcome = 'not-modified'
+            elif result.check(fetcher.FetchAborted):
+                outcome = 'aborted'
+            else:
+                outcome = 'error'
+
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            return result
+
+        d = fetcher.FeedClient.getFeed(self, url, *args, **kwargs)
+        d.addBoth(count)
+        return d
+
+
+
+class FakePubSubClient(object):
+    """
+    Stand-in for a publish-subscribe client, that counts publish requests.
+
+    @ivar publishDelay: the number of seconds a publish request takes.
+    @type publishDelay: C{float}
+    @ivar publishes: the number of publish requests.
+    @type publishes: C{int}
+    @ivar items: the number of published items.
+    @type items: C{int}
+    @ivar bytes: the size of the serialized items.
+    @type bytes: C{int}
+    """
+
+    def __init__(self, publishDelay=0, reactor=reactor):
+        self.publishDelay = publishDelay
+        self.reactor = reactor
+        self.publishes = 0
+        self.items = 0
+        self.bytes = 0
+
+
+    def publish(self, service, nodeIdentifier, items=None):
+        self.publishes += 1
+        for item in items or []:
+            self.items += 1
+            self.bytes += len(item.toXml().encode('utf-8'))
+
+        if self.publishDelay:
+            d = defer.Deferred()
+            self.reactor.callLater(self.publishDelay, d.callback, None)
+            return d
+        else:
+            return defer.succeed(None)
+
+
+    def createNode(self, service, nodeIdentifier=None, options=None):
+        return defer.succeed(nodeIdentifier)
+
+
+
+class LagMonitor(object):
+    """
+    Measure how late the reactor runs timed calls.
+
+    @ivar interval: the number of seconds between measurements.
+    @type interval: C{float}
+    @ivar samples: the measured delays, in seconds.
+    @type samples: C{list}
+    """
+
+    def __init__(self, interval=LAG_INTERVAL, reactor=reactor):
+        self.interval = interval
+        self.reactor = reactor
+        self.samples = []
+        self._call = None
+        self._expected = None
+
+
+    def start(self):
+        self._expected = self.reactor.seconds() + self.interval
+        self._call = self.reactor.callLater(self.interval, self._measure)
+
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+
+    def _measure(self):
+        self.samples.append(max(0, self.reactor.seconds() - self._expected))
+        self.start()
+
+
+    def summary(self):
+        """
+        Return the mean, 99th percentile and maximum lag, in milliseconds.
+        """
+        if not self.samples:
+            return {'mean': 0.0, 'p99': 0.0, 'max': 0.0}
+
+        samples = sorted(self.samples)
+        return {'mean': 1000 * sum(samples) / len(samples),
+                'p99': 1000 * samples[int(0.99 * (len(samples) - 1))],
+                'max': 1000 * samples[-1]}
+
+
+
+class LoadTest(object):
+    """
+    Run an aggregator against a local feed server.
+
+    @ivar server: the feed server.
+    @type server: L{FeedServer}
+    @ivar service: the aggregator under test.
+    @type service: L{aggregator.AggregatorService}
+    @ivar client: the feed client of the aggregator.
+    @type client: L{InstrumentedFeedClient}
+    @ivar pubsub: the client the aggregator publishes to.
+    @type pubsub: L{FakePubSubClient}
+    """
+
+    def __init__(self, server, minInterval=aggregator.MIN_INTERVAL,
+                       maxInterval=aggregator.MAX_INTERVAL,
+                       maxFetches=fetcher.MAX_FETCHES,
+                       maxHostFetches=None,
+                       timeout=fetcher.FETCH_TIMEOUT,
+                       writerName='direct', publishDelay=0,
+                       reactor=reactor):
+        # All feeds are served from the same host, so a lower limit per
+        # host would also limit the retrievals in total.
+        if maxHostFetches is None:
+            maxHostFetches = maxFetches
+
+        self.server = server
+        self.reactor = reactor
+        self.lag = LagMonitor(reactor=reactor)
+
+        self.client = InstrumentedFeedClient(
+                reactor=reactor, maxPersistentPerHost=maxHostFetches,
+                cache=fetcher.ValidatorCache(), timeout=timeout)
+
+        self.service = aggregator.AggregatorService(MemoryFeedStorage())
+        self.service.initialInterval = minInterval
+        self.service.minInterval = minInterval
+        self.service.maxInterval = maxInterval
+        self.service.dispatcher = fetcher.FetchDispatcher(maxFetches,
+                                                          maxHostFetches,
+                                                          self.client)
+
+        self.pubsub = FakePubSubClient(publishDelay, reactor)
+        self.service.handler = aggregator.AtomPublisher(self.pubsub)
+        self.service.handler.service = JID('pubsub.example.org')
+        self.service.handler.writer = writer.WRITERS[writerName]()
+
+
+    def run(self, duration):
+        """
+        Run the aggregator for a number of seconds.
+
+        @return: deferred that fires with the report, see L{report}.
+        @rtype: L{defer.Deferred}
+        """
+        self.port = self.reactor.listenTCP(0, server.Site(self.server),
+                                           interface='127.0.0.1')
+        self.server.baseURL = 'http://127.0.0.1:%d' % (
+                self.port.getHost().port)
+
+        def setIntervals(feeds):
+            # Start out polling at the minimum interval, like the first
+            # polls, instead of the default interval.
+            for feed in feeds:
+                feed['interval'] = self.service.minInterval
+
+        feeds = [('feed%d' % index, self.server.url(index))
+                 for index in xrange(self.server.feeds)]
+        d = self.service.storage.setFeedURLs(feeds)
+        d.addCallback(setIntervals)
+        d.addCallback(lambda _: self.start())
+        d.addCallback(lambda _: self.wait(duration))
+        d.addCallback(lambda _: self.stop())
+        d.addCallback(lambda _: self.report(duration))
+        return d
+
+
+    def start(self):
+        self.startUsage = getrusage(RUSAGE_SELF)
+        self.lag.start()
+        self.service.startService()
+
+
+    def wait(self, duration):
+        d = defer.Deferred()
+        self.reactor.callLater(duration, d.callback, None)
+        return d
+
+
+    def stop(self):
+        self.lag.stop()
+        self.stopUsage = getrusage(RUSAGE_SELF)
+        d = defer.maybeDeferred(self.service.stopService)
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+
+    def report(self, duration):
+        """
+        Summarize the run.
+
+        The peak resident memory is as reported by the operating system,
+        in kilobytes on Linux.
+
+        @rtype: C{dict}
+        """
+        return {
+            'duration': duration,
+            'feeds': self.server.feeds,
+            'requests': self.server.requests,
+            'fetchRate': float(self.server.requests) / duration,
+            'statuses': self.server.statuses,
+            'outcomes': self.client.outcomes,
+            'parses': self.client.parses,
+            'parseTime': self.client.parseTime,
+            'cpuTime': (self.stopUsage.ru_utime - self.startUsage.ru_utime +
+                        self.stopUsage.ru_stime - self.startUsage.ru_stime),
+            'publishes': self.pubsub.publishes,
+            'items': self.pubsub.items,
+            'bytes': self.pubsub.bytes,
+            'lag': self.lag.summary(),
+            'peakRSS': self.stopUsage.ru_maxrss,
+        }
+
+
+
+def formatReport(report):
+    """
+    Format a report for humans.
+    """
+    parseMean = 1000 * report['parseTime'] / (report['parses'] or 1)
+    lines = [
+        "Duration:    %(duration)d s, %(feeds)d feeds" % report,
+        "Fetches:     %(requests)d (%(fetchRate).2f/s)" % report,
+        "Statuses:    %s" % formatCounts(report['statuses']),
+        "Outcomes:    %s" % formatCounts(report['outcomes']),
+        "Parsing:     %d feeds, %.2f s CPU (%.2f ms/feed)" % (
+                report['parses'], report['parseTime'], parseMean),
+        "CPU:         %(cpuTime).2f s" % report,
+        "Publishes:   %(publishes)d requests, %(items)d items, "
+                     "%(bytes)d bytes" % report,
+        "Reactor lag: %(mean).1f ms mean, %(p99).1f ms p99, "
+                     "%(max).1f ms max" % report['lag'],
+        "Peak RSS:    %(peakRSS)d" % report,
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+
+def formatCounts(counts):
+    return ', '.join(['%s: %d' % item for item in sorted(counts.items())])
+
+
+
+class Options(usage.Options):
+    optParameters = [
+        ('feeds', None, FEEDS, 'Number of feeds', int),
+        ('entries', None, ENTRIES, 'Number of entries per feed', int),
+        ('entry-size', None, ENTRY_SIZE,
+            'Size of the text of each entry in bytes', int),
+        ('change-interval', None, CHANGE_INTERVAL,
+            'Seconds between changes of a feed, 0 for feeds that never '
+            'change', float),
+        ('validators', None, 'both',
+            'Validators for conditional requests: both, etag, last-modified '
+            'or none'),
+        ('slow', None, 0, 'Fraction of feeds that respond slowly', float),
+        ('slow-delay', None, 10,
+            'Seconds before slow feeds respond', float),
+        ('failing', None, 0,
+            'Fraction of feeds that fail with a server error', float),
+        ('duration', 'd', DURATION, 'Seconds to run the test', float),
+        ('min-interval', None, aggregator.MIN_INTERVAL,
+            'Minimum polling interval in seconds', int),
+        ('max-interval', None, aggregator.MAX_INTERVAL,
+            'Maximum polling interval in seconds', int),
+        ('max-fetches', None, fetcher.MAX_FETCHES,
+            'Maximum number of concurrent feed retrievals', int),
+        ('max-host-fetches', None, None,
+            'Maximum number of concurrent feed retrievals per host. All '
+            'feeds are on the same host, so this defaults to --max-fetches',
+            int),
+        ('fetch-timeout', None, fetcher.FETCH_TIMEOUT,
+            'Maximum number of seconds for a feed retrieval', int),
+        ('writer', None, 'direct',
+            'Writer for published Atom entries: reconstitute or direct'),
+        ('publish-delay', None, 0,
+            'Seconds each publish request takes', float),
+        ('logfile', 'l', None, 'Log the aggregator to this file'),
+    ]
+
+    optFlags = [
+        ('json', None, 'Report results as JSON'),
+    ]
+
+    def postOptions(self):
+        if self['feeds'] < 1:
+            raise usage.UsageError("There must be at least one feed")
+
+        if self['validators'] not in VALIDATORS:
+            raise usage.UsageError("Unknown validators %r" %
+                                   self['validators'])
+
+        if self['writer'] not in writer.WRITERS:
+            raise usage.UsageError("Unknown writer %r" % self['writer'])
+
+        for name in ('slow', 'failing'):
+            if not 0 <= self[name] <= 1:
+                raise usage.UsageError("The fraction of %s feeds must be "
+                                       "between 0 and 1" % name)
+
+        if self['duration'] <= 0:
+            raise usage.UsageError("The duration must be positive")
+
+
+
+def main(argv=None, stdout=sys.stdout):
+    config = Options()
+    try:
+        config.parseOptions(argv)
+    except usage.UsageError, e:
+        raise SystemExit("%s\n%s" % (config, e))
+
+    if config['logfile']:
+        log.startLogging(open(config['logfile'], 'a'), setStdout=False)
+    else:
+        log.startLoggingWithObserver(lambda event: None, setStdout=False)
+
+    feedServer = FeedServer(feeds=config['feeds'],
+                            entries=config['entries'],
+                            entrySize=config['entry-size'],
+                            changeInterval=config['change-interval'],
+                            validators=config['validators'],
+                            slow=config['slow'],
+                            slowDelay=config['slow-delay'],
+                            failing=config['failing'])
+    test = LoadTest(feedServer,
+                    minInterval=config['min-interval'],
+                    maxInterval=config['max-interval'],
+                    maxFetches=config['max-fetches'],
+                    maxHostFetches=config['max-host-fetches'],
+                    timeout=config['fetch-timeout'],
+                    writerName=config['writer'],
+                    publishDelay=config['publish-delay'])
+
+    def output(report):
+        if config['json']:
+            stdout.write(simplejson.dumps(report) + '\n')
+        else:
+            stdout.write(formatReport(report))
+
+    d = test.run(config['duration'])
+    d.addCallback(output)
+    d.addErrback(log.err, "Load test failed")
+    d.addBoth(lambda _: reactor.stop())
+
+    reactor.run()
+
+
+
+if __name__ == '__main__':
+    main()
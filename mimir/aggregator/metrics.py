@@ -0,0 +1,371 @@
+# -*- test-case-name: mimir.aggregator.test.test_metrics -*-
+#
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Runtime metrics of the aggregator.
+
+L{Metrics} keeps counters and histograms, in aggregate and per feed. The
+aggregator records feed retrievals, their outcomes, discovered entries,
+publish requests and the lag of scheduled polls. When entries are
+spooled, the publish spool records the publish requests instead, per node
+rather than per feed. The fetcher records the size of retrieved documents
+and the time it takes to parse them. As retrievals are shared between
+feeds with the same URL, these two are only kept in aggregate, like the
+hits and misses of the cache of rendered entries.
+
+L{MetricsResource} exposes the metrics over HTTP, as JSON or in the text
+format of Prometheus.
+"""
+
+import bisect
+import simplejson
+
+from twisted.web2 import http, http_headers, resource, responsecode
+
+# Upper bounds of the buckets of histograms, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+           60, 300)
+
+# Counters, with their name in the Prometheus format and description.
+COUNTERS = (
+    ('fetches', 'fetches', 'Feed retrievals'),
+    ('notModified', 'not_modified', 'Retrievals of unmodified feeds'),
+    ('unchanged', 'unchanged', 'Retrievals of feeds with an unchanged body'),
+    ('errors', 'errors', 'Failed retrievals'),
+    ('bytes', 'bytes', 'Size of retrieved feed documents, in bytes'),
+    ('entriesNew', 'entries_new', 'New entries'),
+    ('entriesUpdated', 'entries_updated', 'Updated entries'),
+    ('publishes', 'publishes', 'Publish requests'),
+    ('publishErrors', 'publish_errors', 'Failed publish requests'),
+    ('renderHits', 'render_cache_hits', 'Entries found in the render cache'),
+    ('renderMisses', 'render_cache_misses',
+        'Entries not found in the render cache'),
+)
+
+# Histograms, with their name in the Prometheus format and description.
+HISTOGRAMS = (
+    ('fetchLatency', 'fetch_latency_seconds', 'Time to retrieve a feed'),
+    ('parseTime', 'parse_time_seconds', 'Time to parse a feed'),
+    ('publishLatency', 'publish_latency_seconds',
+        'Time to publish the fresh entries of a feed'),
+    ('scheduleLag', 'schedule_lag_seconds',
+        'Delay of polls after their scheduled time'),
+)
+
+# Metrics recorded by the fetcher and the render cache, that are not kept
+# per feed.
+AGGREGATE_ONLY = ('bytes', 'parseTime', 'renderHits', 'renderMisses')
+
+PREFIX = 'mimir_aggregator_'
+
+def statusClass(status):
+    """
+    Return the class of an HTTP status code, like C{'2xx'}.
+    """
+    return '%sxx' % str(status)[:1]
+
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\')
+                 .replace('"', '\\"')
+                 .replace('\n', '\\n'))
+
+
+
+def _formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    else:
+        return str(value)
+
+
+
+class Histogram(object):
+    """
+    Distribution of observed values, over buckets with fixed bounds.
+
+    @ivar buckets: the upper bounds of the buckets, in ascending order.
+    @type buckets: C{tuple}
+    @ivar counts: the number of values per bucket, with an extra bucket for
+        values above the largest bound.
+    @type counts: C{list}
+    @ivar count: the number of observed values.
+    @type count: C{int}
+    @ivar sum: the sum of the observed values.
+    @type sum: C{float}
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+    def cumulative(self):
+        """
+        Return the number of values up to each bound.
+
+        @return: tuples of bound and count, ending with C{'+Inf'} for the
+            total.
+        @rtype: C{list}
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+    def asDict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'buckets': self.cumulative()}
+
+
+
+class FeedMetrics(object):
+    """
+    Metrics of a single feed.
+
+    Instead of histograms, only the count and sum of observed values are
+    kept per feed.
+
+    @ivar counters: counter values, by name.
+    @type counters: C{dict}
+    @ivar statuses: number of responses, by class of HTTP status.
+    @type statuses: C{dict}
+    @ivar timings: count and sum of observed values, by name.
+    @type timings: C{dict}
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.statuses = {}
+        self.timings = {}
+
+
+    def asDict(self):
+        return {'counters': self.counters,
+                'statuses': self.statuses,
+                'timings': dict([(name, {'count': count, 'sum': total})
+                                 for name, (count, total)
+                                 in self.timings.iteritems()])}
+
+
+
+class Metrics(object):
+    """
+    Counters and histograms of the aggregator, in aggregate and per feed.
+
+    Counters and histograms are referred to by the names in L{COUNTERS} and
+    L{HISTOGRAMS}. Responses are counted by the class of their HTTP status
+    code.
+
+    @ivar counters: counter values, by name.
+    @type counters: C{dict}
+    @ivar statuses: number of responses, by class of HTTP status.
+    @type statuses: C{dict}
+    @ivar histograms: histograms, by name.
+    @type histograms: C{dict}
+    @ivar feeds: metrics per feed, by handle, or per node, by node
+        identifier.
+    @type feeds: C{dict}
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.counters = dict([(name, 0) for name, _, _ in COUNTERS])
+        self.statuses = {}
+        self.histograms = dict([(name, Histogram(buckets))
+                                for name, _, _ in HISTOGRAMS])
+        self.feeds = {}
+
+
+    def _feed(self, handle):
+        try:
+            return self.feeds[handle]
+        except KeyError:
+            feed = self.feeds[handle] = FeedMetrics()
+            return feed
+
+
+    def increment(self, name, handle=None, amount=1):
+        """
+        Increment a counter, and that of the feed, if given.
+        """
+        self.counters[name] += amount
+        if handle is not None:
+            counters = self._feed(handle).counters
+            counters[name] = counters.get(name, 0) + amount
+
+
+    def countStatus(self, status, handle=None):
+        """
+        Count a response by the class of its HTTP status code.
+        """
+        key = statusClass(status)
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        if handle is not None:
+            statuses = self._feed(handle).statuses
+            statuses[key] = statuses.get(key, 0) + 1
+
+
+    def observe(self, name, value, handle=None):
+        """
+        Record a value in a histogram, and in the timings of the feed.
+        """
+        self.histograms[name].observe(value)
+        if handle is not None:
+            timing = self._feed(handle).timings.setdefault(name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += value
+
+
+    def notModifiedRatio(self):
+        """
+        Return the fraction of retrievals of feeds that were not modified.
+        """
+        if not self.counters['fetches']:
+            return 0.0
+
+        return float(self.counters['notModified']) / self.counters['fetches']
+
+
+    def asDict(self, feeds=True):
+        """
+        Return all metrics as a structure that can be serialized to JSON.
+
+        @param feeds: whether to include the metrics per feed.
+        @type feeds: C{bool}
+        """
+        result = {'counters': self.counters,
+                  'statuses': self.statuses,
+                  'notModifiedRatio': self.notModifiedRatio(),
+                  'histograms': dict([(name, histogram.asDict())
+                                      for name, histogram
+                                      in self.histograms.iteritems()])}
+        if feeds:
+            result['feeds'] = dict([(handle, feed.asDict())
+                                    for handle, feed
+                                    in self.feeds.iteritems()])
+        return result
+
+
+    def toPrometheus(self, feeds=True):
+        """
+        Return all metrics in the Prometheus text format.
+
+        Metrics per feed have their own names, with C{feed_} after the
+        prefix, and a C{handle} label.
+
+        @param feeds: whether to include the metrics per feed.
+        @type feeds: C{bool}
+        @rtype: C{str}
+        """
+        lines = []
+
+        def add(name, kind, description, samples):
+            lines.append('# HELP %s%s %s' % (PREFIX, name, description))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+            for suffix, labels, value in samples:
+                if labels:
+                    labels = '{%s}' % ','.join(['%s="%s"' % (key,
+                                                             _escape(str(v)))
+                                                for key, v in labels])
+                else:
+                    labels = ''
+                lines.append('%s%s%s%s %s' % (PREFIX, name, suffix, labels,
+                                              _formatValue(value)))
+
+        handles = sorted(self.feeds)
+        if not feeds:
+            handles = []
+
+        for key, name, description in COUNTERS:
+            add(name + '_total', 'counter', description,
+                [('', (), self.counters[key])])
+            if handles and key not in AGGREGATE_ONLY:
+                add('feed_' + name + '_total', 'counter', description,
+                    [('', (('handle', handle),),
+                      self.feeds[handle].counters.get(key, 0))
+                     for handle in handles])
+
+        add('responses_total', 'counter',
+            'Responses, by class of HTTP status',
+            [('', (('class', key),), value)
+             for key, value in sorted(self.statuses.iteritems())])
+        if handles:
+            add('feed_responses_total', 'counter',
+                'Responses, by class of HTTP status',
+                [('', (('handle', handle), ('class', key)), value)
+                 for handle in handles
+                 for key, value
+                 in sorted(self.feeds[handle].statuses.iteritems())])
+
+        add('not_modified_ratio', 'gauge',
+            'Fraction of retrievals of unmodified feeds',
+            [('', (), self.notModifiedRatio())])
+
+        for key, name, description in HISTOGRAMS:
+            histogram = self.histograms[key]
+            samples = [('_bucket', (('le', bound),), count)
+                       for bound, count in histogram.cumulative()]
+            samples.append(('_sum', (), histogram.sum))
+            samples.append(('_count', (), histogram.count))
+            add(name, 'histogram', description, samples)
+
+            if handles and key not in AGGREGATE_ONLY:
+                samples = []
+                for handle in handles:
+                    count, total = self.feeds[handle].timings.get(key,
+                                                                  (0, 0.0))
+                    samples.append(('_sum', (('handle', handle),), total))
+                    samples.append(('_count', (('handle', handle),), count))
+                add('feed_' + name, 'summary', description, samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+
+class MetricsResource(resource.Resource):
+    """
+    Resource exposing the metrics of the aggregator.
+
+    The metrics are returned as JSON, or in the Prometheus text format when
+    the C{format} query argument is C{prometheus}. With a C{feeds} query
+    argument of C{0}, the metrics per feed are left out.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    http_POST = None
+
+    def http_GET(self, request):
+        format = request.args.get('format', ['json'])[0]
+        feeds = request.args.get('feeds', ['1'])[0] != '0'
+
+        if format == 'prometheus':
+            contentType = http_headers.MimeType('text', 'plain',
+                                                {'version': '0.0.4'})
+            body = self.metrics.toPrometheus(feeds)
+        elif format == 'json':
+            contentType = http_headers.MimeType('application', 'json')
+            body = simplejson.dumps(self.metrics.asDict(feeds))
+        else:
+            return http.StatusResponse(responsecode.BAD_REQUEST,
+                                       """Unknown format""")
+
+        return http.Response(responsecode.OK,
+                             {'content-type': contentType},
+                             stream=body)
@@ -0,0 +1,372 @@
+# -*- test-case-name: mimir.aggregator.test.test_parsepool -*-
+#
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Pool of worker processes for parsing feeds.
+
+Parsing and scrubbing large feeds is CPU bound, and would otherwise block
+the reactor. The L{ParserPool} sends retrieved feed documents to worker
+processes, that run L{fetcher.parseDocument} and send back the result.
+Requests and responses are pickles, framed by a 32-bit length prefix, over
+the standard input and output of the workers.
+
+When no worker is available, because the pool was not started or because
+a worker died while parsing, feeds are parsed in-process instead. A worker
+that takes too long to parse a feed is killed, and the parse fails.
+Workers that end are restarted, with an increasing delay if they keep
+ending without handling any request.
+"""
+
+import cPickle as pickle
+import os
+import struct
+import sys
+
+from twisted.application import service
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python import failure, log
+
+from mimir.aggregator import fetcher
+
+PREFIX = '!I'
+PREFIX_LENGTH = struct.calcsize(PREFIX)
+
+# Maximum number of seconds a worker may take to parse a feed.
+PARSE_TIMEOUT = 60
+
+class WorkerError(Exception):
+    """
+    Parsing failed in the worker process.
+    """
+
+
+
+class ParseTimeout(Exception):
+    """
+    The worker process took too long to parse a feed, and was killed.
+    """
+
+
+
+class BozoException(Exception):
+    """
+    Stand-in for a bozo exception that could not be pickled.
+    """
+
+
+
+def _frame(obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return struct.pack(PREFIX, len(data)) + data
+
+
+
+def _picklableResult(result):
+    """
+    Make sure the parse result can be sent back to the parent.
+    """
+    exc = result.get('bozo_exception')
+    if exc is not None:
+        try:
+            pickle.dumps(exc, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            result['bozo_exception'] = BozoException('%s: %s' % (
+                exc.__class__.__name__, exc))
+    return result
+
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """
+    Protocol for talking to a single worker process.
+
+    @ivar current: deferred for the request being handled, if any.
+    @type current: L{defer.Deferred}
+    @ivar responses: number of responses received from the worker.
+    @type responses: C{int}
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffer = ''
+        self.current = None
+        self.responses = 0
+        self.ended = defer.Deferred()
+        self._timeoutCall = None
+
+
+    def parse(self, request):
+        self.current = defer.Deferred()
+        self._timeoutCall = self.pool.reactor.callLater(self.pool.timeout,
+                                                        self.timedOut)
+        self.transport.write(_frame(request))
+        return self.current
+
+
+    def _cancelTimeout(self):
+        if self._timeoutCall is not None and self._timeoutCall.active():
+            self._timeoutCall.cancel()
+        self._timeoutCall = None
+
+
+    def timedOut(self):
+        """
+        Kill the worker, and fail the request it is handling.
+        """
+        self._timeoutCall = None
+        d, self.current = self.current, None
+        log.msg("Parser worker took longer than %d seconds, killing it" %
+                self.pool.timeout)
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+        d.errback(ParseTimeout())
+
+
+    def outReceived(self, data):
+        self.buffer += data
+        while len(self.buffer) >= PREFIX_LENGTH:
+            length, = struct.unpack(PREFIX, self.buffer[:PREFIX_LENGTH])
+            if len(self.buffer) < PREFIX_LENGTH + length:
+                return
+
+            data = self.buffer[PREFIX_LENGTH:PREFIX_LENGTH + length]
+            self.buffer = self.buffer[PREFIX_LENGTH + length:]
+
+            d, self.current = self.current, None
+            if d is None:
+                # The request timed out, and the worker is being killed.
+                continue
+
+            self._cancelTimeout()
+            self.responses += 1
+            try:
+                status, result = pickle.loads(data)
+            except Exception:
+                d.errback(failure.Failure())
+            else:
+                if status == 'ok':
+                    d.callback(result)
+                else:
+                    d.errback(WorkerError(result))
+
+            self.pool.workerIdle(self)
+
+
+    def errReceived(self, data):
+        log.msg("Parser worker: %s" % data.rstrip())
+
+
+    def processEnded(self, reason):
+        self._cancelTimeout()
+        d, self.current = self.current, None
+        if d is not None:
+            d.errback(reason)
+        self.pool.workerEnded(self)
+        self.ended.callback(None)
+
+
+
+class ParserPool(service.Service):
+    """
+    Service that maintains a pool of worker processes for parsing feeds.
+
+    Use L{parse} as the parser of a L{fetcher.FeedClient}.
+
+    @ivar size: number of worker processes.
+    @type size: C{int}
+    @ivar fast: whether to use the fast parser, see
+                L{fetcher.parseDocument}.
+    @type fast: C{bool}
+    @ivar timeout: maximum number of seconds a worker may take to parse a
+                   feed, before it is killed.
+    @type timeout: C{float}
+    @ivar initialDelay: seconds before restarting a worker that ended
+                        without handling a request, after one that did not
+                        either.
+    @ivar maxDelay: maximum number of seconds before restarting a worker.
+    @ivar factor: factor for the delay after each worker that ended
+                  without handling a request.
+    """
+
+    fast = False
+    timeout = PARSE_TIMEOUT
+    initialDelay = 1
+    maxDelay = 300
+    factor = 2
+
+    def __init__(self, size, reactor=reactor):
+        self.size = size
+        self.reactor = reactor
+        self.workers = []
+        self.idle = []
+        self.queue = []
+        self._delay = 0
+        self._spawnCalls = []
+
+
+    def startService(self):
+        service.Service.startService(self)
+        for _ in xrange(self.size):
+            self.spawnWorker()
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        for call in self._spawnCalls:
+            call.cancel()
+        self._spawnCalls = []
+
+        for d in self.queue:
+            d.callback(None)
+        self.queue = []
+
+        ended = []
+        for worker in self.workers:
+            ended.append(worker.ended)
+            worker.transport.closeStdin()
+
+        return defer.DeferredList(ended)
+
+
+    def spawnWorker(self):
+        """
+        Start a new worker process.
+        """
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+
+        worker = WorkerProtocol(self)
+        self.reactor.spawnProcess(worker, sys.executable,
+                                  [sys.executable, '-m', __name__],
+                                  env=env)
+        self.workers.append(worker)
+        self.workerIdle(worker)
+
+
+    def workerIdle(self, worker):
+        if self.queue:
+            self.queue.pop(0).callback(worker)
+        else:
+            self.idle.append(worker)
+
+
+    def workerEnded(self, worker):
+        """
+        Restart a worker that ended.
+
+        A worker that ended without handling any request, like one that
+        fails to start, is restarted after a delay, that increases with
+        each such worker. Meanwhile, waiting requests are parsed in-process
+        if no worker is left.
+        """
+        self.workers.remove(worker)
+        if worker in self.idle:
+            self.idle.remove(worker)
+
+        if not self.running:
+            return
+
+        if worker.responses:
+            self._delay = 0
+
+        delay = self._delay
+        self._delay = min(self.maxDelay,
+                          self._delay * self.factor or self.initialDelay)
+
+        if not delay:
+            log.msg("Parser worker ended, starting a new one")
+            self.spawnWorker()
+            return
+
+        log.msg("Parser worker ended, starting a new one in %d seconds" %
+                delay)
+
+        def spawn():
+            self._spawnCalls.remove(call)
+            self.spawnWorker()
+
+        call = self.reactor.callLater(delay, spawn)
+        self._spawnCalls.append(call)
+
+        if not self.workers:
+            queue, self.queue = self.queue, []
+            for d in queue:
+                d.callback(None)
+
+
+    def parse(self, data, url, status, headers):
+        """
+        Parse a retrieved feed in a worker process.
+
+        Takes the same arguments as L{fetcher.parseFeed}. Falls back to
+        parsing in-process if no worker is available. Fails with
+        L{ParseTimeout} if the worker takes longer than L{timeout}.
+
+        @rtype: L{defer.Deferred}
+        """
+        request = (data, url, status, headers, self.fast)
+
+        def gotWorker(worker):
+            if worker is None:
+                return fetcher.parseFeed(*request)
+
+            d = worker.parse(request)
+            d.addErrback(fallback)
+            return d
+
+        def fallback(reason):
+            reason.trap(error.ProcessDone, error.ProcessTerminated)
+            log.msg("Parser worker ended while parsing %s, "
+                    "parsing in-process" % url)
+            return fetcher.parseFeed(*request)
+
+        if not self.running or not self.workers:
+            return fetcher.parseFeed(*request)
+
+        if self.idle:
+            return gotWorker(self.idle.pop())
+        else:
+            d = defer.Deferred()
+            self.queue.append(d)
+            d.addCallback(gotWorker)
+            return d
+
+
+
+def work(stdin, stdout):
+    """
+    Handle parse requests until the input is closed.
+    """
+    while True:
+        prefix = stdin.read(PREFIX_LENGTH)
+        if len(prefix) < PREFIX_LENGTH:
+            return
+
+        length, = struct.unpack(PREFIX, prefix)
+        request = pickle.loads(stdin.read(length))
+
+        try:
+            response = ('ok', _picklableResult(
+                                fetcher.parseDocument(*request)))
+        except Exception, e:
+            response = ('error', '%s: %s' % (e.__class__.__name__, e))
+
+        stdout.write(_frame(response))
+        stdout.flush()
+
+
+
+if __name__ == '__main__':
+    # Use the module by its proper name, so that exceptions defined here
+    # can be unpickled by the parent.
+    from mimir.aggregator import parsepool
+
+    # Keep stray output from ending up in the response stream.
+    stdout = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    parsepool.work(os.fdopen(0, 'rb'), stdout)
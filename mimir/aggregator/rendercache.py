@@ -0,0 +1,220 @@
+# -*- test-case-name: mimir.aggregator.test.test_rendercache -*-
+#
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Cache of rendered entries.
+
+L{AtomPublisher<mimir.aggregator.aggregator.AtomPublisher>} renders
+entries to XML through a writer. The same version of an entry is rendered
+again when it is republished, for example when a node is seeded anew. The
+L{RenderCache} keeps the serialized XML of rendered entries, keyed by the
+writer, the feed handle, the entry identifier and the digest of the
+entry's contents, so that an unchanged entry is not rendered twice.
+
+The cache is kept in memory, and optionally also in a directory, with a
+file per entry, so that it survives restarts.
+"""
+
+import hashlib
+import heapq
+
+from twisted.python import log
+from twisted.python.filepath import FilePath
+
+RENDER_CACHE_SIZE = 10000
+RENDER_DISK_CACHE_SIZE = 100000
+
+def _evict(entries, maxSize):
+    """
+    Evict the least recently used entries, down to 90% of the maximum size.
+
+    @param entries: entries, with the value of the use counter first.
+    @type entries: C{dict}
+    @return: the keys of the evicted entries.
+    @rtype: C{list}
+    """
+    count = len(entries) - int(maxSize * 0.9)
+    evicted = [key for _, key
+                   in heapq.nsmallest(count,
+                                      [(entry[0], key) for key, entry
+                                                       in entries.iteritems()])]
+    for key in evicted:
+        del entries[key]
+    return evicted
+
+
+
+class RenderCache(object):
+    """
+    Bounded cache of serialized XML of rendered entries.
+
+    The memory and disk tiers each evict their least recently used entries
+    when they grow beyond their maximum size, a batch at a time like
+    L{ValidatorCache<mimir.aggregator.fetcher.ValidatorCache>}. Entries
+    found on disk are promoted to memory.
+
+    @ivar maxSize: maximum number of entries kept in memory.
+    @type maxSize: C{int}
+    @ivar path: directory of the disk tier, or C{None}.
+    @type path: L{FilePath}
+    @ivar maxDiskSize: maximum number of entries kept on disk.
+    @type maxDiskSize: C{int}
+    @ivar hits: number of lookups found in memory.
+    @type hits: C{int}
+    @ivar diskHits: number of lookups found on disk.
+    @type diskHits: C{int}
+    @ivar misses: number of lookups not found.
+    @type misses: C{int}
+    @ivar metrics: metrics to count hits and misses in, or C{None}.
+    @type metrics: L{mimir.aggregator.metrics.Metrics}
+    """
+
+    metrics = None
+
+    def __init__(self, maxSize=RENDER_CACHE_SIZE, path=None,
+                       maxDiskSize=RENDER_DISK_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.maxDiskSize = maxDiskSize
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self._entries = {}
+        self._diskEntries = {}
+        self._counter = 0
+
+        if path is None:
+            self.path = None
+        else:
+            self.path = FilePath(path)
+            if self.path.exists():
+                self._scan()
+            else:
+                self.path.makedirs()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _scan(self):
+        """
+        Find the entries on disk, least recently modified first.
+        """
+        children = [(child.getModificationTime(), child.basename())
+                    for directory in self.path.children()
+                    if directory.isdir()
+                    for child in directory.children()]
+        children.sort()
+        for _, name in children:
+            self._counter += 1
+            self._diskEntries[name] = [self._counter]
+
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.increment(name)
+
+
+    @staticmethod
+    def key(writer, handle, entryId, digest):
+        """
+        Return the key of a rendered entry.
+
+        @param writer: the name of the writer.
+        @type writer: C{str}
+        @param handle: the handle of the feed.
+        @type handle: C{str}
+        @param entryId: the identifier of the entry.
+        @type entryId: C{unicode}
+        @param digest: the digest of the entry's contents.
+        @type digest: C{str}
+        @rtype: C{str}
+        """
+        data = u'\0'.join([writer, handle, entryId, digest])
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+    def _file(self, key):
+        return self.path.child(key[:2]).child(key)
+
+
+    def get(self, key):
+        """
+        Return the serialized XML of a rendered entry, or C{None}.
+        """
+        self._counter += 1
+
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            pass
+        else:
+            entry[0] = self._counter
+            self.hits += 1
+            self._count('renderHits')
+            return entry[1]
+
+        if key in self._diskEntries:
+            try:
+                xml = self._file(key).getContent().decode('utf-8')
+            except (IOError, OSError):
+                del self._diskEntries[key]
+            else:
+                self._diskEntries[key][0] = self._counter
+                self._remember(key, xml)
+                self.diskHits += 1
+                self._count('renderHits')
+                return xml
+
+        self.misses += 1
+        self._count('renderMisses')
+        return None
+
+
+    def _remember(self, key, xml):
+        self._entries[key] = [self._counter, xml]
+        if len(self._entries) > self.maxSize:
+            _evict(self._entries, self.maxSize)
+
+
+    def put(self, key, xml):
+        """
+        Keep the serialized XML of a rendered entry.
+        """
+        self._counter += 1
+        self._remember(key, xml)
+
+        if self.path is None:
+            return
+
+        try:
+            entryFile = self._file(key)
+            if not entryFile.parent().exists():
+                entryFile.parent().makedirs()
+            entryFile.setContent(xml.encode('utf-8'))
+        except (IOError, OSError):
+            log.err(None, "Could not write rendered entry to disk")
+            return
+
+        self._diskEntries[key] = [self._counter]
+        if len(self._diskEntries) > self.maxDiskSize:
+            for evicted in _evict(self._diskEntries, self.maxDiskSize):
+                try:
+                    self._file(evicted).remove()
+                except (IOError, OSError):
+                    pass
+
+
+    def stats(self):
+        """
+        Return the number of entries, hits and misses.
+
+        @rtype: C{dict}
+        """
+        return {'entries': len(self._entries),
+                'diskEntries': len(self._diskEntries),
+                'hits': self.hits,
+                'diskHits': self.diskHits,
+                'misses': self.misses}
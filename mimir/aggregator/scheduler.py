@@ -0,0 +1,167 @@
+# -*- test-case-name: mimir.aggregator.test.test_scheduler -*-
+#
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Poll scheduling.
+
+Instead of setting up a delayed call with the reactor for every feed, the
+scheduler in this module keeps the due times in a priority queue and drives
+all of them from a single delayed call for the earliest one.
+"""
+
+import heapq
+
+from twisted.python import log
+
+# Number of stale heap entries tolerated before the heap is rebuilt.
+COMPACT_THRESHOLD = 1024
+
+class PollScheduler(object):
+    """
+    Schedule calls, keyed by an identifier, using a single reactor timer.
+
+    Scheduling a key that is already scheduled replaces the earlier call.
+    Replaced and cancelled calls are only marked as such, and left in the
+    heap until they surface or until the heap is compacted. This keeps both
+    scheduling and cancelling at O(log n).
+
+    @ivar callLater: function to set up a delayed call, like
+        L{IReactorTime.callLater<twisted.internet.interfaces.IReactorTime.callLater>}.
+    @ivar seconds: function returning the current time, like
+        L{IReactorTime.seconds<twisted.internet.interfaces.IReactorTime.seconds>}.
+    @ivar lagObserver: function called with the key and the delay in
+        seconds of each call, relative to when it was due, or C{None}.
+    """
+
+    lagObserver = None
+
+    def __init__(self, callLater, seconds):
+        self.callLater = callLater
+        self.seconds = seconds
+        self._heap = []
+        self._entries = {}
+        self._counter = 0
+        self._call = None
+        self._callTime = None
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def getTime(self, key):
+        """
+        Return the time the call for C{key} is due.
+
+        @raise KeyError: if there is no call scheduled for C{key}.
+        """
+        return self._entries[key][0]
+
+
+    def schedule(self, delay, key, f, *args, **kwargs):
+        """
+        Schedule a call to C{f} after C{delay} seconds, keyed by C{key}.
+
+        A call previously scheduled with the same key is cancelled.
+        """
+        self.cancel(key)
+
+        self._counter += 1
+        entry = [self.seconds() + delay, self._counter, key, f, args, kwargs]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        self._update()
+
+
+    def cancel(self, key):
+        """
+        Cancel the call scheduled for C{key}, if any.
+        """
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            return
+
+        entry[3] = None
+
+        if len(self._heap) > 2 * len(self._entries) + COMPACT_THRESHOLD:
+            self._heap = [entry for entry in self._heap
+                                if entry[3] is not None]
+            heapq.heapify(self._heap)
+
+
+    def stop(self):
+        """
+        Cancel all scheduled calls.
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+            self._callTime = None
+
+        self._heap = []
+        self._entries = {}
+
+
+    def _update(self):
+        """
+        Make sure the reactor timer fires for the earliest scheduled call.
+        """
+        while self._heap and self._heap[0][3] is None:
+            heapq.heappop(self._heap)
+
+        if not self._heap:
+            if self._call is not None:
+                self._call.cancel()
+                self._call = None
+                self._callTime = None
+            return
+
+        due = self._heap[0][0]
+        if self._call is not None:
+            if self._callTime <= due:
+                return
+            self._call.cancel()
+
+        self._callTime = due
+        self._call = self.callLater(max(0, due - self.seconds()), self._run)
+
+
+    def _run(self):
+        """
+        Run all calls that are due.
+
+        Calls are collected before any of them is run, so that calls
+        scheduled from within one of them will not run in this same pass.
+        """
+        self._call = None
+        self._callTime = None
+
+        now = self.seconds()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if entry[3] is not None:
+                due.append(entry)
+
+        for entry in due:
+            key, f, args, kwargs = entry[2:]
+            if f is None:
+                # Cancelled by one of the calls before it.
+                continue
+
+            del self._entries[key]
+            if self.lagObserver is not None:
+                self.lagObserver(key, now - entry[0])
+            try:
+                f(*args, **kwargs)
+            except:
+                log.err(None, "Error in scheduled call for %r" % (key,))
+
+        self._update()
@@ -0,0 +1,485 @@
+# -*- test-case-name: mimir.aggregator.test.test_spool -*-
+#
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Durable spool of items to be published.
+
+Fresh entries are handed to L{PublishSpool}, that writes them to a journal
+on disk before they are published. That way, the aggregator can store the
+feed as seen, without losing entries when publishing fails, the component
+is not connected or the process is stopped.
+
+Items are published in batches per node, bounded by the number of items
+and by their serialized size, so that a feed with many or large entries
+does not result in stanzas that the server refuses or that hold up the
+stream. The number of publish requests in flight is limited, in total and
+per node. Nodes take turns in sending their next batch, so that the
+entries of large feeds do not hold up those of small ones. By default, a
+node only has one request in flight at a time, so that its items are
+published in order. When publishing fails, the batch is
+retried later, with an exponential backoff per node. Items that are
+refused by the publish-subscribe service are retried a limited number of
+times. When the connection to the server is (re)initialized, the spool is
+drained.
+
+Publish requests, their latency and failures are recorded per node, when
+the requests finish.
+"""
+
+import collections
+import simplejson
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.python.filepath import FilePath
+from twisted.words.protocols.jabber.error import StanzaError
+
+from wokkel import pubsub
+from wokkel.subprotocols import XMPPHandler
+
+# Maximum number of items in a single publish request.
+BATCH_SIZE = 20
+
+# Maximum size of the serialized items in a single publish request.
+MAX_BATCH_BYTES = 64 * 1024
+
+# Maximum number of publish requests in flight, in total and per node.
+MAX_IN_FLIGHT = 10
+MAX_NODE_IN_FLIGHT = 1
+
+# Number of times a batch is tried when it is refused by the service.
+MAX_ATTEMPTS = 8
+
+# Minimum number of changes in the journal before it is rewritten.
+JOURNAL_SIZE = 1000
+
+class PublishSpool(XMPPHandler):
+    """
+    Spool of items to be published, kept in a journal.
+
+    The journal has a JSON array per line, either C{["add", seq, node,
+    itemId, xml]} for a spooled item, or C{["done", [seq, ...]]} for items
+    that were published, dropped or replaced by a later version of the
+    same item. When the journal has grown beyond L{journalSize} lines and
+    beyond the number of spooled items, and on startup, it is rewritten
+    with only the spooled items.
+
+    @ivar protocol: the publish-subscribe client to publish with.
+    @type protocol: L{pubsub.PubSubClient}
+    @ivar service: the publish-subscribe service.
+    @type service: L{JID<twisted.words.protocols.jabber.jid.JID>}
+    @ivar path: the journal, or C{None} to only keep items in memory.
+    @type path: L{FilePath}
+    @ivar batchSize: maximum number of items in a publish request.
+    @type batchSize: C{int}
+    @ivar maxBatchBytes: maximum size of the serialized items in a publish
+        request. A single item that is larger is sent on its own.
+    @type maxBatchBytes: C{int}
+    @ivar maxInFlight: maximum number of publish requests in flight.
+    @type maxInFlight: C{int}
+    @ivar maxNodeInFlight: maximum number of publish requests in flight per
+        node. If more than one, a later version of an item might be
+        published before an earlier one.
+    @type maxNodeInFlight: C{int}
+    @ivar maxAttempts: number of times a batch is tried when it is refused.
+    @type maxAttempts: C{int}
+    @ivar initialDelay: seconds before the first retry of a failed batch.
+    @ivar maxDelay: maximum number of seconds between retries.
+    @ivar factor: factor for the delay after each failed retry.
+    @ivar metrics: metrics to record publish requests in, or C{None}.
+    @type metrics: L{mimir.aggregator.metrics.Metrics}
+    @ivar connected: whether the connection to the server is initialized.
+    @type connected: C{bool}
+    @ivar inFlight: number of publish requests in flight.
+    @type inFlight: C{int}
+    """
+
+    batchSize = BATCH_SIZE
+    maxBatchBytes = MAX_BATCH_BYTES
+    maxInFlight = MAX_IN_FLIGHT
+    maxNodeInFlight = MAX_NODE_IN_FLIGHT
+    maxAttempts = MAX_ATTEMPTS
+    journalSize = JOURNAL_SIZE
+    initialDelay = 1
+    maxDelay = 300
+    factor = 2
+    metrics = None
+
+    def __init__(self, path=None, reactor=reactor):
+        XMPPHandler.__init__(self)
+        self.protocol = None
+        self.service = None
+        self.reactor = reactor
+        self.connected = False
+        self.inFlight = 0
+
+        # Spooled items by sequence number, as tuples of node, item
+        # identifier and serialized XML.
+        self._pending = {}
+        # Sequence numbers of the items waiting to be sent, per node.
+        self._queues = {}
+        # Sequence numbers of waiting items, by node and item identifier.
+        self._queued = {}
+        # Nodes with waiting items, in the order they take turns.
+        self._ready = collections.deque()
+        self._readySet = set()
+        # Number of requests in flight, per node.
+        self._nodeInFlight = {}
+        # Delay and number of attempts of failed batches, per node.
+        self._backoff = {}
+        self._retries = {}
+
+        self._seq = 0
+        self._journalLength = 0
+
+        if path is None:
+            self.path = None
+        else:
+            self.path = FilePath(path)
+            if self.path.exists():
+                self.load()
+
+
+    def __len__(self):
+        return len(self._pending)
+
+
+    def load(self):
+        """
+        Replay the journal, and rewrite it if it has finished items.
+
+        A last line without line ending was cut short while being written,
+        and is ignored.
+        """
+        self._journalLength = 0
+        fh = self.path.open()
+        try:
+            for line in fh:
+                self._journalLength += 1
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError()
+                    record = simplejson.loads(line)
+                except ValueError:
+                    log.msg("Ignoring incomplete spool entry %r" % line)
+                    continue
+
+                if record[0] == 'add':
+                    seq, node, itemId, xml = record[1:]
+                    self._add(seq, node, itemId, xml)
+                    self._seq = max(self._seq, seq)
+                elif record[0] == 'done':
+                    for seq in record[1]:
+                        self._discard(seq)
+        finally:
+            fh.close()
+
+        if self._journalLength > len(self._pending):
+            self._rewrite()
+
+
+    def _rewrite(self):
+        """
+        Write out the spooled items to a new journal.
+        """
+        tempFile = self.path.temporarySibling()
+        fh = tempFile.open('w')
+        try:
+            for seq in sorted(self._pending):
+                node, itemId, xml = self._pending[seq]
+                fh.write(simplejson.dumps(['add', seq, node, itemId, xml]) +
+                         '\n')
+        finally:
+            fh.close()
+        tempFile.moveTo(self.path)
+        self._journalLength = len(self._pending)
+
+
+    def _append(self, records):
+        """
+        Append records to the journal.
+        """
+        if self.path is None or not records:
+            return
+
+        fh = self.path.open('a')
+        try:
+            fh.writelines([simplejson.dumps(record) + '\n'
+                           for record in records])
+        finally:
+            fh.close()
+
+        self._journalLength += len(records)
+
+
+    def _compact(self):
+        """
+        Rewrite the journal if it has grown too long.
+
+        This is called after the appended records have been applied to the
+        spooled items, as the new journal is written from those.
+        """
+        if (self.path is not None and
+            self._journalLength > max(self.journalSize, len(self._pending))):
+            self._rewrite()
+
+
+    def _add(self, seq, node, itemId, xml):
+        """
+        Spool an item, replacing a waiting earlier version of it.
+
+        @return: the sequence number of the replaced item, or C{None}.
+        """
+        self._pending[seq] = (node, itemId, xml)
+
+        queue = self._queues.setdefault(node, [])
+        replaced = self._queued.get((node, itemId))
+        if replaced is not None:
+            del self._pending[replaced]
+            queue.remove(replaced)
+
+        queue.append(seq)
+        self._queued[(node, itemId)] = seq
+        self._schedule(node)
+        return replaced
+
+
+    def _discard(self, seq):
+        """
+        Remove a finished item.
+        """
+        try:
+            node, itemId, xml = self._pending.pop(seq)
+        except KeyError:
+            return
+
+        if self._queued.get((node, itemId)) == seq:
+            del self._queued[(node, itemId)]
+            queue = self._queues[node]
+            queue.remove(seq)
+            if not queue:
+                del self._queues[node]
+
+
+    def _done(self, seqs):
+        for seq in seqs:
+            self._discard(seq)
+
+        try:
+            self._append([['done', seqs]])
+            self._compact()
+        except:
+            log.err(None, "Could not record published items in spool")
+
+
+    def enqueue(self, node, items):
+        """
+        Spool items to be published to a node.
+
+        @param node: the node identifier.
+        @type node: C{unicode}
+        @param items: tuples of item identifier and serialized payload.
+        @type items: C{list}
+        @return: deferred that fires when the items have been written to
+            the journal.
+        @rtype: L{defer.Deferred}
+        """
+        records = []
+        for itemId, xml in items:
+            self._seq += 1
+            records.append(['add', self._seq, node, itemId, xml])
+
+        try:
+            self._append(records)
+        except:
+            return defer.fail()
+
+        replaced = []
+        for _, seq, node, itemId, xml in records:
+            seq = self._add(seq, node, itemId, xml)
+            if seq is not None:
+                replaced.append(seq)
+
+        if replaced:
+            self._done(replaced)
+        else:
+            try:
+                self._compact()
+            except:
+                log.err(None, "Could not rewrite spool journal")
+
+        self.drain()
+        return defer.succeed(None)
+
+
+    def _blocked(self, node):
+        """
+        Return whether a node cannot send another batch right now.
+        """
+        return (node in self._retries or
+                self._nodeInFlight.get(node, 0) >= self.maxNodeInFlight)
+
+
+    def _schedule(self, node):
+        """
+        Give a node with waiting items a turn, if it does not have one yet.
+        """
+        if (node in self._queues and node not in self._readySet and
+            not self._blocked(node)):
+            self._ready.append(node)
+            self._readySet.add(node)
+
+
+    def drain(self):
+        """
+        Send batches of waiting items, as far as the limits allow.
+        """
+        while (self.connected and self._ready and
+               self.inFlight < self.maxInFlight):
+            node = self._ready.popleft()
+            self._readySet.discard(node)
+            if node in self._queues and not self._blocked(node):
+                self._send(node)
+
+
+    def _takeBatch(self, node):
+        """
+        Take the next batch of waiting items of a node.
+
+        @return: the sequence numbers of the items in the batch.
+        @rtype: C{list}
+        """
+        queue = self._queues[node]
+        size = 0
+        count = 0
+        for seq in queue[:self.batchSize]:
+            size += len(self._pending[seq][2])
+            if count and size > self.maxBatchBytes:
+                break
+            count += 1
+
+        seqs = queue[:count]
+        del queue[:count]
+        if not queue:
+            del self._queues[node]
+        return seqs
+
+
+    def _send(self, node):
+        seqs = self._takeBatch(node)
+
+        items = []
+        for seq in seqs:
+            _, itemId, xml = self._pending[seq]
+            del self._queued[(node, itemId)]
+            items.append(pubsub.Item(itemId, xml))
+
+        self._nodeInFlight[node] = self._nodeInFlight.get(node, 0) + 1
+        self.inFlight += 1
+
+        # Let the node wait for its next turn, after the other nodes.
+        self._schedule(node)
+
+        start = self.reactor.seconds()
+        d = defer.maybeDeferred(self.protocol.publish, self.service, node,
+                                items)
+        d.addCallbacks(self._published, self._failed,
+                       callbackArgs=(node, seqs, start),
+                       errbackArgs=(node, seqs, start))
+        d.addErrback(log.err, "Unexpected error in publish spool")
+
+
+    def _finished(self, node, start, failed):
+        """
+        Account for a finished request of a node.
+        """
+        self.inFlight -= 1
+        self._nodeInFlight[node] -= 1
+        if not self._nodeInFlight[node]:
+            del self._nodeInFlight[node]
+
+        if self.metrics is not None:
+            self.metrics.increment('publishes', node)
+            self.metrics.observe('publishLatency',
+                                 self.reactor.seconds() - start, node)
+            if failed:
+                self.metrics.increment('publishErrors', node)
+
+
+    def _published(self, result, node, seqs, start):
+        self._finished(node, start, False)
+        self._backoff.pop(node, None)
+        self._done(seqs)
+        self._schedule(node)
+        self.drain()
+
+
+    def _failed(self, failure, node, seqs, start):
+        self._finished(node, start, True)
+
+        delay, attempts = self._backoff.get(node, (0, 0))
+        if failure.check(StanzaError):
+            attempts += 1
+            if attempts >= self.maxAttempts:
+                log.err(failure, "%s: Dropping %d items after %d attempts" %
+                                 (node, len(seqs), attempts))
+                self._backoff.pop(node, None)
+                self._done(seqs)
+                self._schedule(node)
+                self.drain()
+                return
+
+        # Put the batch back in front, unless a later version of an item
+        # has been spooled in the mean time.
+        queue = self._queues.setdefault(node, [])
+        requeued = []
+        replaced = []
+        for seq in seqs:
+            _, itemId, _ = self._pending[seq]
+            if (node, itemId) in self._queued:
+                replaced.append(seq)
+            else:
+                self._queued[(node, itemId)] = seq
+                requeued.append(seq)
+        queue[0:0] = requeued
+        if not queue:
+            del self._queues[node]
+        if replaced:
+            self._done(replaced)
+
+        if node in self._retries:
+            # Another batch of this node failed before.
+            return
+
+        delay = min(self.maxDelay, delay * self.factor or self.initialDelay)
+        self._backoff[node] = (delay, attempts)
+        log.msg("%s: Publishing failed, retrying in %d seconds: %s" %
+                (node, delay, failure.getErrorMessage()))
+        self._retries[node] = self.reactor.callLater(delay, self._retry, node)
+
+
+    def _retry(self, node):
+        del self._retries[node]
+        self._schedule(node)
+        self.drain()
+
+
+    def connectionInitialized(self):
+        """
+        Start draining the spool, retrying failed batches right away.
+        """
+        self.connected = True
+
+        retries, self._retries = self._retries, {}
+        for node, call in sorted(retries.iteritems()):
+            call.cancel()
+            self._schedule(node)
+
+        self.drain()
+
+
+    def connectionLost(self, reason):
+        XMPPHandler.connectionLost(self, reason)
+        self.connected = False
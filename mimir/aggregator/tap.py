@@ -5,29 +5,98 @@
 Create a aggregation service.
 """
 
+import functools
+import os
+
 from twisted.application import service
-from twisted.python import usage
+from twisted.python import log, usage
 from twisted.words.protocols.jabber.jid import JID
 
 from wokkel import component, pubsub
 from wokkel.generic import FallbackHandler
 from wokkel.iwokkel import IXMPPHandler
 
-from mimir.aggregator import aggregator
+from mimir import profiling
+from mimir.aggregator import aggregator, fetcher, metrics, parsepool
+from mimir.aggregator import rendercache, spool, writer
 
 class Options(usage.Options):
     optParameters = [
         ('feeds', None, 'feeds', 'Directory that holds the list of feeds'),
+        ('storage', None, 'file',
+            'Storage for feeds: file (in FEEDS) or sqlite (in DATABASE)'),
+        ('storage-format', None, 'json',
+            'Format for cached feeds with file storage: json or compact'),
+        ('database', None, None,
+            'SQLite database for sqlite storage [default: FEEDS/feeds.sqlite]. '
+            'Until an import has finished, the feeds in FEEDS are imported'),
         ('jid', None, 'aggregator', 'JID of this component'),
         ('secret', None, 'secret', 'Secret to connect to upstream server'),
         ('rhost', None, '127.0.0.1', 'Upstream server address'),
         ('rport', None, '5347', 'Upstream server port'),
         ('service', None, None, 'Publish subscribe service JID'),
         ('web-port', None, None, 'Port to listen for HTTP interface service'),
+        ('placement', None, 'spread',
+            'Placement of first polls after startup: spread or stagger'),
+        ('min-interval', None, aggregator.MIN_INTERVAL,
+            'Minimum polling interval in seconds', int),
+        ('max-interval', None, aggregator.MAX_INTERVAL,
+            'Maximum polling interval in seconds', int),
+        ('max-fetches', None, fetcher.MAX_FETCHES,
+            'Maximum number of concurrent feed retrievals', int),
+        ('max-host-fetches', None, fetcher.MAX_HOST_FETCHES,
+            'Maximum number of concurrent feed retrievals per host', int),
+        ('validators', None, None,
+            'File to keep HTTP validators in [default: FEEDS/validators.json]'),
+        ('validator-cache-size', None, fetcher.VALIDATOR_CACHE_SIZE,
+            'Maximum number of URLs to keep HTTP validators for', int),
+        ('max-body-size', None, fetcher.MAX_BODY_SIZE,
+            'Maximum size in bytes of a (decoded) feed document', int),
+        ('connect-timeout', None, fetcher.CONNECT_TIMEOUT,
+            'Seconds to wait for a connection to a feed\'s server', int),
+        ('fetch-timeout', None, fetcher.FETCH_TIMEOUT,
+            'Maximum number of seconds for retrieving a feed', int),
+        ('entry-fields', None, ','.join(aggregator.ENTRY_FIELDS),
+            'Comma separated entry fields that are compared to detect '
+            'updated entries'),
+        ('writer', None, 'reconstitute',
+            'Writer for published Atom entries: reconstitute or direct'),
+        ('parsers', None, 0,
+            'Number of worker processes for parsing feeds, 0 to parse '
+            'in-process', int),
+        ('spool', None, None,
+            'File to spool items to be published in '
+            '[default: FEEDS/spool.journal]'),
+        ('max-publishes', None, spool.MAX_IN_FLIGHT,
+            'Maximum number of concurrent publish requests', int),
+        ('max-node-publishes', None, spool.MAX_NODE_IN_FLIGHT,
+            'Maximum number of concurrent publish requests per node', int),
+        ('publish-batch-size', None, spool.BATCH_SIZE,
+            'Maximum number of items in a publish request', int),
+        ('publish-batch-bytes', None, spool.MAX_BATCH_BYTES,
+            'Maximum size in bytes of the items in a publish request', int),
+        ('render-cache-size', None, rendercache.RENDER_CACHE_SIZE,
+            'Number of rendered entries to keep in memory, 0 to not cache '
+            'rendered entries', int),
+        ('render-cache-dir', None, None,
+            'Directory to also keep rendered entries in'),
+        ('render-disk-cache-size', None, rendercache.RENDER_DISK_CACHE_SIZE,
+            'Number of rendered entries to keep on disk', int),
+        ('profile-output', None, None,
+            'File to append profiling reports to [default: the log]'),
+        ('profile-top', None, profiling.TOP,
+            'Number of feeds, stages and calls in profiling reports', int),
     ]
 
     optFlags = [
         ('verbose', 'v', 'Show traffic'),
+        ('profile', None, 'Time the stages of aggregating feeds. SIGUSR2 '
+                          'writes a report and toggles sampling with '
+                          'cProfile, as does /profile over HTTP. SIGUSR1 '
+                          'still rotates the log'),
+        ('fast-parser', None, 'Parse well-formed Atom 1.0 and RSS 2.0 feeds '
+                              'with a fast parser, falling back to the '
+                              'Universal Feed Parser'),
     ]
 
     def postOptions(self):
@@ -36,10 +105,54 @@ class Options(usage.Options):
         except ValueError:
             pass
 
+        if self['storage'] not in ('file', 'sqlite'):
+            raise usage.UsageError("Unknown storage %r" % self['storage'])
+
+        if self['database'] is None:
+            self['database'] = os.path.join(self['feeds'], 'feeds.sqlite')
+
+        if self['storage-format'] not in aggregator.FEED_FORMATS:
+            raise usage.UsageError("Unknown storage format %r" %
+                                   self['storage-format'])
+
+        if self['placement'] not in aggregator.PLACEMENTS:
+            raise usage.UsageError("Unknown placement %r" %
+                                   self['placement'])
+
+        if not 0 < self['min-interval'] <= self['max-interval']:
+            raise usage.UsageError("Invalid polling interval bounds")
+
+        if self['max-fetches'] < 1 or self['max-host-fetches'] < 1:
+            raise usage.UsageError("Fetch limits must be at least 1")
+
+        self['entry-fields'] = tuple([field.strip() for field
+                                      in self['entry-fields'].split(',')
+                                      if field.strip()])
+        if not self['entry-fields']:
+            raise usage.UsageError("No entry fields to compare")
+
+        if self['writer'] not in writer.WRITERS:
+            raise usage.UsageError("Unknown writer %r" % self['writer'])
+
+        if self['validators'] is None:
+            self['validators'] = os.path.join(self['feeds'], 'validators.json')
+
+        if self['spool'] is None:
+            self['spool'] = os.path.join(self['feeds'], 'spool.journal')
+
+        if min(self['max-publishes'], self['max-node-publishes'],
+               self['publish-batch-size'], self['publish-batch-bytes']) < 1:
+            raise usage.UsageError("Publish limits must be at least 1")
+
 
 def makeService(config):
     s = service.MultiService()
 
+    if config['profile']:
+        profiler = profiling.Profiler(config['profile-top'])
+        profiling.ProfilerService(profiler,
+                                  config['profile-output']).setServiceParent(s)
+
     # create XMPP external component
     cs = component.Component(config['rhost'], config['rport'],
                              config['jid'], config['secret'])
@@ -58,13 +171,66 @@ def makeService(config):
     publisher.setHandlerParent(cs)
 
     # create aggregation service 
-    storage = aggregator.FileFeedStorage(config['feeds'])
+    if config['storage'] == 'sqlite':
+        def imported(count):
+            if count is not None:
+                log.msg("Imported %d feeds from %s" % (count, config['feeds']))
+
+        storage = aggregator.SQLiteFeedStorage.connect(config['database'])
+        if os.path.exists(os.path.join(config['feeds'], 'feeds')):
+            d = storage.migrateFeeds(config['feeds'])
+            d.addCallback(imported)
+            d.addErrback(log.err, "Could not import feeds")
+    else:
+        storage = aggregator.FileFeedStorage(config['feeds'],
+                                             config['storage-format'])
     ag = aggregator.AggregatorService(storage)
+    ag.placement = config['placement']
+    ag.minInterval = config['min-interval']
+    ag.maxInterval = config['max-interval']
+    ag.entryFields = config['entry-fields']
+    cache = fetcher.ValidatorCache(config['validators'],
+                                   config['validator-cache-size'])
+    client = fetcher.FeedClient(maxPersistentPerHost=config['max-host-fetches'],
+                                cache=cache,
+                                maxBodySize=config['max-body-size'],
+                                connectTimeout=config['connect-timeout'],
+                                timeout=config['fetch-timeout'])
+    if config['parsers'] > 0:
+        pool = parsepool.ParserPool(config['parsers'])
+        pool.fast = config['fast-parser']
+        pool.setServiceParent(s)
+        client.parser = pool.parse
+    elif config['fast-parser']:
+        client.parser = functools.partial(fetcher.parseFeed, fast=True)
+    client.metrics = ag.metrics
+    ag.dispatcher = fetcher.FetchDispatcher(config['max-fetches'],
+                                            config['max-host-fetches'],
+                                            client)
     ag.setServiceParent(s)
 
     # set up feed handler from publisher
     ag.handler = aggregator.IFeedHandler(publisher)
     ag.handler.service = JID(config['service'])
+    ag.handler.writer = writer.WRITERS[config['writer']]()
+    if config['render-cache-size'] > 0:
+        renderCache = rendercache.RenderCache(config['render-cache-size'],
+                                              config['render-cache-dir'],
+                                              config['render-disk-cache-size'])
+        renderCache.metrics = ag.metrics
+        ag.handler.renderCache = renderCache
+
+    # spool items to be published, draining it when connected
+    publishSpool = spool.PublishSpool(config['spool'])
+    publishSpool.protocol = publisher
+    publishSpool.service = ag.handler.service
+    publishSpool.maxInFlight = config['max-publishes']
+    publishSpool.maxNodeInFlight = config['max-node-publishes']
+    publishSpool.batchSize = config['publish-batch-size']
+    publishSpool.maxBatchBytes = config['publish-batch-bytes']
+    publishSpool.metrics = ag.metrics
+    publishSpool.setHandlerParent(cs)
+    ag.handler.spool = publishSpool
 
     # set up XMPP handler to interface with aggregator
     IXMPPHandler(ag).setHandlerParent(cs)
@@ -76,6 +242,9 @@ def makeService(config):
 
     root = resource.Resource()
     root.child_setfeed = aggregator.AddFeedResource(ag)
+    root.child_metrics = metrics.MetricsResource(ag.metrics)
+    if config['profile']:
+        root.child_profile = aggregator.ProfileResource(profiler)
     site = server.Site(root)
     w = internet.TCPServer(int(config['web-port']), channel.HTTPFactory(site))
     w.setServiceParent(s)
@@ -1,11 +1,35 @@
 # Copyright (c) 2005-2008 Ralph Meijer
 # See LICENSE for details
 
-from twisted.internet import defer
+import simplejson
+import zlib
+
+from twisted.internet import defer, task
+from twisted.python.filepath import FilePath
 from twisted.trial import unittest
+from twisted.web import error
+from twisted.web2 import responsecode
 from twisted.words.protocols.jabber import xmlstream
 
-from mimir.aggregator import aggregator
+from mimir import profiling
+from mimir.aggregator import aggregator, fetcher
+from mimir.aggregator.test.test_metrics import DummyRequest
+from mimir.monitor.news import FeedParserEncoder
+
+FEED = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Example Feed</title>
+  <id>urn:example:feed</id>
+  <updated>2012-05-10T12:00:00Z</updated>
+  <entry>
+    <title>First entry</title>
+    <id>urn:example:entry1</id>
+    <link href="http://example.org/1"/>
+    <updated>2012-05-10T12:00:00Z</updated>
+    <summary>Summary of the first entry.</summary>
+  </entry>
+</feed>
+"""
 
 class DummyManager(object):
     def __init__(self):
@@ -15,33 +39,156 @@ class DummyManager(object):
         self.outlist.append(obj)
 
 
+class DummyNodeHandler(object):
+    def __init__(self):
+        self.checked = []
+
+    def checkNodes(self, handles):
+        self.checked.extend(handles)
+        return defer.succeed([(True, 'mimir/news/%s' % handle)
+                              for handle in handles])
+
+
 class DummyAggregator(object):
     def __init__(self):
         self.feeds = {}
+        self.handler = DummyNodeHandler()
 
     def setFeed(self, handle, url):
         self.feeds[handle] = url
         return defer.succeed({'handle': handle, 'url': url})
 
+    def setFeeds(self, feeds):
+        for handle, url in feeds:
+            if not aggregator.RE_HANDLE.match(handle):
+                return defer.fail(aggregator.InvalidHandleError(handle))
+
+        for handle, url in feeds:
+            self.feeds[handle] = url
+        return defer.succeed([{'handle': handle, 'url': url}
+                              for handle, url in feeds])
+
 
 class XMPPControlTest(unittest.TestCase):
-    def test_onFeed(self):
-        """
-        Test adding a feed through XMPP.
-        """
-        xc = aggregator.XMPPControl(DummyAggregator())
-        xc.parent = DummyManager()
 
+    def setUp(self):
+        self.xc = aggregator.XMPPControl(DummyAggregator())
+        self.xc.parent = DummyManager()
+
+
+    def request(self, *feeds):
         iq = xmlstream.IQ(None)
         iq['to'] = 'user1@example.org'
         iq['from'] = 'user2@example.org'
         iq.addElement(('http://mimir.ik.nu/protocol/aggregator', 'aggregator'))
-        feed = iq.aggregator.addElement('feed') 
-        feed.addElement('handle', content='test')
-        feed.addElement('url', content='http://www.example.org/')
-        xc.onFeed(iq)
+        for handle, url in feeds:
+            feed = iq.aggregator.addElement('feed')
+            feed.addElement('handle', content=handle)
+            feed.addElement('url', content=url)
+        return iq
+
+
+    def test_onFeed(self):
+        """
+        Test adding a feed through XMPP.
+        """
+        xc = self.xc
+        xc.onFeed(self.request(('test', 'http://www.example.org/')))
         self.assertEquals(xc.parent.outlist[0]['type'], 'result')
         self.assertEquals(xc.service.feeds['test'], 'http://www.example.org/')
+        self.assertEquals(['test'], xc.service.handler.checked)
+
+
+    def test_onFeedBulk(self):
+        """
+        Multiple feeds can be added in one request.
+        """
+        xc = self.xc
+        xc.onFeed(self.request(('test1', 'http://example.org/1'),
+                               ('test2', 'http://example.org/2')))
+        self.assertEquals(xc.parent.outlist[0]['type'], 'result')
+        self.assertEquals({'test1': 'http://example.org/1',
+                           'test2': 'http://example.org/2'},
+                          xc.service.feeds)
+        self.assertEquals(['test1', 'test2'], xc.service.handler.checked)
+
+
+    def test_onFeedBulkInvalidHandle(self):
+        """
+        No feed is added if one of the handles is invalid.
+        """
+        xc = self.xc
+        xc.onFeed(self.request(('test1', 'http://example.org/1'),
+                               ('!test2', 'http://example.org/2')))
+        response = xc.parent.outlist[0]
+        self.assertEquals('error', response['type'])
+        self.assertEquals('bad-request', response.error.firstChildElement().name)
+        self.assertEquals({}, xc.service.feeds)
+
+
+    def test_onFeedNone(self):
+        """
+        A request without feeds is rejected.
+        """
+        xc = self.xc
+        xc.onFeed(self.request())
+        self.assertEquals('error', xc.parent.outlist[0]['type'])
+
+
+class DummyFeedHandler(object):
+    def __init__(self):
+        self.discovered = []
+
+    def entriesDiscovered(self, handle, feed, entries):
+        self.discovered.append((handle, entries))
+        return defer.succeed(None)
+
+
+class DummyFeedClient(object):
+    """
+    Feed client that returns a fixed feed document or failure.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        self.requests = []
+
+    def getFeed(self, url, agent=None, headers=None, useCache=1, digest=None,
+                      validators=None):
+        self.requests.append((url, validators, useCache))
+        if isinstance(self.result, Exception):
+            return defer.fail(self.result)
+        elif digest == fetcher.bodyDigest(self.result):
+            return defer.fail(fetcher.Unchanged())
+        else:
+            feed = fetcher.feedparser.parse(self.result)
+            feed['status'] = '200'
+            feed['href'] = url
+            feed['digest'] = fetcher.bodyDigest(self.result)
+            return defer.succeed(feed)
+
+    def close(self):
+        return defer.succeed(None)
+
+
+class PendingFeedClient(DummyFeedClient):
+    """
+    Feed client that holds on to results until L{flush} is called.
+    """
+
+    def __init__(self, result):
+        DummyFeedClient.__init__(self, result)
+        self.pending = []
+
+    def getFeed(self, *args, **kwargs):
+        d = defer.Deferred()
+        self.pending.append((d, DummyFeedClient.getFeed(self, *args, **kwargs)))
+        return d
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        for d, result in pending:
+            result.chainDeferred(d)
 
 
 class MemoryFeedStorage(object):
@@ -57,13 +204,345 @@ class MemoryFeedStorage(object):
         self.feedList[handle] = feed
         return defer.succeed(feed)
 
+    def setFeedURLs(self, feeds):
+        return defer.gatherResults([self.setFeedURL(handle, url)
+                                    for handle, url in feeds])
+
     def getFeed(self, handle):
         return defer.succeed(self.feeds[handle])
 
     def storeFeed(self, feed):
-        self.feeds[feed['handle']] = feed
+        jsonFeed = simplejson.dumps(feed, cls=FeedParserEncoder)
+        self.feeds[feed['handle']] = simplejson.loads(jsonFeed)
         return defer.succeed(None)
 
+class FileFeedStorageTest(unittest.TestCase):
+    """
+    Tests for L{aggregator.FileFeedStorage}.
+    """
+
+    def setUp(self):
+        self.feedsDir = FilePath(self.mktemp())
+        self.feedsDir.makedirs()
+        self.feedsDir.child('feeds').setContent(
+            'test http://example.org/feed\n')
+        self.feed = {'handle': 'test',
+                     'href': 'http://example.org/feed',
+                     'interval': 900}
+
+
+    def getStorage(self, format):
+        storage = aggregator.FileFeedStorage(self.feedsDir.path, format)
+        storage.getFeedList()
+        return storage
+
+
+    def test_storeCompact(self):
+        """
+        Feeds are stored as compressed, compact JSON.
+        """
+        storage = self.getStorage('compact')
+
+        def cb(_):
+            feedFile = self.feedsDir.child('test.feed.json.z')
+            data = zlib.decompress(feedFile.getContent())
+            self.assertEquals(self.feed, simplejson.loads(data))
+            self.assertNotIn(' ', data)
+            return storage.getFeed('test')
+
+        d = storage.storeFeed(self.feed)
+        d.addCallback(cb)
+        d.addCallback(self.assertEquals, self.feed)
+        return d
+
+
+    def test_storeJSON(self):
+        """
+        Feeds are stored as JSON, replacing the previous version.
+        """
+        storage = self.getStorage('json')
+
+        def cb(_):
+            self.assertEquals(['feeds', 'test.feed.json'],
+                              sorted(self.feedsDir.listdir()))
+            return storage.getFeed('test')
+
+        d = storage.storeFeed({'handle': 'test'})
+        d.addCallback(lambda _: storage.storeFeed(self.feed))
+        d.addCallback(cb)
+        d.addCallback(self.assertEquals, self.feed)
+        return d
+
+
+    def test_convert(self):
+        """
+        Feeds in another format are read, and replaced when stored.
+        """
+        self.feedsDir.child('test.feed.json').setContent(
+            simplejson.dumps(self.feed))
+        storage = self.getStorage('compact')
+
+        def cb(feed):
+            self.assertEquals(self.feed, feed)
+            return storage.storeFeed(feed)
+
+        d = storage.getFeed('test')
+        d.addCallback(cb)
+        d.addCallback(lambda _: self.assertEquals(
+            ['feeds', 'test.feed.json.z'], sorted(self.feedsDir.listdir())))
+        return d
+
+
+    def test_corrupt(self):
+        """
+        A corrupt feed file is ignored.
+        """
+        self.feedsDir.child('test.feed.json.z').setContent('garbage')
+        storage = self.getStorage('compact')
+        d = storage.getFeed('test')
+        d.addCallback(self.assertEquals, {'handle': 'test',
+                                          'href': 'http://example.org/feed'})
+        return d
+
+
+    def test_writeOrder(self):
+        """
+        Writes are done in order, and reads wait for them.
+        """
+        storage = self.getStorage('compact')
+        for interval in xrange(10):
+            storage.storeFeed(dict(self.feed, interval=interval))
+
+        d = storage.getFeed('test')
+        d.addCallback(lambda feed: self.assertEquals(9, feed['interval']))
+        d.addCallback(lambda _: self.assertEquals({}, storage._locks))
+        return d
+
+
+
+    def test_setFeedURLJournal(self):
+        """
+        Changes to the list of feeds are appended to the journal.
+        """
+        storage = self.getStorage('json')
+
+        def cb(_):
+            self.assertEquals('test http://example.org/feed\n',
+                              self.feedsDir.child('feeds').getContent())
+            self.assertEquals('new http://example.org/new\n'
+                              'test http://example.org/moved\n',
+                              self.feedsDir.child('feeds.journal').getContent())
+
+            storage = self.getStorage('json')
+            self.assertEquals({'new': {'handle': 'new',
+                                       'href': 'http://example.org/new'},
+                               'test': {'handle': 'test',
+                                        'href': 'http://example.org/moved'}},
+                              storage.feeds)
+
+        d = storage.setFeedURL('new', 'http://example.org/new')
+        d.addCallback(lambda _: storage.setFeedURL('test',
+                                                   'http://example.org/moved'))
+        d.addCallback(cb)
+        return d
+
+
+    def test_journalCompact(self):
+        """
+        The journal is merged into the list when it grows too large.
+        """
+        storage = self.getStorage('json')
+        storage.journalSize = 2
+
+        d = defer.succeed(None)
+        for i in xrange(3):
+            d.addCallback(lambda _, i=i: storage.setFeedURL(
+                'test', 'http://example.org/%d' % i))
+
+        def cb(_):
+            self.assertFalse(self.feedsDir.child('feeds.journal').exists())
+            self.assertEquals('test http://example.org/2\n',
+                              self.feedsDir.child('feeds').getContent())
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_journalReplay(self):
+        """
+        On startup, the journal is replayed and merged, ignoring a last
+        incomplete line.
+        """
+        self.feedsDir.child('feeds.journal').setContent(
+            'test http://example.org/moved\n'
+            'new http://exa')
+
+        d = aggregator.FileFeedStorage(self.feedsDir.path).getFeedList()
+        d.addCallback(self.assertEquals,
+                      {'test': {'handle': 'test',
+                                'href': 'http://example.org/moved'}})
+        d.addCallback(lambda _: self.assertEquals(
+            'test http://example.org/moved\n',
+            self.feedsDir.child('feeds').getContent()))
+        d.addCallback(lambda _: self.assertFalse(
+            self.feedsDir.child('feeds.journal').exists()))
+        return d
+
+
+
+    def test_setFeedURLs(self):
+        """
+        Feeds set in bulk are appended to the journal at once.
+        """
+        storage = self.getStorage('json')
+        appended = []
+        self.patch(storage, '_appendFeedList', appended.append)
+
+        d = storage.setFeedURLs([('new', 'http://example.org/new'),
+                                 ('other', 'http://example.org/other')])
+        d.addCallback(lambda _: self.assertEquals(
+            [[{'handle': 'new', 'href': 'http://example.org/new'},
+              {'handle': 'other', 'href': 'http://example.org/other'}]],
+            appended))
+        d.addCallback(lambda _: self.assertEquals(3, len(storage.feeds)))
+        return d
+
+
+
+class SQLiteFeedStorageTest(unittest.TestCase):
+    """
+    Tests for L{aggregator.SQLiteFeedStorage}.
+    """
+
+    def setUp(self):
+        self.storage = aggregator.SQLiteFeedStorage.connect(self.mktemp())
+        self.feed = {'handle': 'test',
+                     'href': 'http://example.org/feed',
+                     'interval': 900}
+
+
+    def tearDown(self):
+        self.storage._dbpool.close()
+
+
+    def test_setFeedURL(self):
+        """
+        Added feeds are listed, without cached feed.
+        """
+        d = self.storage.setFeedURL('test', 'http://example.org/feed')
+        d.addCallback(lambda _: self.storage.getFeedList())
+        d.addCallback(self.assertEquals,
+                      {'test': {'handle': 'test',
+                                'href': 'http://example.org/feed'}})
+        d.addCallback(lambda _: self.storage.getFeed('test'))
+        d.addCallback(self.assertEquals, {'handle': 'test',
+                                          'href': 'http://example.org/feed'})
+        return d
+
+
+    def test_setFeedURLs(self):
+        """
+        Feeds can be added in bulk.
+        """
+        d = self.storage.setFeedURLs([('test1', 'http://example.org/1'),
+                                      ('test2', 'http://example.org/2')])
+        d.addCallback(lambda _: self.storage.getFeedList())
+        d.addCallback(lambda feeds: self.assertEquals(['test1', 'test2'],
+                                                      sorted(feeds)))
+        return d
+
+
+    def test_storeFeed(self):
+        """
+        Stored feeds are retrieved.
+        """
+        d = self.storage.setFeedURL('test', 'http://example.org/feed')
+        d.addCallback(lambda _: self.storage.storeFeed(self.feed))
+        d.addCallback(lambda _: self.storage.getFeed('test'))
+        d.addCallback(self.assertEquals, self.feed)
+        return d
+
+
+    def test_getFeedUnknown(self):
+        """
+        Retrieving an unknown feed fails.
+        """
+        d = self.storage.getFeed('test')
+        self.assertFailure(d, KeyError)
+        return d
+
+
+    def test_importFeeds(self):
+        """
+        Feeds are imported from a feeds directory, in either format.
+        """
+        feedsDir = FilePath(self.mktemp())
+        feedsDir.makedirs()
+        feedsDir.child('feeds').setContent(
+            'test http://example.org/feed\n'
+            'other http://example.org/other\n'
+            'new http://example.org/new\n')
+        feedsDir.child('test.feed.json').setContent(
+            simplejson.dumps(self.feed))
+        other = dict(self.feed, handle='other', href='http://example.org/other')
+        feedsDir.child('other.feed.json.z').setContent(
+            zlib.compress(simplejson.dumps(other)))
+
+        d = self.storage.importFeeds(feedsDir.path)
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda _: self.storage.getFeedList())
+        d.addCallback(lambda feeds: self.assertEquals(['new', 'other', 'test'],
+                                                      sorted(feeds)))
+        d.addCallback(lambda _: self.storage.getFeed('test'))
+        d.addCallback(self.assertEquals, self.feed)
+        d.addCallback(lambda _: self.storage.getFeed('other'))
+        d.addCallback(self.assertEquals, other)
+        d.addCallback(lambda _: self.storage.getFeed('new'))
+        d.addCallback(self.assertEquals, {'handle': 'new',
+                                          'href': 'http://example.org/new'})
+        return d
+
+
+    def test_migrateFeeds(self):
+        """
+        Feeds are imported once, keeping feeds already in the database.
+        """
+        feedsDir = FilePath(self.mktemp())
+        feedsDir.makedirs()
+        feedsDir.child('feeds').setContent(
+            'test http://example.org/feed\n'
+            'new http://example.org/new\n')
+
+        d = self.storage.setFeedURL('test', 'http://example.org/feed')
+        d.addCallback(lambda _: self.storage.storeFeed(self.feed))
+        d.addCallback(lambda _: self.storage.migrateFeeds(feedsDir.path))
+        d.addCallback(self.assertEquals, 2)
+        d.addCallback(lambda _: self.storage.getFeed('test'))
+        d.addCallback(self.assertEquals, self.feed)
+        d.addCallback(lambda _: self.storage.migrateFeeds(feedsDir.path))
+        d.addCallback(self.assertIdentical, None)
+        return d
+
+
+    def test_migrateFeedsRetry(self):
+        """
+        Feeds are imported again if an earlier import did not finish.
+        """
+        feedsDir = FilePath(self.mktemp())
+        feedsDir.makedirs()
+
+        d = self.storage.migrateFeeds(feedsDir.path)
+        self.assertFailure(d, IOError)
+        d.addCallback(lambda _: feedsDir.child('feeds').setContent(
+            'test http://example.org/feed\n'))
+        d.addCallback(lambda _: self.storage.migrateFeeds(feedsDir.path))
+        d.addCallback(self.assertEquals, 1)
+        d.addCallback(lambda _: self.storage.getFeedList())
+        d.addCallback(lambda feeds: self.assertEquals(['test'], list(feeds)))
+        return d
+
+
+
 class AggregatorTest(unittest.TestCase):
 
     def test_setFeed(self):
@@ -126,3 +605,829 @@ class AggregatorTest(unittest.TestCase):
         self.assertFailure(d, aggregator.InvalidHandleError)
         d.addCallback(cb)
         return d
+
+
+    def test_setFeeds(self):
+        """
+        First retrievals of feeds set in bulk are spread out.
+        """
+
+        rescheduled = {}
+
+        def reschedule(delay, handle, useCache):
+            rescheduled[handle] = delay
+
+        storage = MemoryFeedStorage()
+        agg = aggregator.AggregatorService(storage)
+        agg.reschedule = reschedule
+        agg.startService()
+
+        feeds = [('test%d' % i, 'http://example.org/%d' % i)
+                 for i in xrange(100)]
+
+        def cb(result):
+            self.assertEquals(100, len(result))
+            self.assertEquals(100, len(storage.feedList))
+            self.assertEquals(100, len(rescheduled))
+            window = 99 * aggregator.STAGGER
+            for delay in rescheduled.itervalues():
+                self.assertTrue(0 <= delay < window)
+            self.assertTrue(len(set(rescheduled.values())) > 90)
+
+        d = agg.setFeeds(feeds)
+        d.addCallback(cb)
+        return d
+
+
+    def test_setFeedsInvalidHandle(self):
+        """
+        No feeds are set if one of the handles is invalid.
+        """
+
+        storage = MemoryFeedStorage()
+        agg = aggregator.AggregatorService(storage)
+        agg.startService()
+
+        d = agg.setFeeds([('test', 'http://example.org/feed'),
+                          ('!test', 'http://example.org/feed')])
+        self.assertFailure(d, aggregator.InvalidHandleError)
+        d.addCallback(lambda _: self.assertEquals({}, storage.feedList))
+        return d
+
+
+    def test_startServiceSingleTimer(self):
+        """
+        Starting the service schedules all feeds using a single timer.
+        """
+
+        clock = task.Clock()
+        aggregated = []
+
+        storage = MemoryFeedStorage()
+        for handle in ('test1', 'test2', 'test3'):
+            storage.setFeedURL(handle, 'http://example.org/%s' % handle)
+
+        agg = aggregator.AggregatorService(storage)
+        agg._callLater = clock.callLater
+        agg._seconds = clock.seconds
+        agg.aggregate = lambda handle, useCache: aggregated.append(handle)
+        agg.startService()
+
+        self.assertEquals(1, len(clock.getDelayedCalls()))
+        self.assertEquals(3, len(agg.scheduler))
+
+        agg.stopService()
+        self.assertEquals([], clock.getDelayedCalls())
+        self.assertEquals([], aggregated)
+
+
+    def test_startServiceSpread(self):
+        """
+        First polls are spread over the interval, deterministically.
+
+        Cached feeds are not read to place the first polls.
+        """
+
+        storage = MemoryFeedStorage()
+        for i in xrange(100):
+            storage.setFeedURL('test%d' % i, 'http://example.org/%d' % i)
+        storage.getFeed = lambda handle: self.fail("Read %s" % handle)
+
+        def schedule(agg):
+            rescheduled = {}
+
+            def reschedule(delay, handle, useCache=1):
+                rescheduled[handle] = delay
+
+            agg.reschedule = reschedule
+            agg.startService()
+            return rescheduled
+
+        agg = aggregator.AggregatorService(storage)
+        delays = schedule(agg)
+
+        self.assertEquals(100, len(delays))
+        for delay in delays.itervalues():
+            self.assertTrue(0 <= delay < aggregator.INTERVAL)
+
+        # Roughly half of the feeds are in the first half of the interval
+        early = [delay for delay in delays.itervalues()
+                       if delay < aggregator.INTERVAL / 2]
+        self.assertTrue(30 < len(early) < 70)
+
+        self.assertEquals(delays, schedule(
+            aggregator.AggregatorService(storage)))
+
+
+    def test_startServiceStagger(self):
+        """
+        With stagger placement, first polls are a fixed delay apart.
+        """
+
+        storage = MemoryFeedStorage()
+        for i in xrange(3):
+            storage.setFeedURL('test%d' % i, 'http://example.org/%d' % i)
+
+        rescheduled = []
+
+        def reschedule(delay, handle, useCache=1):
+            rescheduled.append(delay)
+
+        agg = aggregator.AggregatorService(storage)
+        agg.placement = 'stagger'
+        agg.reschedule = reschedule
+        agg.startService()
+
+        self.assertEquals([5, 10, 15], rescheduled)
+
+
+
+class AdaptiveIntervalTest(unittest.TestCase):
+    """
+    Tests for adapting the polling interval of feeds.
+    """
+
+    def setUp(self):
+        self.storage = MemoryFeedStorage()
+        self.storage.setFeedURL('test', 'http://example.org/feed')
+        self.storage.feeds['test'] = {'handle': 'test',
+                                      'href': 'http://example.org/feed',
+                                      'interval': 1800}
+
+        self.rescheduled = []
+
+        def reschedule(delay, handle, useCache=1):
+            self.rescheduled.append((delay, handle))
+
+        self.agg = aggregator.AggregatorService(self.storage)
+        self.agg.handler = DummyFeedHandler()
+        self.agg.reschedule = reschedule
+
+
+    def patchFetch(self, result):
+        self.agg.dispatcher.client = DummyFeedClient(result)
+
+
+    def test_adaptIntervalBounds(self):
+        """
+        Adapted intervals stay within the configured bounds.
+        """
+        self.agg.minInterval = 600
+        self.agg.maxInterval = 3600
+        self.assertEquals(600, self.agg.adaptInterval(1000, 'fresh'))
+        self.assertEquals(1250, self.agg.adaptInterval(1000, 'stale'))
+        self.assertEquals(3600, self.agg.adaptInterval(3000, 'error'))
+
+
+    def test_fresh(self):
+        """
+        Discovering fresh entries shortens the interval, and stores it.
+        """
+        self.patchFetch(FEED)
+
+        def cb(_):
+            self.assertEquals(1, len(self.agg.handler.discovered))
+            self.assertEquals(900, self.storage.feeds['test']['interval'])
+            self.assertEquals([(900, 'test')], self.rescheduled)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+    def test_stale(self):
+        """
+        Polls without fresh entries lengthen the interval.
+        """
+        self.patchFetch(FEED)
+
+        def cb(_):
+            self.assertEquals(1, len(self.agg.handler.discovered))
+            self.assertEquals(1125, self.storage.feeds['test']['interval'])
+            self.assertEquals([(900, 'test'), (1125, 'test')],
+                              self.rescheduled)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(lambda _: self.agg.aggregate('test'))
+        d.addCallback(cb)
+        return d
+
+
+    def test_notModified(self):
+        """
+        A Not Modified response lengthens the interval, and stores it.
+        """
+        self.patchFetch(fetcher.NotModified())
+
+        def cb(_):
+            self.assertEquals(2250, self.storage.feeds['test']['interval'])
+            self.assertEquals([(2250, 'test')], self.rescheduled)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+    def test_unchanged(self):
+        """
+        An identical body skips entry detection, but lengthens the interval.
+        """
+        self.patchFetch(FEED)
+
+        def storeFeed(feed):
+            self.fail("Unexpected storeFeed %r" % (feed,))
+
+        def aggregateAgain(_):
+            self.assertEquals(fetcher.bodyDigest(FEED),
+                              self.storage.feeds['test']['digest'])
+            self.agg.handler = None
+            self.patch(self.storage, 'storeFeed', storeFeed)
+            self.agg.minInterval = self.agg.maxInterval = 900
+            return self.agg.aggregate('test')
+
+        def cb(_):
+            self.assertEquals([], self.flushLoggedErrors())
+            self.assertEquals([(900, 'test'), (900, 'test')],
+                              self.rescheduled)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(aggregateAgain)
+        d.addCallback(cb)
+        return d
+
+
+    def test_unchangedNoCache(self):
+        """
+        Without using the cache, an identical body is processed anyway.
+        """
+        self.patchFetch(FEED)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(lambda _: self.agg.aggregate('test', useCache=0))
+        d.addCallback(lambda _: self.assertEquals(
+            1125, self.storage.feeds['test']['interval']))
+        return d
+
+
+    def test_validators(self):
+        """
+        The validators of the stored feed are passed to seed the cache.
+        """
+        self.patchFetch(FEED)
+        self.storage.feeds['test']['etag'] = '"1"'
+        self.storage.feeds['test']['modified'] = [2012, 6, 12, 12, 0, 0,
+                                                  1, 164, 0]
+
+        def cb(_):
+            self.assertEquals(
+                [('http://example.org/feed',
+                  {'etag': '"1"',
+                   'last-modified': 'Tue, 12 Jun 2012 12:00:00 GMT'}, 1),
+                 ('http://example.org/feed', None, 0)],
+                self.agg.dispatcher.client.requests)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(lambda _: self.agg.aggregate('test', useCache=0))
+        d.addCallback(cb)
+        return d
+
+
+    def test_error(self):
+        """
+        Failing polls back off.
+        """
+        self.patchFetch(ValueError())
+
+        def cb(_):
+            self.assertEquals(1, len(self.flushLoggedErrors(ValueError)))
+            self.assertEquals(3600, self.storage.feeds['test']['interval'])
+            self.assertEquals([(3600, 'test')], self.rescheduled)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+
+class FindFreshEntriesTest(unittest.TestCase):
+    """
+    Tests for detecting new and updated entries.
+    """
+
+    def setUp(self):
+        self.storage = MemoryFeedStorage()
+        self.storage.setFeedURL('test', 'http://example.org/feed')
+        self.storage.feeds['test'] = {'handle': 'test',
+                                      'href': 'http://example.org/feed',
+                                      'interval': 1800}
+
+        self.agg = aggregator.AggregatorService(self.storage)
+        self.agg.handler = DummyFeedHandler()
+        self.agg.reschedule = lambda delay, handle, useCache=1: None
+
+
+    def aggregate(self, document):
+        self.agg.dispatcher.client = DummyFeedClient(document)
+        return self.agg.aggregate('test')
+
+
+    def discovered(self):
+        return [[entry.id for entry in entries]
+                for handle, entries in self.agg.handler.discovered]
+
+
+    def test_digests(self):
+        """
+        The cache keeps digests of the entries, instead of the entries.
+        """
+        def cb(_):
+            cachedFeed = self.storage.feeds['test']
+            self.assertNotIn('entries', cachedFeed)
+            self.assertEquals({'urn:example:entry1': 0},
+                              cachedFeed['indexes'])
+            self.assertEquals(['urn:example:entry1'],
+                              cachedFeed['digests'].keys())
+
+        d = self.aggregate(FEED)
+        d.addCallback(cb)
+        return d
+
+
+    def test_updated(self):
+        """
+        Changes in compared fields make an entry updated.
+        """
+        d = self.aggregate(FEED)
+        d.addCallback(lambda _: self.aggregate(
+            FEED.replace('First entry', 'First entry, revised')))
+        d.addCallback(lambda _: self.assertEquals(
+            [['urn:example:entry1'], ['urn:example:entry1']],
+            self.discovered()))
+        return d
+
+
+    def test_ignoredField(self):
+        """
+        Changes in fields that are not compared are ignored.
+        """
+        self.agg.entryFields = ('title',)
+
+        d = self.aggregate(FEED)
+        d.addCallback(lambda _: self.aggregate(
+            FEED.replace('Summary of', 'Changed summary of')))
+        d.addCallback(lambda _: self.assertEquals(
+            [['urn:example:entry1']], self.discovered()))
+        return d
+
+
+    def test_cachedEntries(self):
+        """
+        Entries cached before digests were kept are compared by digest.
+        """
+        def removeDigests(_):
+            feed = fetcher.feedparser.parse(FEED)
+            jsonFeed = simplejson.dumps(feed, cls=FeedParserEncoder)
+            cachedFeed = self.storage.feeds['test']
+            cachedFeed['entries'] = simplejson.loads(jsonFeed)['entries']
+            del cachedFeed['digests']
+
+        d = self.aggregate(FEED)
+        d.addCallback(removeDigests)
+        d.addCallback(lambda _: self.aggregate(FEED))
+        d.addCallback(lambda _: self.assertEquals(
+            [['urn:example:entry1']], self.discovered()))
+        return d
+
+
+
+class SharedFeedTest(unittest.TestCase):
+    """
+    Tests for feeds that share their URL.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.storage = MemoryFeedStorage()
+        for handle, url in (('test1', 'http://example.org/feed'),
+                            ('test2', 'http://example.org/feed/'),
+                            ('other', 'http://example.org/other')):
+            self.storage.setFeedURL(handle, url)
+            self.storage.feeds[handle] = {'handle': handle,
+                                          'href': url,
+                                          'interval': 1800}
+
+        self.agg = aggregator.AggregatorService(self.storage)
+        self.agg._callLater = self.clock.callLater
+        self.agg._seconds = self.clock.seconds
+        self.agg.handler = DummyFeedHandler()
+        self.agg.dispatcher.client = PendingFeedClient(FEED)
+        self.agg.startService()
+
+
+    def tearDown(self):
+        self.agg.scheduler.stop()
+
+
+    def test_subscribers(self):
+        """
+        Feeds are grouped by the canonical form of their URL.
+        """
+        self.assertEquals({'//example.org/feed': set(['test1', 'test2']),
+                           '//example.org/other': set(['other'])},
+                          self.agg.subscribers)
+
+
+    def test_aggregate(self):
+        """
+        Feeds with the same URL are polled together, with one retrieval.
+        """
+        def cb(_):
+            self.assertEquals(1, len(self.agg.dispatcher.client.requests))
+            self.assertEquals(['test1', 'test2'],
+                              sorted([handle for handle, _
+                                      in self.agg.handler.discovered]))
+            for handle in ('test1', 'test2'):
+                self.assertEquals(900, self.storage.feeds[handle]['interval'])
+                self.assertEquals(self.clock.seconds() + 900,
+                                  self.agg.scheduler.getTime(handle))
+            self.assertEquals(1800, self.storage.feeds['other']['interval'])
+
+        d = self.agg.aggregate('test1')
+        d.addCallback(cb)
+        self.agg.dispatcher.client.flush()
+        return d
+
+
+
+class FetchAbortedTest(unittest.TestCase):
+
+    def test_backoff(self):
+        """
+        Aborted retrievals are logged without traceback and back off.
+        """
+        storage = MemoryFeedStorage()
+        storage.setFeedURL('test', 'http://example.org/feed')
+        storage.feeds['test'] = {'handle': 'test',
+                                 'href': 'http://example.org/feed',
+                                 'interval': 1800}
+        rescheduled = []
+
+        def reschedule(delay, handle, useCache=1):
+            rescheduled.append(delay)
+
+        agg = aggregator.AggregatorService(storage)
+        agg.reschedule = reschedule
+        agg.dispatcher.client = DummyFeedClient(fetcher.BodyTooLarge(1024))
+
+        def cb(_):
+            self.assertEquals([], self.flushLoggedErrors())
+            self.assertEquals(3600, storage.feeds['test']['interval'])
+            self.assertEquals([3600], rescheduled)
+
+        d = agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+
+class NextDelayTest(unittest.TestCase):
+    """
+    Tests for honoring scheduling hints.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1336651200) # 2012-05-10 12:00:00 UTC
+        self.agg = aggregator.AggregatorService(MemoryFeedStorage())
+        self.agg._seconds = self.clock.seconds
+
+
+    def test_interval(self):
+        feed = {'interval': 1800, 'hints': {'maxAge': 600}}
+        self.assertEquals(1800, self.agg.nextDelay(feed))
+
+
+    def test_lowerBound(self):
+        feed = {'interval': 1800, 'hints': {'maxAge': 600, 'ttl': 3600}}
+        self.assertEquals(3600, self.agg.nextDelay(feed))
+
+
+    def test_capped(self):
+        self.agg.maxInterval = 7200
+        feed = {'interval': 1800, 'hints': {'retryAfter': 86400}}
+        self.assertEquals(7200, self.agg.nextDelay(feed))
+
+
+    def test_skipHours(self):
+        feed = {'interval': 1800, 'hints': {'skipHours': [12, 13]}}
+        self.assertEquals(7200, self.agg.nextDelay(feed))
+
+
+    def test_throttled(self):
+        """
+        Retry-After of throttled responses is used for the next poll.
+        """
+
+        storage = MemoryFeedStorage()
+        storage.setFeedURL('test', 'http://example.org/feed')
+        storage.feeds['test'] = {'handle': 'test',
+                                 'href': 'http://example.org/feed',
+                                 'interval': 1800}
+        rescheduled = []
+
+        def reschedule(delay, handle, useCache=1):
+            rescheduled.append(delay)
+
+        agg = aggregator.AggregatorService(storage)
+        agg.reschedule = reschedule
+        agg.dispatcher.client = DummyFeedClient(
+            fetcher.Throttled('503', hints={'retryAfter': 7200}))
+
+        def cb(_):
+            self.assertEquals(1, len(self.flushLoggedErrors(
+                                        fetcher.Throttled)))
+            self.assertEquals([7200], rescheduled)
+
+        d = agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+    def test_notModifiedKeepsFeedHints(self):
+        """
+        Not Modified responses replace the header hints, not the feed hints.
+        """
+
+        class ParsingFeedClient(DummyFeedClient):
+            def getFeed(self, url, agent=None, headers=None, useCache=1,
+                              digest=None, validators=None):
+                if isinstance(self.result, Exception):
+                    return defer.fail(self.result)
+                return defer.succeed(fetcher.parseDocument(
+                    self.result, url, '200',
+                    {'content-type': ['application/rss+xml'],
+                     'cache-control': ['max-age=600']}))
+
+        storage = MemoryFeedStorage()
+        storage.setFeedURL('test', 'http://example.org/feed')
+        storage.feeds['test'] = {'handle': 'test',
+                                 'href': 'http://example.org/feed',
+                                 'interval': 1800}
+        rescheduled = []
+
+        def reschedule(delay, handle, useCache=1):
+            rescheduled.append(delay)
+
+        agg = aggregator.AggregatorService(storage)
+        agg._seconds = self.clock.seconds
+        agg.handler = DummyFeedHandler()
+        agg.reschedule = reschedule
+        agg.dispatcher.client = ParsingFeedClient("""<?xml version="1.0"?>
+<rss version="2.0">
+  <channel>
+    <title>Example</title>
+    <link>http://example.org/</link>
+    <ttl>60</ttl>
+    <skipHours><hour>13</hour></skipHours>
+  </channel>
+</rss>
+""")
+
+        def notModified(_):
+            agg.dispatcher.client.result = fetcher.NotModified(
+                hints={'maxAge': 60})
+            return agg.aggregate('test')
+
+        def cb(_):
+            self.assertEquals({'maxAge': 60,
+                               'ttl': 3600,
+                               'skipHours': [13]},
+                              storage.feeds['test']['hints'])
+            self.assertEquals([7200, 7200], rescheduled)
+
+        d = agg.aggregate('test')
+        d.addCallback(notModified)
+        d.addCallback(cb)
+        return d
+
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    Tests for recording metrics of polls.
+    """
+
+    def setUp(self):
+        self.storage = MemoryFeedStorage()
+        self.storage.setFeedURL('test', 'http://example.org/feed')
+        self.storage.feeds['test'] = {'handle': 'test',
+                                      'href': 'http://example.org/feed',
+                                      'interval': 1800}
+
+        self.agg = aggregator.AggregatorService(self.storage)
+        self.agg.handler = DummyFeedHandler()
+        self.agg.reschedule = lambda delay, handle, useCache=1: None
+        self.metrics = self.agg.metrics
+
+
+    def patchFetch(self, result):
+        self.agg.dispatcher.client = DummyFeedClient(result)
+
+
+    def test_fresh(self):
+        """
+        Retrievals, their status, new entries and publishing are counted.
+        """
+        self.patchFetch(FEED)
+
+        def cb(_):
+            self.assertEquals(1, self.metrics.counters['fetches'])
+            self.assertEquals({'2xx': 1}, self.metrics.statuses)
+            self.assertEquals(1, self.metrics.counters['entriesNew'])
+            self.assertEquals(1, self.metrics.counters['publishes'])
+            self.assertEquals(1, self.metrics.histograms['fetchLatency'].count)
+            self.assertEquals(1,
+                              self.metrics.histograms['publishLatency'].count)
+
+            feed = self.metrics.feeds['test']
+            self.assertEquals(1, feed.counters['entriesNew'])
+            self.assertEquals({'2xx': 1}, feed.statuses)
+            self.assertEquals(1, feed.timings['fetchLatency'][0])
+
+        d = self.agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+    def test_publishLatency(self):
+        """
+        The publish latency includes the time spent in the handler.
+        """
+        clock = task.Clock()
+        self.agg._seconds = clock.seconds
+        self.patchFetch(FEED)
+
+        def entriesDiscovered(handle, feed, entries):
+            clock.advance(2)
+            return defer.succeed(None)
+
+        self.agg.handler.entriesDiscovered = entriesDiscovered
+
+        def cb(_):
+            histogram = self.metrics.histograms['publishLatency']
+            self.assertEquals(2, histogram.sum)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+    def test_notModified(self):
+        """
+        Not Modified responses are counted as such.
+        """
+        self.patchFetch(fetcher.NotModified())
+
+        def cb(_):
+            self.assertEquals(1, self.metrics.counters['notModified'])
+            self.assertEquals({'3xx': 1}, self.metrics.statuses)
+            self.assertEquals(1.0, self.metrics.notModifiedRatio())
+            self.assertEquals(0, self.metrics.counters['publishes'])
+
+        d = self.agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+    def test_error(self):
+        """
+        Failed retrievals are counted, with their HTTP status.
+        """
+        self.patchFetch(error.Error('500'))
+
+        def cb(_):
+            self.flushLoggedErrors(error.Error)
+            self.assertEquals(1, self.metrics.counters['errors'])
+            self.assertEquals({'5xx': 1}, self.metrics.statuses)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+    def test_scheduleLag(self):
+        """
+        Polls that run later than scheduled are recorded.
+        """
+        clock = task.Clock()
+        agg = aggregator.AggregatorService(MemoryFeedStorage())
+        agg._callLater = clock.callLater
+        agg._seconds = clock.seconds
+        agg.startService()
+
+        agg.scheduler.schedule(10, 'test', lambda: None)
+        clock.advance(12)
+
+        histogram = agg.metrics.histograms['scheduleLag']
+        self.assertEquals(1, histogram.count)
+        self.assertEquals(2, histogram.sum)
+        self.assertEquals([1, 2.0], agg.metrics.feeds['test'].timings[
+                                                            'scheduleLag'])
+
+
+
+class ProfilingTest(unittest.TestCase):
+    """
+    Tests for profiling the stages of polls.
+    """
+
+    def setUp(self):
+        self.storage = MemoryFeedStorage()
+        self.storage.setFeedURL('test', 'http://example.org/feed')
+        self.storage.feeds['test'] = {'handle': 'test',
+                                      'href': 'http://example.org/feed',
+                                      'interval': 1800}
+
+        self.agg = aggregator.AggregatorService(self.storage)
+        self.agg.handler = DummyFeedHandler()
+        self.agg.reschedule = lambda delay, handle, useCache=1: None
+        self.agg.dispatcher.client = DummyFeedClient(FEED)
+
+        self.profiler = profiling.Profiler()
+        profiling.install(self.profiler)
+        self.addCleanup(profiling.uninstall)
+
+
+    def test_stages(self):
+        """
+        The stages of a poll are timed for the feed.
+        """
+        def cb(_):
+            self.assertEquals(['fresh', 'store', 'work'],
+                              sorted(self.profiler.stages))
+            self.assertEquals(3, self.profiler.keys['test'].count)
+
+        d = self.agg.aggregate('test')
+        d.addCallback(cb)
+        return d
+
+
+    def test_resource(self):
+        """
+        The resource reports timings and toggles sampling.
+        """
+        resource = aggregator.ProfileResource(self.profiler)
+        self.profiler.record('work', 'test', 1.0)
+
+        response = resource.http_GET(DummyRequest({}))
+        self.assertEquals(responsecode.OK, response.code)
+
+        resource.http_POST(DummyRequest({'sampling': ['on']}))
+        self.assertNotIdentical(None, self.profiler.sampler)
+        resource.http_POST(DummyRequest({'sampling': ['off']}))
+        self.assertIdentical(None, self.profiler.sampler)
+
+        response = resource.http_POST(DummyRequest({}))
+        self.assertEquals(responsecode.BAD_REQUEST, response.code)
+
+
+
+class DummyPubSubClient(object):
+    def __init__(self):
+        self.requests = []
+
+    def createNode(self, service, node):
+        d = defer.Deferred()
+        self.requests.append((node, d))
+        return d
+
+
+
+class AtomPublisherTest(unittest.TestCase):
+
+    def test_checkNodes(self):
+        """
+        Nodes are created with a limited number of outstanding requests.
+        """
+        protocol = DummyPubSubClient()
+        publisher = aggregator.AtomPublisher(protocol)
+        publisher.nodeSemaphore = defer.DeferredSemaphore(2)
+
+        d = publisher.checkNodes(['test1', 'test2', 'test3'])
+        self.assertEquals(['mimir/news/test1', 'mimir/news/test2'],
+                          [node for node, _ in protocol.requests])
+
+        protocol.requests[0][1].callback('mimir/news/test1')
+        self.assertEquals(3, len(protocol.requests))
+        protocol.requests[1][1].errback(
+            aggregator.StanzaError('conflict'))
+        protocol.requests[2][1].errback(
+            aggregator.StanzaError('forbidden'))
+
+        def cb(results):
+            self.assertEquals([(True, 'mimir/news/test1'),
+                               (True, 'mimir/news/test2')], results[:2])
+            self.assertFalse(results[2][0])
+
+        d.addCallback(cb)
+        return d
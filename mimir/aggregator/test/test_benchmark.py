@@ -0,0 +1,106 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.benchmark}.
+"""
+
+import simplejson
+from StringIO import StringIO
+
+from twisted.python import usage
+from twisted.trial import unittest
+
+from mimir.aggregator import aggregator, benchmark
+
+class CorpusTest(unittest.TestCase):
+
+    def test_fromPath(self):
+        """
+        All feeds in the corpus are parsed and their entries counted.
+        """
+        corpus = benchmark.Corpus.fromPath()
+        names = [name for name, _ in corpus.documents]
+        self.assertIn('rss091.xml', names)
+        self.assertIn('atom03.xml', names)
+        self.assertIn('malformed.xml', names)
+        self.assertEquals(len(names), len(corpus.feeds))
+        self.assertEquals(sum([len(feed.entries) for feed in corpus.feeds]),
+                          corpus.entries)
+        self.assertTrue(corpus.entries)
+
+
+
+class MeasureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.corpus = benchmark.Corpus.fromPath()
+
+
+    def test_measure(self):
+        """
+        All available benchmarks report a rate and a retained object count.
+        """
+        for name, _ in benchmark.BENCHMARKS:
+            if not benchmark.available(name):
+                continue
+
+            result = benchmark.measure(name, self.corpus, number=1, repeat=1)
+            self.assertEquals(name, result['benchmark'])
+            self.assertEquals(self.corpus.entries, result['entries'])
+            self.assertTrue(result['rate'] > 0)
+            self.assertTrue(result['retained'] >= 0)
+
+
+    def test_freshEntries(self):
+        """
+        With a warm cache, all feeds are found stale.
+        """
+        service = aggregator.AggregatorService(None)
+        interval = service.adaptInterval(aggregator.INTERVAL, 'stale')
+
+        run = benchmark.benchmarkFreshEntries(cached=True)(self.corpus)
+        for d in run():
+            feed = self.successResultOf(d)
+            self.assertEquals(interval, feed['interval'])
+
+
+    def test_countRetained(self):
+        """
+        Objects kept alive by the result are counted, the result list not.
+        """
+        def run():
+            return [[] for _ in xrange(10)]
+
+        self.assertEquals(10, benchmark.countRetained(run))
+
+
+
+class OptionsTest(unittest.TestCase):
+
+    def test_benchmarks(self):
+        """
+        All benchmarks are run if none are given.
+        """
+        config = benchmark.Options()
+        config.parseOptions([])
+        self.assertEquals([name for name, _ in benchmark.BENCHMARKS],
+                          config['benchmarks'])
+
+
+    def test_unknownBenchmark(self):
+        """
+        Unknown benchmarks are refused.
+        """
+        config = benchmark.Options()
+        self.assertRaises(usage.UsageError, config.parseOptions, ['bogus'])
+
+
+    def test_main(self):
+        """
+        Results can be reported as JSON.
+        """
+        stdout = StringIO()
+        benchmark.main(['--json', '-n', '1', '-r', '1', 'mimir'], stdout)
+        result = simplejson.loads(stdout.getvalue())
+        self.assertEquals('mimir', result['benchmark'])
@@ -0,0 +1,375 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.fastparser}.
+
+Most tests are differential: a document is parsed by both the fast parser
+and the Universal Feed Parser, and the results must be the same.
+"""
+
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+
+from mimir.aggregator import fastparser, fetcher
+from mimir.aggregator.fetcher import feedparser
+
+FEEDS = FilePath(__file__).sibling('feeds')
+
+RSS = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"
+     xmlns:atom="http://www.w3.org/2005/Atom"
+     xmlns:dc="http://purl.org/dc/elements/1.1/"
+     xmlns:content="http://purl.org/rss/1.0/modules/content/"
+     xmlns:sy="http://purl.org/rss/1.0/modules/syndication/"
+     xmlns:wfw="http://wellformedweb.org/commentAPI/">
+  <channel>
+    <title>Caf\xc3\xa9 &amp; Bar</title>
+    <link>http://example.org/</link>
+    <atom:link rel="self" type="application/rss+xml"
+               href="http://example.org/feed.xml"/>
+    <description>News from the &lt;b&gt;caf\xc3\xa9&lt;/b&gt;</description>
+    <language>en-us</language>
+    <copyright>Copyright 2012</copyright>
+    <managingEditor>editor@example.org (The Editor)</managingEditor>
+    <webMaster>webmaster@example.org</webMaster>
+    <pubDate>Sat, 02 Jun 2012 10:00:00 GMT</pubDate>
+    <lastBuildDate>Sat, 02 Jun 2012 11:00:00 GMT</lastBuildDate>
+    <category domain="http://example.org/topics">Food</category>
+    <generator>Generator 1.0</generator>
+    <docs>/rss-spec</docs>
+    <cloud domain="rpc.example.org" port="80" path="/RPC2"
+           registerProcedure="notify" protocol="xml-rpc"/>
+    <ttl>30</ttl>
+    <sy:updatePeriod>hourly</sy:updatePeriod>
+    <sy:updateFrequency>2</sy:updateFrequency>
+    <image>
+      <url>http://example.org/logo.png</url>
+      <title>Logo</title>
+      <link>http://example.org/</link>
+      <width>88</width>
+      <height>x</height>
+      <description>The logo</description>
+    </image>
+    <skipHours><hour>1</hour><hour>2</hour></skipHours>
+    <item>
+      <title>First</title>
+      <enclosure url="http://example.org/first.mp3" length="1234"
+                 type="audio/mpeg"/>
+      <guid isPermaLink="false">first</guid>
+      <description>Summary of the &lt;i&gt;first&lt;/i&gt;.</description>
+      <content:encoded><![CDATA[<p>The first item.</p>]]></content:encoded>
+      <dc:creator>Jan</dc:creator>
+      <dc:date>2012-06-02T09:00:00Z</dc:date>
+      <category>One</category>
+      <category>One</category>
+      <category domain="http://example.org/tags"></category>
+      <comments>http://example.org/first#comments</comments>
+      <wfw:commentRss>/first/comments.xml</wfw:commentRss>
+      <custom attr="value">Custom <b>bold</b> value</custom>
+    </item>
+    <item>
+      <content:encoded>&lt;p&gt;Content first.&lt;/p&gt;</content:encoded>
+      <description>Description after content</description>
+      <guid>http://example.org/second</guid>
+      <author>jan@example.org (Jan)</author>
+      <pubDate>Fri, 01 Jun 2012 16:30:00 +0200</pubDate>
+      <pubDate>Fri, 01 Jun 2012 17:30:00 +0200</pubDate>
+    </item>
+    <item>
+      <link>http://example.org/third</link>
+      <guid>http://example.org/third-guid</guid>
+    </item>
+  </channel>
+</rss>
+"""
+
+ATOM = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xml:lang="en"
+      xml:base="http://example.com/blog/">
+  <title type="html">The &lt;em&gt;Blog&lt;/em&gt;</title>
+  <subtitle>Things</subtitle>
+  <id>tag:example.com,2012:blog</id>
+  <updated>2012-06-02T21:15:42Z</updated>
+  <link href="/"/>
+  <link rel="self" type="application/atom+xml" href="atom.xml"/>
+  <icon>icon.png</icon>
+  <rights type="text">All rights reserved</rights>
+  <generator uri="http://example.com/generator" version="1.0">Gen</generator>
+  <author>
+    <name>Author</name>
+    <email>author@example.com</email>
+    <uri>/about</uri>
+  </author>
+  <contributor>
+    <name>Helper</name>
+  </contributor>
+  <category term="blog" label="Blog"/>
+  <entry xml:lang="nl">
+    <id>tag:example.com,2012:blog-1</id>
+    <title>Eerste</title>
+    <link href="2012/06/first"/>
+    <link rel="enclosure" type="audio/mpeg" length="1234"
+          href="http://example.com/first.mp3"/>
+    <link rel="alternate" type="application/pdf" href="first.pdf"/>
+    <published>2012-06-02T21:10:00+02:00</published>
+    <updated>2012-06-02T21:15:42+02:00</updated>
+    <content type="html">&lt;p&gt;Inhoud&lt;/p&gt;</content>
+    <summary>Samenvatting</summary>
+    <author><name>Jan</name></author>
+    <contributor><name>Piet</name><email>piet@example.com</email></contributor>
+    <contributor><uri>http://example.com/klaas</uri></contributor>
+    <category term="twisted" scheme="http://example.com/tags"/>
+    <category term="twisted" scheme="http://example.com/tags"/>
+  </entry>
+  <entry xml:base="http://other.example.com/posts/">
+    <id>2</id>
+    <title type="text">Second</title>
+    <summary type="html">&lt;b&gt;Summary&lt;/b&gt;</summary>
+    <content>Plain text content</content>
+    <updated>2012-06-01T10:00:00Z</updated>
+    <link rel="alternate" type="text/html" href="second.html"/>
+    <rights xml:lang="">Mine</rights>
+  </entry>
+  <entry>
+    <id>tag:example.com,2012:blog-3</id>
+    <title>Third</title>
+    <content src="http://example.com/third.txt" type="text/plain"/>
+    <updated>not a date</updated>
+  </entry>
+</feed>
+"""
+
+def _normalize(value):
+    """
+    Turn a parse result into plain dictionaries, for comparison.
+
+    The Universal Feed Parser in use may sanitize embedded HTML, even if
+    told not to, so values with markup are compared after sanitizing.
+    """
+    if isinstance(value, (dict, feedparser.FeedParserDict)):
+        return dict([(key, _normalize(value[key])) for key in value.keys()])
+    elif isinstance(value, list):
+        return [_normalize(item) for item in value]
+    elif isinstance(value, basestring) and '<' in value:
+        value = feedparser._sanitizeHTML(value, 'utf-8')
+        if not isinstance(value, unicode):
+            value = value.decode('utf-8')
+        return value
+    else:
+        return value
+
+
+
+class ParseFastTest(unittest.TestCase):
+    """
+    Tests for L{fastparser.parseFast}, against the Universal Feed Parser.
+    """
+
+    url = 'http://example.org/feed.xml'
+
+    def resource(self, data, headers=None):
+        return fetcher.FeedResource(data, self.url, '200', headers or {})
+
+
+    def parseBoth(self, data, headers=None):
+        fast = fastparser.parseFast(self.resource(data, headers))
+        slow = feedparser.parse(self.resource(data, headers))
+        return fast, slow
+
+
+    def assertSameResult(self, data, headers=None):
+        """
+        Assert that both parsers give the same result.
+        """
+        fast, slow = self.parseBoth(data, headers)
+        for key in ('bozo', 'encoding', 'etag', 'headers', 'href',
+                    'namespaces', 'status', 'version'):
+            self.assertEquals(slow.get(key), fast.get(key), key)
+        self.assertEquals(_normalize(slow.feed), _normalize(fast.feed))
+        self.assertEquals(len(slow.entries), len(fast.entries))
+        for slowEntry, fastEntry in zip(slow.entries, fast.entries):
+            self.assertEquals(_normalize(slowEntry), _normalize(fastEntry))
+        return fast
+
+
+    def assertUnsupported(self, data, headers=None):
+        self.assertRaises(fastparser.Unsupported, fastparser.parseFast,
+                          self.resource(data, headers))
+
+
+    def test_rss(self):
+        """
+        RSS 2.0 feeds are parsed like the Universal Feed Parser does.
+        """
+        result = self.assertSameResult(RSS)
+        self.assertEquals(3, len(result.entries))
+        self.assertEquals(u'<p>The first item.</p>',
+                          result.entries[0].content[0].value)
+
+
+    def test_atom(self):
+        """
+        Atom 1.0 feeds are parsed like the Universal Feed Parser does.
+        """
+        result = self.assertSameResult(ATOM)
+        self.assertEquals('atom10', result.version)
+        self.assertEquals('nl', result.entries[0].title_detail.language)
+        self.assertEquals(u'http://other.example.com/posts/second.html',
+                          result.entries[1].link)
+
+
+    def test_corpus(self):
+        """
+        Documents in the test corpus that take the fast path are parsed
+        like the Universal Feed Parser does.
+        """
+        for name in ('atom-html.xml', 'rss2.xml', 'rss2-plain.xml'):
+            self.assertSameResult(FEEDS.child(name).getContent())
+
+
+    def test_headers(self):
+        """
+        Headers are taken into account for the encoding, base URI and
+        language.
+        """
+        data = RSS.replace('encoding="utf-8"', '').decode('utf-8')
+        data = data.encode('iso-8859-1')
+        result = self.assertSameResult(data, {
+            'content-type': ['application/rss+xml; charset=iso-8859-1'],
+            'content-location': ['http://example.org/moved/feed.xml'],
+            'content-language': ['fr'],
+            'etag': ['"abc"'],
+            'last-modified': ['Sat, 02 Jun 2012 10:00:00 GMT']})
+        self.assertEquals('iso-8859-1', result.encoding)
+        self.assertEquals(u'http://example.org/moved/first',
+                          result.entries[0].id)
+
+
+    def test_malformed(self):
+        """
+        Documents that are not well-formed are not supported.
+        """
+        self.assertUnsupported(FEEDS.child('malformed.xml').getContent())
+        self.assertUnsupported(RSS[:500])
+
+
+    def test_otherVersions(self):
+        """
+        Other versions of RSS and Atom are not supported.
+        """
+        for name in ('atom03.xml', 'rss091.xml', 'rss092.xml'):
+            self.assertUnsupported(FEEDS.child(name).getContent())
+
+
+    def test_doctype(self):
+        """
+        Documents with a document type declaration are not supported.
+        """
+        self.assertUnsupported(RSS.replace('<rss ',
+                                           '<!DOCTYPE rss>\n<rss ', 1))
+
+
+    def test_xhtml(self):
+        """
+        Inline XHTML content is not supported.
+        """
+        self.assertUnsupported(FEEDS.child('atom-xhtml.xml').getContent())
+        self.assertUnsupported(ATOM.replace('<subtitle>Things',
+                                            '<subtitle>Some <b>things</b>'))
+
+
+    def test_base64(self):
+        """
+        Base64 encoded content is not supported.
+        """
+        self.assertUnsupported(ATOM.replace('type="text/plain"/>',
+                                            'type="image/png"/>'))
+
+
+    def test_unknownNamespace(self):
+        """
+        Elements and attributes in unknown namespaces are not supported.
+        """
+        self.assertUnsupported(RSS.replace(
+            '<ttl>', '<x:y xmlns:x="http://example.org/x">z</x:y><ttl>'))
+        self.assertUnsupported(RSS.replace(
+            '<ttl>', '<ttl xmlns:x="http://example.org/x" x:y="z">'))
+
+
+    def test_unhandled(self):
+        """
+        Elements the Universal Feed Parser has handlers for, that are not
+        mirrored by the fast parser, are not supported.
+        """
+        self.assertUnsupported(RSS.replace(
+            '<ttl>', '<textInput><title>Search</title></textInput><ttl>'))
+        self.assertUnsupported(ATOM.replace(
+            '<summary>', '<source><id>other</id></source><summary>'))
+
+
+    def test_encoding(self):
+        """
+        Documents that cannot be decoded as declared are not supported.
+        """
+        self.assertUnsupported(RSS, {'content-type': ['text/xml']})
+        self.assertUnsupported(RSS, {'content-type': ['text/html']})
+
+
+    def test_handlers(self):
+        """
+        The element handlers mirror those of the Universal Feed Parser.
+        """
+        for name, handlers in (('start', fastparser._STARTS),
+                               ('end', fastparser._ENDS)):
+            for element in handlers:
+                self.assertTrue(hasattr(feedparser._FeedParserMixin,
+                                        '_%s_%s' % (name, element)),
+                                "No %s handler for %r" % (name, element))
+
+        for element in set(fastparser._STARTS) | set(fastparser._ENDS):
+            for name, handlers in (('start', fastparser._STARTS),
+                                   ('end', fastparser._ENDS)):
+                if hasattr(feedparser._FeedParserMixin,
+                           '_%s_%s' % (name, element)):
+                    self.assertIn(element, handlers)
+
+
+
+class ParseTest(unittest.TestCase):
+    """
+    Tests for L{fastparser.parse}.
+    """
+
+    def parse(self, data):
+        return fastparser.parse(fetcher.FeedResource(
+            data, 'http://example.org/feed.xml', '200', {}))
+
+
+    def test_fast(self):
+        """
+        Supported documents are parsed on the fast path.
+        """
+        result = self.parse(RSS)
+        self.assertIsInstance(result, feedparser.FeedParserDict)
+        self.assertIsInstance(result.feed, feedparser.FeedParserDict)
+        self.assertEquals(u'First', result.entries[0].title_detail.value)
+
+
+    def test_fallback(self):
+        """
+        Other documents are parsed by the Universal Feed Parser.
+        """
+        result = self.parse(FEEDS.child('malformed.xml').getContent())
+        self.assertTrue(result.bozo)
+        self.assertTrue(result.entries)
+
+
+    def test_parseDocument(self):
+        """
+        L{fetcher.parseDocument} uses the fast parser if asked to.
+        """
+        result = fetcher.parseDocument(RSS, 'http://example.org/feed.xml',
+                                       '200', {}, fast=True)
+        self.assertEquals({'ttl': 1800, 'updatePeriod': 1800,
+                           'skipHours': [1, 2]}, result.hints)
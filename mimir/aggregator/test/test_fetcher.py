@@ -0,0 +1,688 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.fetcher}.
+"""
+
+import zlib
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web import error, resource, server
+
+from mimir.aggregator import fetcher, metrics
+
+RSS = """<?xml version="1.0"?>
+<rss version="2.0"
+     xmlns:sy="http://purl.org/rss/1.0/modules/syndication/">
+  <channel>
+    <title>Example</title>
+    <link>http://example.org/</link>
+    <ttl>60</ttl>
+    <sy:updatePeriod>daily</sy:updatePeriod>
+    <sy:updateFrequency>4</sy:updateFrequency>
+    <skipHours>
+      <hour>2</hour>
+      <hour>3</hour>
+    </skipHours>
+    <item>
+      <title>Item</title>
+      <link>http://example.org/item</link>
+    </item>
+  </channel>
+</rss>
+"""
+
+class GetHeaderHintsTest(unittest.TestCase):
+
+    date = 'Thu, 10 May 2012 12:00:00 GMT'
+
+    def test_maxAge(self):
+        hints = fetcher.getHeaderHints({
+            'cache-control': ['public, max-age=600'],
+            'expires': ['Thu, 10 May 2012 13:00:00 GMT'],
+            'date': [self.date]})
+        self.assertEquals({'maxAge': 600}, hints)
+
+
+    def test_expires(self):
+        hints = fetcher.getHeaderHints({
+            'expires': ['Thu, 10 May 2012 13:00:00 GMT'],
+            'date': [self.date]})
+        self.assertEquals({'maxAge': 3600}, hints)
+
+
+    def test_noCache(self):
+        hints = fetcher.getHeaderHints({
+            'cache-control': ['no-cache, max-age=600']})
+        self.assertEquals({}, hints)
+
+
+    def test_retryAfterSeconds(self):
+        hints = fetcher.getHeaderHints({'retry-after': ['120']})
+        self.assertEquals({'retryAfter': 120}, hints)
+
+
+    def test_retryAfterDate(self):
+        hints = fetcher.getHeaderHints({
+            'retry-after': ['Thu, 10 May 2012 12:30:00 GMT'],
+            'date': [self.date]})
+        self.assertEquals({'retryAfter': 1800}, hints)
+
+
+    def test_invalid(self):
+        hints = fetcher.getHeaderHints({
+            'cache-control': ['max-age=soon'],
+            'expires': ['0'],
+            'retry-after': ['tomorrow']})
+        self.assertEquals({'maxAge': 0}, hints)
+
+
+
+class GetFeedHintsTest(unittest.TestCase):
+
+    def test_rss(self):
+        result = fetcher.feedparser.parse(RSS)
+        hints = fetcher.getFeedHints(result, RSS)
+        self.assertEquals({'ttl': 3600,
+                           'updatePeriod': 21600,
+                           'skipHours': [2, 3]}, hints)
+
+
+    def test_none(self):
+        result = fetcher.feedparser.parse('<rss version="2.0"/>')
+        self.assertEquals({}, fetcher.getFeedHints(result, ''))
+
+
+
+class GetValidatorsTest(unittest.TestCase):
+
+    def test_validators(self):
+        result = fetcher.parseDocument(
+                RSS, 'http://example.org/feed', '200',
+                {'content-type': ['application/rss+xml'],
+                 'etag': ['"1"'],
+                 'last-modified': ['Tue, 12 Jun 2012 12:00:00 GMT']})
+        self.assertEquals({'etag': '"1"',
+                           'last-modified': 'Tue, 12 Jun 2012 12:00:00 GMT'},
+                          fetcher.getValidators(result))
+
+
+    def test_stored(self):
+        """
+        Validators are also taken from a feed as stored in JSON.
+        """
+        result = {'etag': u'"1"',
+                  'modified': [2012, 6, 12, 12, 0, 0, 1, 164, 0]}
+        self.assertEquals({'etag': '"1"',
+                           'last-modified': 'Tue, 12 Jun 2012 12:00:00 GMT'},
+                          fetcher.getValidators(result))
+
+
+    def test_none(self):
+        self.assertEquals({}, fetcher.getValidators({}))
+
+
+
+class DecodeBodyTest(unittest.TestCase):
+
+    def test_gzip(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(RSS) + compressor.flush()
+        headers = {'content-encoding': ['gzip']}
+        self.assertEquals(RSS, fetcher.decodeBody(data, headers))
+        self.assertEquals({}, headers)
+
+
+    def test_deflate(self):
+        headers = {'content-encoding': ['deflate']}
+        self.assertEquals(RSS, fetcher.decodeBody(zlib.compress(RSS),
+                                                  headers))
+
+
+    def test_invalid(self):
+        headers = {'content-encoding': ['gzip']}
+        self.assertEquals(RSS, fetcher.decodeBody(RSS, headers))
+        self.assertIn('content-encoding', headers)
+
+
+
+class CanonicalURLTest(unittest.TestCase):
+
+    def test_equivalent(self):
+        """
+        URLs of the same resource have the same canonical form.
+        """
+        self.assertEquals('//example.org/feed?a=1',
+                          fetcher.canonicalURL('http://Example.org/feed?a=1'))
+        for url in ('https://example.org:443/feed/?a=1',
+                    'http://example.org:80/feed?a=1#top'):
+            self.assertEquals('//example.org/feed?a=1',
+                              fetcher.canonicalURL(url))
+
+
+    def test_different(self):
+        """
+        Ports, paths and queries distinguish resources.
+        """
+        urls = ['http://example.org/feed',
+                'http://example.org:8080/feed',
+                'http://example.org/feed/atom',
+                'http://example.org/feed?a=1',
+                'http://user@example.org/feed']
+        self.assertEquals(len(urls),
+                          len(set([fetcher.canonicalURL(url) for url in urls])))
+
+
+
+class FetchDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+
+        self.dispatcher = fetcher.FetchDispatcher(maxFetches=3,
+                                                  maxHostFetches=2,
+                                                  client=self)
+
+
+    def getFeed(self, url, *args, **kwargs):
+        d = defer.Deferred()
+        self.requests.append((url, d))
+        return d
+
+
+    def test_limits(self):
+        """
+        Retrievals beyond the global and per host limits are queued.
+        """
+        results = []
+        for url in ('http://a.example.org/1',
+                    'http://a.example.org/2',
+                    'http://a.example.org/3',
+                    'http://b.example.org/1',
+                    'http://c.example.org/1'):
+            d = self.dispatcher.getFeed(url)
+            d.addCallback(results.append)
+
+        self.assertEquals(['http://a.example.org/1',
+                           'http://a.example.org/2',
+                           'http://b.example.org/1'],
+                          [url for url, _ in self.requests])
+        self.assertEquals(2, self.dispatcher.getPending())
+
+        self.requests[0][1].callback('a1')
+        self.assertEquals('http://c.example.org/1', self.requests[3][0])
+        self.assertEquals(1, self.dispatcher.getPending())
+
+        self.requests[2][1].callback('b1')
+        self.assertEquals('http://a.example.org/3', self.requests[4][0])
+        self.assertEquals(0, self.dispatcher.getPending())
+        self.assertNotIn('b.example.org', self.dispatcher.hosts)
+
+        for _, d in self.requests[3:] + self.requests[1:2]:
+            d.callback(None)
+        self.assertEquals(['a1', 'b1', None, None, None], results)
+        self.assertEquals({}, self.dispatcher.hosts)
+
+
+    def test_coalesce(self):
+        """
+        Retrievals of the same resource share one request.
+        """
+        d1 = self.dispatcher.getFeed('http://example.org/feed')
+        d2 = self.dispatcher.getFeed('https://example.org/feed/')
+        d3 = self.dispatcher.getFeed('http://example.org/feed', useCache=0)
+        self.assertEquals(2, len(self.requests))
+
+        result = {'href': 'http://example.org/feed'}
+        self.requests[0][1].callback(result)
+        self.requests[1][1].callback(result)
+
+        d = defer.gatherResults([d1, d2, d3])
+
+        def cb(results):
+            self.assertEquals([result] * 3, results)
+            self.assertNotIdentical(results[0], results[1])
+            self.assertEquals({}, self.dispatcher.pending)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_coalesceDigest(self):
+        """
+        Retrievals expecting different digests are not coalesced.
+        """
+        self.dispatcher.getFeed('http://example.org/feed', digest='a')
+        self.dispatcher.getFeed('http://example.org/feed', digest='b')
+        self.dispatcher.getFeed('http://example.org/feed', digest='a')
+        self.assertEquals(2, len(self.requests))
+
+
+    def test_coalesceFailure(self):
+        """
+        A failed retrieval fails all that share it.
+        """
+        d1 = self.dispatcher.getFeed('http://example.org/feed')
+        d2 = self.dispatcher.getFeed('http://example.org/feed')
+        self.requests[0][1].errback(ValueError())
+        self.assertFailure(d1, ValueError)
+        self.assertFailure(d2, ValueError)
+        return defer.gatherResults([d1, d2])
+
+
+    def test_alias(self):
+        """
+        Redirect targets are recorded, for coalescing with the original.
+        """
+        d = self.dispatcher.getFeed('http://example.org/feed')
+        self.requests[0][1].callback({'href': 'http://example.com/feed'})
+        self.assertEquals({'//example.org/feed': '//example.com/feed'},
+                          self.dispatcher.aliases)
+
+        self.dispatcher.getFeed('http://example.com/feed')
+        self.dispatcher.getFeed('http://example.org/feed')
+        self.assertEquals(2, len(self.requests))
+        return d
+
+
+    def test_failure(self):
+        """
+        Failed retrievals release their slots.
+        """
+        d = self.dispatcher.getFeed('http://a.example.org/1')
+        self.requests[0][1].errback(ValueError())
+        self.assertFailure(d, ValueError)
+        self.assertEquals({}, self.dispatcher.hosts)
+        self.assertEquals(3, self.dispatcher.semaphore.tokens)
+        return d
+
+
+
+class FeedResource(resource.Resource):
+    """
+    Resource serving a feed, with support for conditional GETs.
+    """
+
+    isLeaf = True
+
+    def __init__(self, data, etag='"1"'):
+        resource.Resource.__init__(self)
+        self.data = data
+        self.etag = etag
+        self.requests = []
+
+    def render_GET(self, request):
+        self.requests.append((request.clientproto,
+                              request.transport.getPeer().port))
+        if request.setETag(self.etag):
+            return ''
+        request.setHeader('Content-Type', 'application/rss+xml')
+        return self.data
+
+
+
+class RedirectResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, code, location):
+        resource.Resource.__init__(self)
+        self.code = code
+        self.location = location
+
+    def render_GET(self, request):
+        request.setResponseCode(self.code)
+        request.setHeader('Location', self.location)
+        return ''
+
+
+
+class ThrottledResource(resource.Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setResponseCode(503)
+        request.setHeader('Retry-After', '120')
+        return ''
+
+
+
+class GzipResource(resource.Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        request.setHeader('Content-Encoding', 'gzip')
+        return compressor.compress(RSS) + compressor.flush()
+
+
+
+class EndlessResource(resource.Resource):
+    """
+    Resource that keeps sending data, until the connection is lost.
+    """
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        call = task.LoopingCall(request.write, 'x' * 8192)
+        call.start(0.01)
+        request.notifyFinish().addErrback(lambda _: call.stop())
+        return server.NOT_DONE_YET
+
+
+
+class StalledResource(resource.Resource):
+    """
+    Resource that never responds.
+    """
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.notifyFinish().addErrback(lambda _: None)
+        return server.NOT_DONE_YET
+
+
+
+class FeedClientTest(unittest.TestCase):
+    """
+    Tests for L{fetcher.FeedClient}, against a local web server.
+    """
+
+    def setUp(self):
+        self.feed = FeedResource(RSS)
+        root = resource.Resource()
+        root.putChild('feed', self.feed)
+        root.putChild('moved', RedirectResource(301, '/feed'))
+        root.putChild('found', RedirectResource(302, '/feed'))
+        root.putChild('loop', RedirectResource(302, '/loop'))
+        root.putChild('throttled', ThrottledResource())
+        root.putChild('gzip', GzipResource())
+        root.putChild('endless', EndlessResource())
+        root.putChild('stalled', StalledResource())
+
+        self.port = reactor.listenTCP(0, server.Site(root),
+                                      interface='127.0.0.1')
+        self.client = fetcher.FeedClient()
+
+
+    def tearDown(self):
+        # Let aborted responses settle, so their connections can be closed.
+        d = task.deferLater(reactor, 0, self.client.close)
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.port.getHost().port, path)
+
+
+    def test_getFeed(self):
+        """
+        A feed is retrieved and parsed.
+        """
+        def cb(result):
+            self.assertEquals('200', result.status)
+            self.assertEquals(self.url('feed'), result.href)
+            self.assertEquals(u'Example', result.feed.title)
+            self.assertEquals({'ttl': 3600,
+                               'updatePeriod': 21600,
+                               'skipHours': [2, 3]}, result.hints)
+
+        d = self.client.getFeed(self.url('feed'))
+        d.addCallback(cb)
+        return d
+
+
+    def test_metrics(self):
+        """
+        The size of response bodies and the time to parse them are recorded.
+        """
+        def cb(result):
+            self.assertEquals(len(RSS), self.client.metrics.counters['bytes'])
+            self.assertEquals(
+                    1, self.client.metrics.histograms['parseTime'].count)
+
+        self.client.metrics = metrics.Metrics()
+        d = self.client.getFeed(self.url('feed'))
+        d.addCallback(cb)
+        return d
+
+
+    def test_notModified(self):
+        """
+        A second request is conditional, over the same connection.
+        """
+        def cb(_):
+            self.assertEquals('"1"', self.client.cache[self.url('feed')]['etag'])
+            d = self.client.getFeed(self.url('feed'))
+            self.assertFailure(d, fetcher.NotModified)
+            return d
+
+        def checkConnection(_):
+            self.assertEquals(2, len(self.feed.requests))
+            first, second = self.feed.requests
+            self.assertEquals('HTTP/1.1', second[0])
+            self.assertEquals(first[1], second[1])
+
+        d = self.client.getFeed(self.url('feed'))
+        d.addCallback(cb)
+        d.addCallback(checkConnection)
+        return d
+
+
+    def test_seedCache(self):
+        """
+        Passed validators are used if the cache has none for the URL.
+        """
+        d = self.client.getFeed(self.url('feed'), validators={'etag': '"1"'})
+        self.assertFailure(d, fetcher.NotModified)
+        return d
+
+
+    def test_seedCacheKnown(self):
+        """
+        Passed validators do not replace those in the cache.
+        """
+        self.client.cache[self.url('feed')] = {'etag': '"1"'}
+        d = self.client.getFeed(self.url('feed'), validators={'etag': '"2"'})
+        self.assertFailure(d, fetcher.NotModified)
+        return d
+
+
+    def test_noCache(self):
+        """
+        Validators are not used if useCache is false.
+        """
+        d = self.client.getFeed(self.url('feed'))
+        d.addCallback(lambda _: self.client.getFeed(self.url('feed'),
+                                                    useCache=0))
+        d.addCallback(lambda result: self.assertEquals('200', result.status))
+        return d
+
+
+    def test_unchanged(self):
+        """
+        An identical body is not parsed again.
+        """
+        def cb(result):
+            self.assertEquals(fetcher.bodyDigest(RSS), result.digest)
+            d = self.client.getFeed(self.url('feed'), useCache=0,
+                                    digest=result.digest)
+            self.assertFailure(d, fetcher.Unchanged)
+            return d
+
+        d = self.client.getFeed(self.url('feed'))
+        d.addCallback(cb)
+        return d
+
+
+    def test_unchangedMoved(self):
+        """
+        An identical body is parsed if the feed moved permanently.
+        """
+        d = self.client.getFeed(self.url('moved'),
+                                digest=fetcher.bodyDigest(RSS))
+        d.addCallback(lambda result: self.assertEquals('301', result.status))
+        return d
+
+
+    def test_movedPermanently(self):
+        """
+        Permanent moves are reported in status, and cached for the target.
+        """
+        def cb(result):
+            self.assertEquals('301', result.status)
+            self.assertEquals(self.url('feed'), result.href)
+            self.assertIn(self.url('feed'), self.client.cache)
+            self.assertNotIn(self.url('moved'), self.client.cache)
+
+        d = self.client.getFeed(self.url('moved'))
+        d.addCallback(cb)
+        return d
+
+
+    def test_found(self):
+        """
+        Temporary redirects are cached for the original URL.
+        """
+        def cb(result):
+            self.assertEquals('302', result.status)
+            self.assertIn(self.url('found'), self.client.cache)
+
+        d = self.client.getFeed(self.url('found'))
+        d.addCallback(cb)
+        return d
+
+
+    def test_redirectLoop(self):
+        d = self.client.getFeed(self.url('loop'))
+        self.assertFailure(d, error.InfiniteRedirection)
+        return d
+
+
+    def test_throttled(self):
+        def cb(exc):
+            self.assertEquals('503', exc.status)
+            self.assertEquals({'retryAfter': 120}, exc.hints)
+
+        d = self.client.getFeed(self.url('throttled'))
+        self.assertFailure(d, fetcher.Throttled)
+        d.addCallback(cb)
+        return d
+
+
+    def test_notFound(self):
+        d = self.client.getFeed(self.url('missing'))
+        self.assertFailure(d, error.Error)
+        d.addCallback(lambda exc: self.assertEquals('404', exc.status))
+        return d
+
+
+    def test_gzip(self):
+        """
+        Compressed bodies are decoded while received.
+        """
+        def cb(result):
+            self.assertEquals(u'Example', result.feed.title)
+            self.assertNotIn('content-encoding', result.headers)
+
+        d = self.client.getFeed(self.url('gzip'))
+        d.addCallback(cb)
+        return d
+
+
+    def test_bodyTooLarge(self):
+        """
+        Bodies beyond the maximum size abort the retrieval.
+        """
+        self.client.maxBodySize = 100000
+        d = self.client.getFeed(self.url('endless'))
+        self.assertFailure(d, fetcher.BodyTooLarge)
+        return d
+
+
+    def test_bodyTooLargeDecoded(self):
+        """
+        The maximum size applies to the decoded body.
+        """
+        self.client.maxBodySize = len(RSS) - 1
+        d = self.client.getFeed(self.url('gzip'))
+        self.assertFailure(d, fetcher.BodyTooLarge)
+        return d
+
+
+    def test_timeout(self):
+        """
+        Retrievals that take too long fail with FetchTimeout.
+        """
+        self.client.timeout = 0.1
+        d = self.client.getFeed(self.url('stalled'))
+        self.assertFailure(d, fetcher.FetchTimeout)
+        return d
+
+
+    def test_timeoutBody(self):
+        """
+        The deadline also applies to receiving the body.
+        """
+        self.client.timeout = 0.1
+        self.client.maxBodySize = None
+        d = self.client.getFeed(self.url('endless'))
+        self.assertFailure(d, fetcher.FetchTimeout)
+        return d
+
+
+class ValidatorCacheTest(unittest.TestCase):
+
+    def test_evict(self):
+        """
+        The least recently used entries are evicted.
+        """
+        cache = fetcher.ValidatorCache(maxSize=10)
+        for i in xrange(10):
+            cache['http://example.org/%d' % i] = {'etag': str(i)}
+
+        self.assertEquals({'etag': '0'}, cache['http://example.org/0'])
+        cache['http://example.org/10'] = {'etag': '10'}
+
+        self.assertEquals(9, len(cache))
+        self.assertIn('http://example.org/0', cache)
+        self.assertNotIn('http://example.org/1', cache)
+        self.assertNotIn('http://example.org/2', cache)
+        self.assertIn('http://example.org/10', cache)
+
+
+    def test_persist(self):
+        """
+        Saved validators are loaded again, in order of use.
+        """
+        path = self.mktemp()
+        cache = fetcher.ValidatorCache(path, maxSize=2)
+        cache['http://example.org/1'] = {'etag': '1'}
+        cache['http://example.org/2'] = {'etag': '2',
+                                         'last-modified': 'yesterday'}
+        cache.get('http://example.org/1')
+        cache.save()
+
+        cache = fetcher.ValidatorCache(path)
+        self.assertEquals({'etag': '2', 'last-modified': 'yesterday'},
+                          cache['http://example.org/2'])
+
+        cache = fetcher.ValidatorCache(path, maxSize=1)
+        self.assertEquals(['http://example.org/1'], cache._entries.keys())
+
+
+    def test_corrupt(self):
+        """
+        A corrupt cache file is ignored.
+        """
+        path = self.mktemp()
+        open(path, 'w').write('{')
+        cache = fetcher.ValidatorCache(path)
+        self.assertEquals(0, len(cache))
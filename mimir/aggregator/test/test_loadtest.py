@@ -0,0 +1,225 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.loadtest}.
+"""
+
+from twisted.internet import reactor, task
+from twisted.python import usage
+from twisted.trial import unittest
+from twisted.web import error, server
+
+from mimir.aggregator import fetcher, loadtest
+
+class SelectedTest(unittest.TestCase):
+
+    def test_selected(self):
+        """
+        A fraction of the feeds is selected, spread over all of them.
+        """
+        selected = [index for index in xrange(100)
+                    if loadtest._selected(index, 0.25)]
+        self.assertEquals(25, len(selected))
+        self.assertEquals(range(3, 100, 4), selected)
+
+
+
+class FeedServerTest(unittest.TestCase):
+    """
+    Tests for L{loadtest.FeedServer}, retrieved with L{fetcher.FeedClient}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = fetcher.FeedClient()
+
+
+    def listen(self, **kwargs):
+        self.server = loadtest.FeedServer(reactor=self.clock, **kwargs)
+        self.port = reactor.listenTCP(0, server.Site(self.server),
+                                      interface='127.0.0.1')
+        self.server.baseURL = 'http://127.0.0.1:%d' % (
+                self.port.getHost().port)
+
+
+    def tearDown(self):
+        d = self.client.close()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+
+    def test_feed(self):
+        """
+        Feeds have the configured number of entries and change over time.
+        """
+        def cb(result):
+            self.assertEquals(5, len(result.entries))
+            self.assertEquals(self.server.url(1) + '/4', result.entries[0].id)
+            d = self.client.getFeed(self.server.url(1))
+            self.assertFailure(d, fetcher.NotModified)
+            return d
+
+        def changed(_):
+            self.clock.advance(60)
+            return self.client.getFeed(self.server.url(1))
+
+        def cbChanged(result):
+            self.assertEquals(5, len(result.entries))
+            self.assertEquals(self.server.url(1) + '/5', result.entries[0].id)
+            self.assertEquals({200: 2, 304: 1}, self.server.statuses)
+
+        self.listen(feeds=2, entries=5, changeInterval=60)
+        d = self.client.getFeed(self.server.url(1))
+        d.addCallback(cb)
+        d.addCallback(changed)
+        d.addCallback(cbChanged)
+        return d
+
+
+    def test_entryDates(self):
+        """
+        Entries keep the date of the change that added them.
+        """
+        def cb(result):
+            d = self.client.getFeed(self.server.url(0))
+            d.addCallback(lambda changed: (result, changed))
+            self.clock.advance(60)
+            return d
+
+        def check((result, changed)):
+            dates = dict((entry.id, entry.updated_parsed)
+                         for entry in result.entries)
+            self.assertEquals(3, len(set(dates.values())))
+            for entry in changed.entries[1:]:
+                self.assertEquals(dates[entry.id], entry.updated_parsed)
+            self.assertNotIn(changed.entries[0].updated_parsed,
+                             dates.values())
+
+        self.listen(feeds=1, entries=3, changeInterval=60)
+        d = self.client.getFeed(self.server.url(0))
+        d.addCallback(cb)
+        d.addCallback(check)
+        return d
+
+
+    def test_noValidators(self):
+        """
+        Without validators, unchanged feeds are retrieved in full.
+        """
+        def check(_):
+            self.assertEquals({200: 2}, self.server.statuses)
+
+        self.listen(feeds=1, validators='none')
+        d = self.client.getFeed(self.server.url(0))
+        d.addCallback(lambda result: self.client.getFeed(self.server.url(0),
+                                                         digest=result.digest))
+        self.assertFailure(d, fetcher.Unchanged)
+        d.addCallback(check)
+        return d
+
+
+    def test_failing(self):
+        """
+        Failing feeds respond with a server error.
+        """
+        self.listen(feeds=1, failing=1)
+        d = self.client.getFeed(self.server.url(0))
+        self.assertFailure(d, error.Error)
+        d.addCallback(lambda exc: self.assertEquals('500', exc.status))
+        return d
+
+
+    def test_unknownFeed(self):
+        """
+        Feeds beyond the configured number do not exist.
+        """
+        self.listen(feeds=1)
+        d = self.client.getFeed(self.server.url(1))
+        self.assertFailure(d, error.Error)
+        d.addCallback(lambda exc: self.assertEquals('404', exc.status))
+        return d
+
+
+
+class LagMonitorTest(unittest.TestCase):
+
+    def test_lag(self):
+        """
+        The delay of the measurement calls is recorded.
+        """
+        clock = task.Clock()
+        monitor = loadtest.LagMonitor(0.1, clock)
+        monitor.start()
+        clock.advance(0.15)
+        clock.advance(0.1)
+        monitor.stop()
+
+        self.assertEquals(2, len(monitor.samples))
+        self.assertAlmostEquals(0.05, monitor.samples[0])
+        self.assertAlmostEquals(0, monitor.samples[1])
+        self.assertAlmostEquals(50, monitor.summary()['max'])
+        self.assertEquals([], clock.getDelayedCalls())
+
+
+    def test_noSamples(self):
+        """
+        The summary of a monitor without samples has no lag.
+        """
+        monitor = loadtest.LagMonitor(0.1, task.Clock())
+        self.assertEquals(0, monitor.summary()['max'])
+
+
+
+class LoadTestTest(unittest.TestCase):
+
+    def test_run(self):
+        """
+        The aggregator retrieves and publishes the feeds served locally.
+        """
+        def cb(report):
+            # Feeds may be polled again, but they have not changed.
+            self.assertTrue(report['requests'] >= 3)
+            self.assertEquals(3, report['outcomes']['ok'])
+            self.assertEquals(3, report['parses'])
+            self.assertEquals(3, report['publishes'])
+            self.assertEquals(6, report['items'])
+            self.assertTrue(report['bytes'])
+            self.assertTrue(report['peakRSS'])
+            self.assertTrue(loadtest.formatReport(report))
+
+        feedServer = loadtest.FeedServer(feeds=3, entries=2)
+        test = loadtest.LoadTest(feedServer, minInterval=1, maxInterval=60)
+        d = test.run(1.5)
+        d.addCallback(cb)
+        return d
+
+
+    def test_maxHostFetches(self):
+        """
+        All feeds are on the same host, which is not limited by default.
+        """
+        feedServer = loadtest.FeedServer(feeds=3)
+        test = loadtest.LoadTest(feedServer, maxFetches=8)
+        self.assertEquals(8, test.service.dispatcher.maxHostFetches)
+
+
+
+class OptionsTest(unittest.TestCase):
+
+    def test_validators(self):
+        """
+        Unknown kinds of validators are refused.
+        """
+        config = loadtest.Options()
+        self.assertRaises(usage.UsageError, config.parseOptions,
+                          ['--validators', 'bogus'])
+
+
+    def test_fraction(self):
+        """
+        Fractions of feeds must be between 0 and 1.
+        """
+        config = loadtest.Options()
+        self.assertRaises(usage.UsageError, config.parseOptions,
+                          ['--slow', '2'])
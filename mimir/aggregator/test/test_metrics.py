@@ -0,0 +1,203 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.metrics}.
+"""
+
+import simplejson
+
+from twisted.trial import unittest
+from twisted.web2 import responsecode
+from twisted.web2.stream import readStream
+
+from mimir.aggregator import metrics
+
+class HistogramTest(unittest.TestCase):
+
+    def test_observe(self):
+        """
+        Values are counted in the first bucket with a bound not below them.
+        """
+        histogram = metrics.Histogram((1, 10))
+        for value in (0.5, 1, 5, 20):
+            histogram.observe(value)
+
+        self.assertEquals([2, 1, 1], histogram.counts)
+        self.assertEquals(4, histogram.count)
+        self.assertEquals(26.5, histogram.sum)
+        self.assertEquals([(1, 2), (10, 3), ('+Inf', 4)],
+                          histogram.cumulative())
+
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+
+    def test_increment(self):
+        """
+        Counters are kept in aggregate and per feed.
+        """
+        self.metrics.increment('fetches', 'test')
+        self.metrics.increment('fetches', 'other')
+        self.metrics.increment('bytes', amount=100)
+
+        self.assertEquals(2, self.metrics.counters['fetches'])
+        self.assertEquals(100, self.metrics.counters['bytes'])
+        self.assertEquals({'fetches': 1},
+                          self.metrics.feeds['test'].counters)
+
+
+    def test_countStatus(self):
+        """
+        Responses are counted by the class of their status.
+        """
+        self.metrics.countStatus('200', 'test')
+        self.metrics.countStatus(304, 'test')
+        self.metrics.countStatus('301', 'other')
+
+        self.assertEquals({'2xx': 1, '3xx': 2}, self.metrics.statuses)
+        self.assertEquals({'2xx': 1, '3xx': 1},
+                          self.metrics.feeds['test'].statuses)
+
+
+    def test_observe(self):
+        """
+        Observed values go into the histogram, and the timings of the feed.
+        """
+        self.metrics.observe('fetchLatency', 0.5, 'test')
+        self.metrics.observe('fetchLatency', 1.5, 'test')
+        self.metrics.observe('parseTime', 0.1)
+
+        self.assertEquals(2, self.metrics.histograms['fetchLatency'].count)
+        self.assertEquals([2, 2.0],
+                          self.metrics.feeds['test'].timings['fetchLatency'])
+        self.assertNotIn('parseTime', self.metrics.feeds['test'].timings)
+
+
+    def test_notModifiedRatio(self):
+        self.assertEquals(0.0, self.metrics.notModifiedRatio())
+        self.metrics.increment('fetches', amount=4)
+        self.metrics.increment('notModified')
+        self.assertEquals(0.25, self.metrics.notModifiedRatio())
+
+
+    def test_asDict(self):
+        """
+        All metrics can be serialized to JSON, with or without feeds.
+        """
+        self.metrics.increment('fetches', 'test')
+        self.metrics.observe('fetchLatency', 0.5, 'test')
+
+        result = simplejson.loads(simplejson.dumps(self.metrics.asDict()))
+        self.assertEquals(1, result['counters']['fetches'])
+        self.assertEquals(1, result['histograms']['fetchLatency']['count'])
+        self.assertEquals({'count': 1, 'sum': 0.5},
+                          result['feeds']['test']['timings']['fetchLatency'])
+
+        self.assertNotIn('feeds', self.metrics.asDict(feeds=False))
+
+
+    def test_toPrometheus(self):
+        """
+        Metrics are rendered in the Prometheus text format.
+        """
+        self.metrics.increment('fetches', 'test')
+        self.metrics.countStatus('200', 'test')
+        self.metrics.observe('fetchLatency', 0.5, 'test')
+        self.metrics.increment('bytes', amount=10)
+
+        lines = self.metrics.toPrometheus().splitlines()
+        self.assertIn('# TYPE mimir_aggregator_fetches_total counter', lines)
+        self.assertIn('mimir_aggregator_fetches_total 1', lines)
+        self.assertIn('mimir_aggregator_feed_fetches_total{handle="test"} 1',
+                      lines)
+        self.assertIn('mimir_aggregator_responses_total{class="2xx"} 1',
+                      lines)
+        self.assertIn('mimir_aggregator_fetch_latency_seconds_bucket'
+                      '{le="0.5"} 1', lines)
+        self.assertIn('mimir_aggregator_fetch_latency_seconds_bucket'
+                      '{le="+Inf"} 1', lines)
+        self.assertIn('mimir_aggregator_feed_fetch_latency_seconds_sum'
+                      '{handle="test"} 0.5', lines)
+        self.assertIn('mimir_aggregator_bytes_total 10', lines)
+        self.assertFalse([line for line in lines
+                          if line.startswith('mimir_aggregator_feed_bytes')])
+
+
+    def test_toPrometheusNoFeeds(self):
+        """
+        Metrics per feed can be left out.
+        """
+        self.metrics.increment('fetches', 'test')
+        self.assertNotIn('handle=', self.metrics.toPrometheus(feeds=False))
+
+
+    def test_escape(self):
+        """
+        Label values are escaped.
+        """
+        self.assertEquals('a\\"b\\\\c\\n', metrics._escape('a"b\\c\n'))
+
+
+
+class DummyRequest(object):
+
+    def __init__(self, args):
+        self.args = args
+
+
+
+class MetricsResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+        self.metrics.increment('fetches', 'test')
+        self.resource = metrics.MetricsResource(self.metrics)
+
+
+    def readBody(self, response):
+        data = []
+        d = readStream(response.stream, data.append)
+        d.addCallback(lambda _: ''.join(data))
+        return d
+
+
+    def test_json(self):
+        """
+        Metrics are returned as JSON by default.
+        """
+        def cb(body):
+            result = simplejson.loads(body)
+            self.assertEquals(1, result['counters']['fetches'])
+            self.assertIn('test', result['feeds'])
+
+        response = self.resource.http_GET(DummyRequest({}))
+        self.assertEquals(responsecode.OK, response.code)
+        d = self.readBody(response)
+        d.addCallback(cb)
+        return d
+
+
+    def test_prometheus(self):
+        """
+        Metrics can be requested in the Prometheus text format.
+        """
+        def cb(body):
+            self.assertIn('mimir_aggregator_fetches_total 1', body)
+            self.assertNotIn('handle=', body)
+
+        response = self.resource.http_GET(
+                DummyRequest({'format': ['prometheus'], 'feeds': ['0']}))
+        self.assertEquals(responsecode.OK, response.code)
+        d = self.readBody(response)
+        d.addCallback(cb)
+        return d
+
+
+    def test_unknownFormat(self):
+        response = self.resource.http_GET(DummyRequest({'format': ['xml']}))
+        self.assertEquals(responsecode.BAD_REQUEST, response.code)
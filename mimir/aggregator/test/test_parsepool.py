@@ -0,0 +1,222 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.parsepool}.
+"""
+
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from mimir.aggregator import parsepool
+from mimir.aggregator.test.test_fetcher import RSS
+
+class DummyProcessTransport(object):
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+
+    def closeStdin(self):
+        self.protocol.processEnded(failure.Failure(error.ProcessDone(0)))
+
+
+
+class DummyProcessReactor(task.Clock):
+    """
+    Clock that records spawned processes, without starting them.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.spawned = []
+
+
+    def spawnProcess(self, protocol, executable, args, env=None):
+        protocol.transport = DummyProcessTransport(protocol)
+        self.spawned.append(protocol)
+
+
+
+class ParserPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = parsepool.ParserPool(2)
+        self.pool.startService()
+
+
+    def tearDown(self):
+        if self.pool.running:
+            return self.pool.stopService()
+
+
+    def parse(self):
+        return self.pool.parse(RSS, 'http://example.org/feed', '200',
+                               {'content-type': ['application/rss+xml']})
+
+
+    def test_parse(self):
+        """
+        Feeds are parsed by the workers.
+        """
+        def cb(results):
+            self.assertEquals(5, len(results))
+            for result in results:
+                self.assertEquals(u'Example', result.feed.title)
+                self.assertEquals(u'Item', result.entries[0].title)
+                self.assertEquals(3600, result.hints['ttl'])
+
+        d = defer.gatherResults([self.parse() for _ in xrange(5)])
+        d.addCallback(cb)
+        return d
+
+
+    def test_fast(self):
+        """
+        With C{fast} set, the workers parse with the fast parser.
+        """
+        def cb(result):
+            self.assertEquals(u'Example', result.feed.title)
+            self.assertEquals(u'Item', result.entries[0].title)
+            self.assertEquals(3600, result.hints['ttl'])
+
+        self.pool.fast = True
+        d = self.parse()
+        d.addCallback(cb)
+        return d
+
+
+    def test_bozo(self):
+        """
+        Bozo exceptions are passed back, even if they can't be pickled.
+        """
+        def cb(result):
+            self.assertTrue(result.bozo)
+            self.assertTrue(result.bozo_exception)
+
+        d = self.pool.parse(RSS[:200], 'http://example.org/feed', '200', {})
+        d.addCallback(cb)
+        return d
+
+
+    def test_workerEnded(self):
+        """
+        When a worker dies, the request is parsed in-process.
+        """
+        def cb(result):
+            self.assertEquals(u'Example', result.feed.title)
+            self.assertEquals(2, len(self.pool.workers))
+
+        worker = self.pool.idle[-1]
+        d = self.parse()
+        worker.transport.signalProcess('KILL')
+        d.addCallback(cb)
+        return d
+
+
+    def test_timeout(self):
+        """
+        A worker that takes too long is killed, and the parse fails.
+        """
+        def ended(_):
+            self.assertNotIn(worker, self.pool.workers)
+            self.assertEquals(2, len(self.pool.workers))
+
+        self.pool.timeout = 0.5
+        worker = self.pool.idle[-1]
+        worker.transport.signalProcess('STOP')
+        d = self.parse()
+        self.assertFailure(d, parsepool.ParseTimeout)
+        d.addCallback(lambda _: worker.ended)
+        d.addCallback(ended)
+        return d
+
+
+    def test_notRunning(self):
+        """
+        Without running workers, feeds are parsed in-process.
+        """
+        def cb(result):
+            self.assertEquals(u'Example', result.feed.title)
+
+        d = self.pool.stopService()
+        d.addCallback(lambda _: self.parse())
+        d.addCallback(cb)
+        return d
+
+
+
+class ParserPoolRestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = DummyProcessReactor()
+        self.pool = parsepool.ParserPool(1, reactor=self.reactor)
+        self.pool.startService()
+
+
+    def crash(self):
+        self.reactor.spawned[-1].processEnded(
+            failure.Failure(error.ProcessTerminated(1)))
+
+
+    def test_backoff(self):
+        """
+        Workers that keep ending are restarted with an increasing delay.
+        """
+        self.crash()
+        self.assertEquals(2, len(self.reactor.spawned))
+
+        self.crash()
+        self.assertEquals(2, len(self.reactor.spawned))
+        self.reactor.advance(1)
+        self.assertEquals(3, len(self.reactor.spawned))
+
+        self.crash()
+        self.reactor.advance(1)
+        self.assertEquals(3, len(self.reactor.spawned))
+        self.reactor.advance(1)
+        self.assertEquals(4, len(self.reactor.spawned))
+
+
+    def test_backoffReset(self):
+        """
+        A worker that handled requests is restarted right away.
+        """
+        self.crash()
+        self.crash()
+        self.reactor.advance(1)
+
+        self.reactor.spawned[-1].responses = 1
+        self.crash()
+        self.assertEquals(4, len(self.reactor.spawned))
+
+
+    def test_noWorkers(self):
+        """
+        Waiting requests are parsed in-process while no worker is left.
+        """
+        self.crash()
+
+        worker = self.pool.idle.pop()
+        worker.current = defer.Deferred()
+        worker.current.addErrback(lambda _: None)
+        d = self.pool.parse(RSS, 'http://example.org/feed', '200',
+                            {'content-type': ['application/rss+xml']})
+        self.assertEquals(1, len(self.pool.queue))
+
+        self.crash()
+        d.addCallback(lambda result: self.assertEquals(u'Example',
+                                                       result.feed.title))
+        return d
+
+
+    def test_stopService(self):
+        """
+        Delayed restarts are cancelled when the pool is stopped.
+        """
+        self.crash()
+        self.crash()
+        d = self.pool.stopService()
+        self.assertEquals([], self.reactor.getDelayedCalls())
+        return d
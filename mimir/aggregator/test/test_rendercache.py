@@ -0,0 +1,153 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.rendercache}.
+"""
+
+from twisted.trial import unittest
+from twisted.words.xish import domish
+
+from mimir.aggregator import aggregator, fetcher, metrics, rendercache
+
+class RenderCacheTest(unittest.TestCase):
+
+    def test_key(self):
+        """
+        Keys differ by writer, handle, entry identifier and digest.
+        """
+        key = rendercache.RenderCache.key
+        keys = set([key('AtomWriter', 'test', u'a', 'd1'),
+                    key('MimirWriter', 'test', u'a', 'd1'),
+                    key('AtomWriter', 'other', u'a', 'd1'),
+                    key('AtomWriter', 'test', u'b\xe9', 'd1'),
+                    key('AtomWriter', 'test', u'a', 'd2')])
+        self.assertEquals(5, len(keys))
+
+
+    def test_getPut(self):
+        """
+        Entries are found after they were put, counting hits and misses.
+        """
+        cache = rendercache.RenderCache()
+        cache.metrics = metrics.Metrics()
+        self.assertIdentical(None, cache.get('k1'))
+        cache.put('k1', u'<entry/>')
+        self.assertEquals(u'<entry/>', cache.get('k1'))
+
+        self.assertEquals({'entries': 1, 'diskEntries': 0,
+                           'hits': 1, 'diskHits': 0, 'misses': 1},
+                          cache.stats())
+        self.assertEquals(1, cache.metrics.counters['renderHits'])
+        self.assertEquals(1, cache.metrics.counters['renderMisses'])
+
+
+    def test_evict(self):
+        """
+        The least recently used entries are evicted.
+        """
+        cache = rendercache.RenderCache(maxSize=10)
+        for i in xrange(10):
+            cache.put('k%d' % i, u'<entry/>')
+        cache.get('k0')
+        cache.put('k10', u'<entry/>')
+
+        self.assertEquals(9, len(cache))
+        self.assertEquals(u'<entry/>', cache.get('k0'))
+        self.assertIdentical(None, cache.get('k1'))
+
+
+    def test_disk(self):
+        """
+        Entries on disk are found by a new cache, and promoted to memory.
+        """
+        path = self.mktemp()
+        cache = rendercache.RenderCache(path=path)
+        cache.put('k1', u'<entry>\xe9</entry>')
+
+        cache = rendercache.RenderCache(path=path)
+        self.assertEquals(0, len(cache))
+        self.assertEquals(u'<entry>\xe9</entry>', cache.get('k1'))
+        self.assertEquals(1, len(cache))
+        self.assertEquals(1, cache.diskHits)
+
+
+    def test_diskEvict(self):
+        """
+        The least recently used entries are removed from disk.
+        """
+        path = self.mktemp()
+        cache = rendercache.RenderCache(maxSize=1, path=path, maxDiskSize=10)
+        for i in xrange(11):
+            cache.put('k%02d' % i, u'<entry/>')
+
+        cache = rendercache.RenderCache(path=path)
+        self.assertEquals(9, cache.stats()['diskEntries'])
+        self.assertIdentical(None, cache.get('k01'))
+        self.assertEquals(u'<entry/>', cache.get('k10'))
+
+
+
+class CountingWriter(object):
+
+    def __init__(self):
+        self.generated = 0
+
+
+    def generate(self, feed, entry):
+        self.generated += 1
+        element = domish.Element((None, 'entry'))
+        element.addElement('id', content=entry.id)
+        return element
+
+
+
+class AtomPublisherRenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = aggregator.AtomPublisher(None)
+        self.publisher.writer = CountingWriter()
+        self.publisher.renderCache = rendercache.RenderCache()
+        self.entry = fetcher.feedparser.FeedParserDict(id=u'a')
+
+
+    def test_cached(self):
+        """
+        The same version of an entry is rendered once.
+        """
+        feed = {'feed': {'title': u'Feed'}}
+        xml = self.publisher.render('test', feed, self.entry)
+        self.assertEquals(xml, self.publisher.render('test', feed, self.entry))
+        self.assertEquals(u'<entry><id>a</id></entry>', xml)
+        self.assertEquals(1, self.publisher.writer.generated)
+
+
+    def test_changed(self):
+        """
+        A changed entry is rendered again.
+        """
+        self.publisher.render('test', {}, self.entry)
+        self.entry['title'] = u'Title'
+        self.publisher.render('test', {}, self.entry)
+        self.assertEquals(2, self.publisher.writer.generated)
+
+
+    def test_feedChanged(self):
+        """
+        An entry is rendered again when the feed metadata has changed.
+        """
+        self.publisher.render('test', {'feed': {'title': u'Feed'}},
+                              self.entry)
+        self.publisher.render('test', {'feed': {'title': u'Renamed'}},
+                              self.entry)
+        self.assertEquals(2, self.publisher.writer.generated)
+
+
+    def test_otherFields(self):
+        """
+        Entry fields that are not compared for updates still count.
+        """
+        self.publisher.render('test', {}, self.entry)
+        self.entry['rights'] = u'Copyright'
+        self.publisher.render('test', {}, self.entry)
+        self.assertEquals(2, self.publisher.writer.generated)
@@ -0,0 +1,108 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.scheduler}.
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from mimir.aggregator import scheduler
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = scheduler.PollScheduler(self.clock.callLater,
+                                                 self.clock.seconds)
+        self.called = []
+
+
+    def record(self, key):
+        self.called.append((self.clock.seconds(), key))
+
+
+    def test_singleTimer(self):
+        """
+        Scheduling many calls only sets up one reactor timer.
+        """
+        for i in xrange(100):
+            self.scheduler.schedule(i + 1, i, self.record, i)
+
+        self.assertEquals(1, len(self.clock.getDelayedCalls()))
+        self.assertEquals(100, len(self.scheduler))
+
+
+    def test_order(self):
+        """
+        Calls are run in order of their due time.
+        """
+        self.scheduler.schedule(20, 'b', self.record, 'b')
+        self.scheduler.schedule(10, 'a', self.record, 'a')
+        self.scheduler.schedule(30, 'c', self.record, 'c')
+        self.clock.pump([10, 10, 10])
+        self.assertEquals([(10, 'a'), (20, 'b'), (30, 'c')], self.called)
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+
+    def test_reschedule(self):
+        """
+        Scheduling a key again replaces the earlier call.
+        """
+        self.scheduler.schedule(10, 'a', self.record, 'a')
+        self.scheduler.schedule(5, 'a', self.record, 'a')
+        self.scheduler.schedule(20, 'a', self.record, 'a')
+        self.clock.pump([5, 5, 10])
+        self.assertEquals([(20, 'a')], self.called)
+
+
+    def test_cancel(self):
+        """
+        Cancelled calls are not run.
+        """
+        self.scheduler.schedule(10, 'a', self.record, 'a')
+        self.scheduler.schedule(10, 'b', self.record, 'b')
+        self.scheduler.cancel('a')
+        self.scheduler.cancel('unknown')
+        self.assertNotIn('a', self.scheduler)
+        self.clock.advance(10)
+        self.assertEquals([(10, 'b')], self.called)
+
+
+    def test_rescheduleFromCall(self):
+        """
+        A call scheduling its own key again with no delay runs in a later pass.
+        """
+        def cb():
+            self.record('a')
+            self.scheduler.schedule(0, 'a', self.record, 'a')
+            self.assertEquals(1, len(self.called))
+            self.assertIn('a', self.scheduler)
+
+        self.scheduler.schedule(10, 'a', cb)
+        self.clock.advance(10)
+        self.assertEquals([(10, 'a'), (10, 'a')], self.called)
+
+
+    def test_stop(self):
+        """
+        Stopping the scheduler cancels all calls and the reactor timer.
+        """
+        self.scheduler.schedule(10, 'a', self.record, 'a')
+        self.scheduler.schedule(20, 'b', self.record, 'b')
+        self.scheduler.stop()
+        self.assertEquals(0, len(self.scheduler))
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+
+    def test_lagObserver(self):
+        """
+        The lag observer is told how late each call runs.
+        """
+        lags = []
+        self.scheduler.lagObserver = lambda key, lag: lags.append((key, lag))
+        self.scheduler.schedule(10, 'a', self.record, 'a')
+        self.scheduler.schedule(11, 'b', self.record, 'b')
+        self.clock.advance(12)
+        self.assertEquals([('a', 2), ('b', 1)], lags)
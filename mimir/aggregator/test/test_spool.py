@@ -0,0 +1,331 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.spool}.
+"""
+
+from twisted.internet import defer, error, task
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+from twisted.words.protocols.jabber.error import StanzaError
+from twisted.words.protocols.jabber.jid import JID
+from twisted.words.xish import domish
+
+from mimir.aggregator import aggregator, fetcher, metrics, spool
+
+class DummyPubSubClient(object):
+    """
+    Publish-subscribe client that keeps publish requests pending.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+
+    def publish(self, service, node, items):
+        d = defer.Deferred()
+        self.requests.append((node, [item['id'] for item in items], d))
+        return d
+
+
+
+class PublishSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.path = self.mktemp()
+        self.protocol = DummyPubSubClient()
+        self.spool = self.createSpool()
+
+
+    def createSpool(self):
+        publishSpool = spool.PublishSpool(self.path, reactor=self.clock)
+        publishSpool.protocol = self.protocol
+        publishSpool.service = JID('pubsub.example.org')
+        publishSpool.batchSize = 2
+        publishSpool.maxInFlight = 2
+        return publishSpool
+
+
+    def enqueue(self, node, *itemIds):
+        return self.spool.enqueue(node, [(itemId, u'<entry/>')
+                                         for itemId in itemIds])
+
+
+    def test_disconnected(self):
+        """
+        Items are spooled, but not published, while not connected.
+        """
+        self.enqueue('node1', 'a', 'b')
+        self.assertEquals(2, len(self.spool))
+        self.assertEquals([], self.protocol.requests)
+
+
+    def test_batches(self):
+        """
+        Items are published in batches, with a limited number in flight.
+        """
+        self.enqueue('node1', 'a', 'b', 'c')
+        self.enqueue('node2', 'd')
+        self.enqueue('node3', 'e')
+        self.spool.connectionInitialized()
+
+        self.assertEquals([('node1', ['a', 'b']), ('node2', ['d'])],
+                          [request[:2] for request in self.protocol.requests])
+
+        self.protocol.requests[0][2].callback(None)
+        self.assertEquals(('node3', ['e']), self.protocol.requests[2][:2])
+        self.assertEquals(3, len(self.spool))
+
+        self.protocol.requests[1][2].callback(None)
+        self.assertEquals(('node1', ['c']), self.protocol.requests[3][:2])
+
+
+    def test_batchBytes(self):
+        """
+        Batches are bounded by the size of the serialized items.
+        """
+        self.spool.batchSize = 10
+        self.spool.maxBatchBytes = 10
+        self.spool.enqueue('node1', [('a', u'<e>1</e>'),
+                                     ('b', u'<e>2</e>'),
+                                     ('c', u'<e>' + u'x' * 20 + u'</e>'),
+                                     ('d', u'<e>4</e>')])
+        self.spool.connectionInitialized()
+
+        self.assertEquals(['a'], self.protocol.requests[0][1])
+        self.protocol.requests[0][2].callback(None)
+        self.assertEquals(['b'], self.protocol.requests[1][1])
+        self.protocol.requests[1][2].callback(None)
+        self.assertEquals(['c'], self.protocol.requests[2][1])
+
+
+    def test_nodeWindow(self):
+        """
+        Nodes take turns, with a limited number of requests in flight each.
+        """
+        self.spool.batchSize = 1
+        self.spool.maxInFlight = 4
+        self.spool.maxNodeInFlight = 2
+        self.enqueue('large', 'a', 'b', 'c', 'd')
+        self.enqueue('small', 'e')
+        self.spool.connectionInitialized()
+
+        self.assertEquals([('large', ['a']), ('small', ['e']),
+                           ('large', ['b'])],
+                          [request[:2] for request in self.protocol.requests])
+
+        self.protocol.requests[0][2].callback(None)
+        self.assertEquals(('large', ['c']), self.protocol.requests[3][:2])
+        self.assertEquals(3, self.spool.inFlight)
+
+
+    def test_replaced(self):
+        """
+        A later version of a waiting item replaces it.
+        """
+        self.enqueue('node1', 'a', 'b')
+        self.enqueue('node1', 'a')
+        self.spool.connectionInitialized()
+
+        self.assertEquals([('node1', ['b', 'a'])],
+                          [request[:2] for request in self.protocol.requests])
+        self.assertEquals(2, len(self.spool))
+
+
+    def test_retry(self):
+        """
+        Failed batches are retried with an increasing delay.
+        """
+        self.enqueue('node1', 'a')
+        self.spool.connectionInitialized()
+
+        self.protocol.requests[0][2].errback(error.ConnectionLost())
+        self.assertEquals(0, self.spool.inFlight)
+        self.clock.advance(1)
+        self.assertEquals(2, len(self.protocol.requests))
+
+        self.protocol.requests[1][2].errback(error.ConnectionLost())
+        self.clock.advance(1)
+        self.assertEquals(2, len(self.protocol.requests))
+        self.clock.advance(1)
+        self.assertEquals(3, len(self.protocol.requests))
+
+        self.protocol.requests[2][2].callback(None)
+        self.assertEquals(0, len(self.spool))
+        self.assertEquals({}, self.spool._backoff)
+
+
+    def test_metrics(self):
+        """
+        Finished publish requests are recorded per node, with their latency.
+        """
+        self.spool.metrics = metrics.Metrics()
+        self.enqueue('node1', 'a')
+        self.enqueue('node2', 'b')
+        self.spool.connectionInitialized()
+        self.assertEquals(0, self.spool.metrics.counters['publishes'])
+
+        self.clock.advance(2)
+        self.protocol.requests[0][2].callback(None)
+        self.protocol.requests[1][2].errback(error.ConnectionLost())
+
+        counters = self.spool.metrics.counters
+        self.assertEquals(2, counters['publishes'])
+        self.assertEquals(1, counters['publishErrors'])
+        histogram = self.spool.metrics.histograms['publishLatency']
+        self.assertEquals(2, histogram.count)
+        self.assertEquals(4, histogram.sum)
+        feeds = self.spool.metrics.feeds
+        self.assertEquals([1, 2.0], feeds['node1'].timings['publishLatency'])
+        self.assertEquals(1, feeds['node2'].counters['publishErrors'])
+
+
+    def test_dropRefused(self):
+        """
+        Batches refused by the service are dropped after some attempts.
+        """
+        self.spool.maxAttempts = 2
+        self.enqueue('node1', 'a')
+        self.spool.connectionInitialized()
+
+        self.protocol.requests[0][2].errback(StanzaError('not-acceptable'))
+        self.clock.advance(1)
+        self.protocol.requests[1][2].errback(StanzaError('not-acceptable'))
+        self.assertEquals(1, len(self.flushLoggedErrors(StanzaError)))
+        self.assertEquals(0, len(self.spool))
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+
+    def test_reconnect(self):
+        """
+        On reconnect, batches waiting to be retried are sent right away.
+        """
+        self.enqueue('node1', 'a')
+        self.spool.connectionInitialized()
+        self.spool.connectionLost(None)
+        self.protocol.requests[0][2].errback(error.ConnectionLost())
+
+        self.spool.connectionInitialized()
+        self.assertEquals(2, len(self.protocol.requests))
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+
+    def test_replay(self):
+        """
+        Items that were not published are spooled again on startup.
+        """
+        self.enqueue('node1', 'a', 'b')
+        self.enqueue('node2', 'c')
+        self.spool.connectionInitialized()
+        self.protocol.requests[1][2].callback(None)
+
+        publishSpool = self.createSpool()
+        self.assertEquals(2, len(publishSpool))
+        journal = FilePath(self.path).getContent()
+        self.assertEquals(2, len(journal.splitlines()))
+
+        publishSpool.connectionInitialized()
+        self.assertEquals(('node1', ['a', 'b']),
+                          self.protocol.requests[2][:2])
+
+
+    def test_incompleteJournal(self):
+        """
+        A last journal line that was cut short is ignored.
+        """
+        self.enqueue('node1', 'a')
+        fh = open(self.path, 'a')
+        fh.write('["add", 2, "node1", "b"')
+        fh.close()
+
+        publishSpool = self.createSpool()
+        self.assertEquals(1, len(publishSpool))
+
+
+    def test_rewrite(self):
+        """
+        The journal is rewritten when it has grown too long.
+        """
+        self.spool.journalSize = 3
+        self.spool.batchSize = 1
+        self.enqueue('node1', 'a', 'b')
+        self.spool.connectionInitialized()
+        self.protocol.requests[0][2].callback(None)
+        self.protocol.requests[1][2].callback(None)
+
+        self.assertEquals(0, len(self.spool))
+        self.assertEquals('', FilePath(self.path).getContent())
+
+
+    def test_rewriteOnEnqueue(self):
+        """
+        Items that make the journal grow too long are kept in the rewrite.
+        """
+        self.spool.journalSize = 3
+        self.enqueue('node1', 'a', 'b')
+        self.enqueue('node1', 'c', 'd')
+        self.assertEquals(4, len(self.spool))
+
+        publishSpool = self.createSpool()
+        self.assertEquals(4, len(publishSpool))
+        journal = FilePath(self.path).getContent()
+        self.assertEquals(4, len(journal.splitlines()))
+
+
+    def test_writeFailure(self):
+        """
+        Spooling fails if the journal cannot be written.
+        """
+        self.spool.path = FilePath(self.mktemp()).child('spool')
+        d = self.enqueue('node1', 'a')
+        self.assertFailure(d, IOError)
+        d.addCallback(lambda _: self.assertEquals(0, len(self.spool)))
+        return d
+
+
+
+class AtomPublisherSpoolTest(unittest.TestCase):
+
+    def test_entriesDiscovered(self):
+        """
+        With a spool, the serialized entries are spooled for their node.
+        """
+        class DummySpool(object):
+            def enqueue(self, node, items):
+                self.enqueued = node, items
+                return defer.succeed(None)
+
+        class DummyWriter(object):
+            def generate(self, feed, entry):
+                return domish.Element((None, 'entry'))
+
+        publisher = aggregator.AtomPublisher(None)
+        publisher.writer = DummyWriter()
+        publisher.spool = DummySpool()
+        entry = fetcher.feedparser.FeedParserDict(id='a')
+        publisher.entriesDiscovered('test', {}, [entry])
+
+        self.assertEquals(('mimir/news/test', [('a', '<entry/>')]),
+                          publisher.spool.enqueued)
+
+
+    def test_notCounted(self):
+        """
+        The aggregator leaves counting publish requests to the spool.
+        """
+        class DummyHandler(object):
+            spool = object()
+
+            def entriesDiscovered(self, handle, feed, entries):
+                return defer.succeed(None)
+
+        agg = aggregator.AggregatorService(None)
+        agg.handler = DummyHandler()
+        entry = fetcher.feedparser.FeedParserDict(id='a')
+        feed = fetcher.feedparser.FeedParserDict(entries=[entry])
+        d = agg.findFreshEntries(feed, 'test', {'interval': 1800})
+        d.addCallback(lambda _: self.assertEquals(
+                                    0, agg.metrics.counters['publishes']))
+        return d
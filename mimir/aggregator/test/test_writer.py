@@ -0,0 +1,407 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.aggregator.writer}.
+"""
+
+import hashlib
+import time
+
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+from twisted.words.xish import domish
+
+from mimir.aggregator import fetcher, writer
+
+FEEDS = FilePath(__file__).sibling('feeds')
+EXPECTED = FEEDS.child('expected')
+
+# Stand-in for the current time, for entries and feeds without a date.
+NOW = 1339502400 # 2012-06-12 12:00:00 UTC
+
+NS_PLANET = 'http://planet.intertwingly.net/'
+NS_FEEDBURNER = 'http://rssnamespace.org/feedburner/ext/1.0'
+
+def parseCorpusFeed(name):
+    """
+    Parse one of the feeds in the test corpus.
+    """
+    return fetcher.feedparser.parse(FEEDS.child(name).getContent())
+
+
+
+def _gmtime(*args):
+    """
+    Like L{time.gmtime}, but at L{NOW} when called without arguments.
+    """
+    return _realGmtime(*(args or (NOW,)))
+
+_realGmtime = time.gmtime
+
+
+
+def expectedEntries(name):
+    """
+    Return the expected entries for one of the feeds in the corpus.
+    """
+    document = writer.StringParser().parse(
+            EXPECTED.child(name).getContent())
+    return list(document.elements())
+
+
+
+def writeExpected(writerClass=writer.ReconstituteWriter):
+    """
+    Write the expected entries for all feeds in the corpus.
+
+    Each file in L{EXPECTED} has the entries of the feed by the same name,
+    as generated by C{writerClass}, in an C{entries} element.
+
+    The files currently in L{EXPECTED} were written with
+    L{writer.DirectAtomWriter}, as Venus was not available. They guard
+    against changes in its output, but are not reference output of
+    L{writer.ReconstituteWriter} until they are written again, with this
+    default, where Venus is installed::
+
+        python -c 'from mimir.aggregator.test.test_writer import *;
+                   writeExpected()'
+    """
+    time.gmtime = _gmtime
+    try:
+        instance = writerClass()
+        for path in FEEDS.globChildren('*.xml'):
+            feed = parseCorpusFeed(path.basename())
+            entries = [instance.generate(feed, entry).toXml()
+                       for entry in feed.entries]
+            xml = u'<entries>\n%s\n</entries>\n' % u'\n'.join(entries)
+            EXPECTED.child(path.basename()).setContent(xml.encode('utf-8'))
+    finally:
+        time.gmtime = _realGmtime
+
+
+
+def canonical(element):
+    """
+    Reduce an element to nested tuples, for comparing entries.
+
+    Elements and attributes in Venus' own namespace are left out, as are
+    differences in whitespace and attribute order.
+    """
+    attributes = []
+    for key, value in element.attributes.iteritems():
+        if isinstance(key, tuple) and key[0] == NS_PLANET:
+            continue
+        attributes.append((key, value))
+
+    # Sort namespaced attributes last, whether names are str or unicode.
+    attributes.sort(key=lambda (key, value): (isinstance(key, tuple), key))
+
+    children = []
+    for child in element.children:
+        if isinstance(child, domish.Element):
+            if child.uri != NS_PLANET:
+                children.append(canonical(child))
+        elif child.strip():
+            children.append(child.strip())
+
+    return (element.uri, element.name, attributes, children)
+
+
+
+class DirectAtomWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = writer.DirectAtomWriter()
+
+
+    def generate(self, name, index):
+        feed = parseCorpusFeed(name)
+        return self.writer.generate(feed, feed.entries[index])
+
+
+    def child(self, element, name):
+        for child in element.elements():
+            if child.name == name:
+                return child
+        self.fail("No %s element in %s" % (name, element.toXml()))
+
+
+    def test_entry(self):
+        """
+        Entries are generated in the Atom namespace, with all common fields.
+        """
+        element = self.generate('atom-xhtml.xml', 0)
+        self.assertEquals((writer.NS_ATOM, 'entry'),
+                          (element.uri, element.name))
+        self.assertEquals(u'tag:example.org,2012:weblog/42',
+                          unicode(self.child(element, 'id')))
+        self.assertEquals(u'2012-06-01T09:30:00Z',
+                          unicode(self.child(element, 'updated')))
+        self.assertEquals(u'2012-06-01T08:00:00Z',
+                          unicode(self.child(element, 'published')))
+        self.assertEquals(u'en', element[(writer.NS_XML, 'lang')])
+
+
+    def test_links(self):
+        """
+        All links are kept, with their attributes.
+        """
+        element = self.generate('atom-xhtml.xml', 0)
+        links = [link for link in element.elements() if link.name == 'link']
+        self.assertEquals(['alternate', 'enclosure', 'related'],
+                          [link['rel'] for link in links])
+        self.assertEquals('1337', links[1]['length'])
+        self.assertEquals('XEP-0060', links[2]['title'])
+
+
+    def test_xhtmlContent(self):
+        """
+        XHTML content is included as XHTML.
+        """
+        element = self.generate('atom-xhtml.xml', 0)
+        content = self.child(element, 'content')
+        self.assertEquals('xhtml', content['type'])
+        div = content.firstChildElement()
+        self.assertEquals((writer.NS_XHTML, 'div'), (div.uri, div.name))
+
+
+    def test_textContent(self):
+        """
+        Plain text is included as text, even if it looks like markup.
+        """
+        element = self.generate('atom-xhtml.xml', 1)
+        summary = self.child(element, 'summary')
+        self.assertFalse(summary.hasAttribute('type'))
+        self.assertIn(u'<angle brackets>', unicode(summary))
+
+
+    def test_escapedHTML(self):
+        """
+        Well-formed HTML is converted to XHTML.
+        """
+        element = self.generate('atom-xhtml.xml', 2)
+        title = self.child(element, 'title')
+        self.assertEquals('xhtml', title['type'])
+        self.assertEquals(u'HTML', unicode(title.firstChildElement().b))
+
+
+    def test_htmlText(self):
+        """
+        HTML without any markup is included as text.
+        """
+        element = self.generate('atom-html.xml', 1)
+        content = self.child(element, 'content')
+        self.assertFalse(content.hasAttribute('type'))
+        self.assertEquals(u'Just text, no markup at all.', unicode(content))
+
+
+    def test_malformedHTML(self):
+        """
+        HTML that is not well-formed is converted, or else kept as HTML.
+        """
+        element = self.generate('atom-html.xml', 0)
+        content = self.child(element, 'content')
+        try:
+            import html5lib
+        except ImportError:
+            self.assertEquals('html', content['type'])
+            self.assertIn(u'<br>', unicode(content))
+        else:
+            self.assertEquals('xhtml', content['type'])
+            self.assertEquals(u'two',
+                              unicode(list(content.firstChildElement()
+                                                  .ul.elements())[1]))
+
+
+    def test_emptyTitle(self):
+        """
+        An empty title element is generated for entries without a title.
+        """
+        element = self.generate('atom-html.xml', 1)
+        title = self.child(element, 'title')
+        self.assertEquals([], title.children)
+
+
+    def test_idFallback(self):
+        """
+        Entries without an id or link get an identifier based on the text.
+        """
+        feed = parseCorpusFeed('rss2-plain.xml')
+        entry = feed.entries[2]
+        element = self.writer.generate(feed, entry)
+        digest = hashlib.md5(entry.summary.encode('utf-8')).hexdigest()
+        self.assertTrue(unicode(self.child(element, 'id')).endswith(digest))
+
+
+    def test_linkAlternate(self):
+        """
+        The link of an RSS item becomes the alternate link.
+        """
+        element = self.generate('rss2-plain.xml', 0)
+        link = self.child(element, 'link')
+        self.assertEquals(u'http://cafe.example.com/menu', link['href'])
+        self.assertEquals(u'alternate', link['rel'])
+
+
+    def test_updatedFallback(self):
+        """
+        Entries without any dates get the current time as update time.
+        """
+        element = self.generate('rss2-plain.xml', 2)
+        self.assertTrue(unicode(self.child(element, 'updated')))
+        self.assertRaises(AssertionError, self.child, element, 'published')
+
+
+    def test_author(self):
+        """
+        Authors get a name, an e-mail address and a URI where available.
+        """
+        element = self.generate('rss2-plain.xml', 1)
+        author = self.child(element, 'author')
+        self.assertEquals(u'The Owner', unicode(self.child(author, 'name')))
+        self.assertEquals(u'owner@cafe.example.com',
+                          unicode(self.child(author, 'email')))
+
+
+    def test_categories(self):
+        """
+        Categories are included with their scheme, if any.
+        """
+        element = self.generate('rss2.xml', 0)
+        categories = [(category['term'], category.getAttribute('scheme'))
+                      for category in element.elements()
+                      if category.name == 'category']
+        self.assertEquals([(u'Software', None),
+                           (u'Releases', u'http://news.example.net/topics')],
+                          categories)
+
+
+    def test_origLink(self):
+        """
+        The original link of entries passed through FeedBurner is kept.
+        """
+        element = self.generate('rss2.xml', 0)
+        origLink = [child for child in element.elements()
+                          if child.uri == NS_FEEDBURNER][0]
+        self.assertEquals('origLink', origLink.name)
+        self.assertEquals(u'http://news.example.net/2012/06/02/aggregator',
+                          unicode(origLink))
+
+
+    def test_source(self):
+        """
+        The source element describes the feed the entry came from.
+        """
+        element = self.generate('rss2.xml', 1)
+        source = self.child(element, 'source')
+        self.assertEquals(u'http://news.example.net/',
+                          unicode(self.child(source, 'id')))
+        self.assertEquals(u'Example News',
+                          unicode(self.child(source, 'title')))
+        self.assertEquals(u'http://news.example.net/logo.gif',
+                          unicode(self.child(source, 'logo')))
+
+
+    def test_sourceFromEntry(self):
+        """
+        The source of an entry is used over the feed it was found in.
+        """
+        element = self.generate('atom-xhtml.xml', 2)
+        source = self.child(element, 'source')
+        self.assertEquals(u'tag:other.example.org,2012:feed',
+                          unicode(self.child(source, 'id')))
+
+
+    def test_serialize(self):
+        """
+        All entries in the corpus can be serialized.
+        """
+        for path in FEEDS.globChildren('*.xml'):
+            feed = parseCorpusFeed(path.basename())
+            for entry in feed.entries:
+                xml = self.writer.generate(feed, entry).toXml()
+                self.assertNotIn(NS_PLANET, xml)
+
+
+
+class ExpectedEntriesMixin(object):
+    """
+    Compare writers with the expected entries for the corpus.
+    """
+
+    def assertExpected(self, instance):
+        names = [path.basename() for path in FEEDS.globChildren('*.xml')]
+        self.assertEquals(sorted(names),
+                          sorted([path.basename()
+                                  for path in EXPECTED.globChildren('*.xml')]))
+
+        for name in names:
+            feed = parseCorpusFeed(name)
+            expected = expectedEntries(name)
+            self.assertEquals(len(expected), len(feed.entries))
+            for entry, element in zip(feed.entries, expected):
+                self.assertEquals(
+                    canonical(element),
+                    canonical(instance.generate(feed, entry)),
+                    "Entry %s of %s differs" % (entry.get('id'), name))
+
+
+
+class ExpectedEntriesTest(ExpectedEntriesMixin, unittest.TestCase):
+    """
+    Compare L{writer.DirectAtomWriter} with the expected entries.
+
+    The expected entries were written with L{writer.DirectAtomWriter}
+    itself, see L{writeExpected}, so this does not establish parity with
+    Venus. L{ReconstituteParityTest} compares them with
+    L{writer.ReconstituteWriter}, where Venus is available.
+    """
+
+    def setUp(self):
+        self.patch(time, 'gmtime', _gmtime)
+
+
+    def test_direct(self):
+        """
+        The direct writer generates the expected entries for the corpus.
+        """
+        self.assertExpected(writer.DirectAtomWriter())
+
+
+
+class ReconstituteParityTest(ExpectedEntriesMixin, unittest.TestCase):
+    """
+    Compare L{writer.DirectAtomWriter} with L{writer.ReconstituteWriter}.
+    """
+
+    def setUp(self):
+        try:
+            from planet import reconstitute
+        except ImportError:
+            raise unittest.SkipTest("Venus is not available")
+        self.patch(time, 'gmtime', _gmtime)
+
+
+    def test_expected(self):
+        """
+        Venus generates the expected entries.
+        """
+        self.assertExpected(writer.ReconstituteWriter())
+
+
+    def test_corpus(self):
+        """
+        Both writers generate the same entries for all feeds in the corpus.
+        """
+        direct = writer.DirectAtomWriter()
+        reconstitute = writer.ReconstituteWriter()
+
+        for path in FEEDS.globChildren('*.xml'):
+            feed = parseCorpusFeed(path.basename())
+            for entry in feed.entries:
+                self.assertEquals(
+                    canonical(reconstitute.generate(feed, entry)),
+                    canonical(direct.generate(feed, entry)),
+                    "Entry %s of %s differs" % (entry.get('id'),
+                                                path.basename()))
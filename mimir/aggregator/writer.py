@@ -8,10 +8,14 @@ Writers create another representation from the Universal Feed Parser's entry
 representation.
 """
 
+import hashlib
+import time
+
 from twisted.words.xish import domish
 
 NS_XML = 'http://www.w3.org/XML/1998/namespace'
 NS_ATOM = 'http://www.w3.org/2005/Atom'
+NS_XHTML = 'http://www.w3.org/1999/xhtml'
 
 class AtomWriter(object):
     """
@@ -231,3 +235,259 @@ class ReconstituteWriter(object):
         xdoc = reconstitute(feed, entry)
         xml = xdoc.documentElement.toxml()
         return StringParser().parse(xml.encode('utf-8'))
+
+
+
+class DirectAtomWriter(AtomWriter):
+    """
+    Writer that generates Atom entries like L{ReconstituteWriter}, directly.
+
+    Instead of building a DOM document with Venus' reconstitute module,
+    serializing and reparsing it, this builds the entry as a
+    L{domish.Element} right away. Elements and attributes in Venus' own
+    C{planet} namespace are not generated.
+
+    HTML content is converted to XHTML if it is well-formed. Otherwise, it
+    is converted using html5lib, if available, or included as escaped HTML.
+    """
+
+    def generate(self, feed, entry):
+        bozo = feed.get('bozo')
+
+        element = domish.Element((NS_ATOM, 'entry'))
+
+        language = entry.get('language') or feed.feed.get('language')
+        if language:
+            element[(NS_XML, 'lang')] = language
+
+        self.generate_id(element, entry)
+        self.generate_links(element, entry)
+
+        if not entry.get('title'):
+            element.addElement('title')
+
+        self.generate_content(element, 'title', entry.get('title_detail'),
+                              bozo)
+        self.generate_content(element, 'summary',
+                              entry.get('summary_detail'), bozo)
+        self.generate_content(element, 'content',
+                              (entry.get('content') or [None])[0], bozo)
+        self.generate_content(element, 'rights', entry.get('rights_detail'),
+                              bozo)
+
+        updated = (entry.get('updated_parsed') or
+                   entry.get('published_parsed') or
+                   feed.feed.get('updated_parsed') or
+                   time.gmtime())
+        self.generate_date(element, 'updated', updated)
+        self.generate_date(element, 'published', entry.get('published_parsed'))
+
+        for tag in entry.get('tags') or []:
+            self.generate_category(element, tag)
+
+        namespaces = feed.get('namespaces') or {}
+        if entry.get('feedburner_origlink') and 'feedburner' in namespaces:
+            origLink = domish.Element((namespaces['feedburner'], 'origLink'))
+            origLink.addContent(entry['feedburner_origlink'])
+            element.addChild(origLink)
+
+        self.generate_author(element, 'author', entry.get('author_detail'))
+        for contributor in entry.get('contributors') or []:
+            self.generate_author(element, 'contributor', contributor)
+
+        source = entry.get('source') or feed.feed
+        self.generate_source(element.addElement('source'), source, bozo)
+
+        return element
+
+    def generate_source(self, parent, source, bozo):
+        """
+        Fill the C{source} element from the feed an entry came from.
+        """
+        self.generate_text_element(parent, 'id',
+                                   source.get('id') or source.get('link'))
+        self.generate_text_element(parent, 'icon', source.get('icon'))
+        self.generate_text_element(parent, 'logo',
+                                   source.get('logo') or
+                                   (source.get('image') or {}).get('href'))
+
+        for tag in source.get('tags') or []:
+            self.generate_category(parent, tag)
+
+        self.generate_author(parent, 'author', source.get('author_detail'))
+        for contributor in source.get('contributors') or []:
+            self.generate_author(parent, 'contributor', contributor)
+
+        if 'links' not in source and source.get('href'):
+            link = {'href': source['href']}
+            if 'title' in source:
+                link['title'] = source['title']
+            self.generate_links(parent, {'links': [link]})
+        else:
+            self.generate_links(parent, source)
+
+        self.generate_content(parent, 'rights', source.get('rights_detail'),
+                              bozo)
+        self.generate_content(parent, 'subtitle',
+                              source.get('subtitle_detail'), bozo)
+        self.generate_content(parent, 'title', source.get('title_detail'),
+                              bozo)
+
+        self.generate_date(parent, 'updated',
+                           source.get('updated_parsed') or time.gmtime())
+
+    def generate_text_element(self, parent, name, value):
+        """
+        Add a child element with text, if there is any.
+        """
+        if not value:
+            return None
+
+        if isinstance(value, str):
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                value = value.decode('iso-8859-1')
+
+        return parent.addElement(name, content=value)
+
+    def generate_id(self, parent, entry):
+        if entry.get('id'):
+            value = entry['id']
+        elif entry.get('link'):
+            value = entry['link']
+        else:
+            for key in ('title', 'summary'):
+                if entry.get(key):
+                    text = entry[key]
+                    base = entry[key + '_detail'].get('base', '')
+                    break
+            else:
+                if not entry.get('content'):
+                    return
+                text = entry['content'][0]['value']
+                base = entry['content'][0].get('base', '')
+
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            value = base + '/' + hashlib.md5(text).hexdigest()
+
+        self.generate_text_element(parent, 'id', value)
+
+    def generate_links(self, parent, item):
+        links = item.get('links')
+        if links is None:
+            links = []
+            if item.get('link'):
+                links.append({'rel': 'alternate', 'href': item['link']})
+
+        for link in links:
+            if 'href' not in link:
+                continue
+
+            element = parent.addElement('link')
+            element['href'] = link['href']
+            for key in ('type', 'rel', 'title', 'length'):
+                if key in link:
+                    element[key] = link[key]
+
+    def generate_date(self, parent, name, parsed):
+        if parsed:
+            self.generate_text_element(parent, name,
+                                       time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                                     tuple(parsed)))
+
+    def generate_category(self, parent, tag):
+        if not tag.get('term'):
+            return
+
+        element = parent.addElement('category')
+        element['term'] = tag['term']
+        for key in ('scheme', 'label'):
+            if tag.get(key):
+                element[key] = tag[key]
+
+    def generate_author(self, parent, name, detail):
+        if not detail:
+            return
+
+        element = parent.addElement(name)
+        if not self.generate_text_element(element, 'name',
+                                          detail.get('name')):
+            element.addElement('name')
+        self.generate_text_element(element, 'email', detail.get('email'))
+        self.generate_text_element(element, 'uri', detail.get('href'))
+
+    def generate_content(self, parent, name, detail, bozo):
+        """
+        Add a text construct, as plain text or XHTML where possible.
+        """
+        if not detail or not detail.get('value'):
+            return
+
+        value = detail['value']
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        contentType = (detail.get('type') or '').lower()
+
+        element = parent.addElement(name)
+
+        if 'html' not in contentType:
+            element.addContent(value)
+        else:
+            div = self.parseXHTML(value)
+            if div is None:
+                div = self.parseHTML(value)
+
+            if div is None:
+                element['type'] = 'html'
+                element.addContent(value)
+            elif (('xhtml' in contentType and not bozo) or
+                  [child for child in div.children
+                         if isinstance(child, domish.Element)]):
+                element['type'] = 'xhtml'
+                element.addChild(div)
+            else:
+                element.addContent(u''.join(div.children))
+
+        if detail.get('language'):
+            element[(NS_XML, 'lang')] = detail['language']
+
+    def parseXHTML(self, value):
+        """
+        Parse a well-formed XHTML fragment into an XHTML C{div} element.
+
+        @return: the C{div} element, or C{None} if the fragment is not
+                 well-formed.
+        """
+        xml = u'<x><div xmlns="%s">%s</div></x>' % (NS_XHTML, value)
+        try:
+            document = StringParser().parse(xml.encode('utf-8'))
+        except Exception:
+            return None
+
+        div = document.firstChildElement()
+        div.parent = None
+        return div
+
+    def parseHTML(self, value):
+        """
+        Parse an HTML fragment into an XHTML C{div} element, using html5lib.
+
+        @return: the C{div} element, or C{None} if html5lib is not available.
+        """
+        try:
+            import html5lib
+        except ImportError:
+            return None
+
+        builder = html5lib.treebuilders.getTreeBuilder('dom')
+        fragment = html5lib.HTMLParser(tree=builder).parseFragment(value)
+        return self.parseXHTML(u''.join([node.toxml()
+                                         for node in fragment.childNodes]))
+
+
+
+# Writers for Atom entries that can be chosen for publishing, by name.
+WRITERS = {'reconstitute': ReconstituteWriter,
+           'direct': DirectAtomWriter}
@@ -17,6 +17,8 @@ from twisted.words.xish import domish
 from wokkel import pubsub
 from wokkel.iwokkel import IXMPPHandler
 
+from mimir import profiling
+
 SGMLTAG = re.compile('<.+?>', re.DOTALL)
 NS_ATOM = 'http://www.w3.org/2005/Atom'
 
@@ -116,8 +118,10 @@ class NewsService(service.Service):
 
     def process(self, channel, items):
         print "Got entries: %r" % items
-        d = self._dbpool.runInteraction(self._processItems, channel, items)
-        d.addCallback(self.notify)
+        d = self._dbpool.runInteraction(
+                profiling.wrap('process', channel, self._processItems),
+                channel, items)
+        d.addCallback(profiling.wrap('notify', channel, self.notify))
         d.addErrback(self.error)
 
     def _processItems(self, cursor, channel, items):
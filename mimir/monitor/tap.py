@@ -13,6 +13,7 @@ from twisted.words.protocols.jabber import jid
 from wokkel import client
 from wokkel.iwokkel import IXMPPHandler
 
+from mimir import profiling
 from mimir.monitor import news, presence
 
 class Options(usage.Options):
@@ -21,10 +22,17 @@ class Options(usage.Options):
         ('secret', None, None),
         ('dbuser', None, None),
         ('dbname', None, 'mimir'),
+        ('profile-output', None, None,
+            'File to append profiling reports to [default: the log]'),
+        ('profile-top', None, profiling.TOP,
+            'Number of channels, stages and calls in profiling reports', int),
     ]
 
     optFlags = [
         ('verbose', 'v', 'Show traffic'),
+        ('profile', None, 'Time the processing of news items. SIGUSR2 '
+                          'writes a report and toggles sampling with '
+                          'cProfile. SIGUSR1 still rotates the log'),
     ]
 
     def postOptions(self):
@@ -39,6 +47,11 @@ class Options(usage.Options):
 def makeService(config):
     s = service.MultiService()
 
+    if config['profile']:
+        profiler = profiling.Profiler(config['profile-top'])
+        profiling.ProfilerService(profiler,
+                                  config['profile-output']).setServiceParent(s)
+
     clientService = client.XMPPClient(config['jid'], config['secret'])
     clientService.setServiceParent(s)
 
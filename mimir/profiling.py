@@ -0,0 +1,319 @@
+# -*- test-case-name: mimir.test.test_profiling -*-
+#
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Opt-in profiling of the stages of processing feeds and news items.
+
+Code that does a distinct stage of work runs it through L{call} or
+L{wrap}, with the name of the stage and a key, like the handle of a feed or
+the name of a channel. This is a plain call, until a L{Profiler} is
+installed. The profiler then keeps the time spent in each stage and for
+each key, and the slowest calls. Stages may be nested, in which case the
+time of the inner stage also counts for the outer one.
+
+Only the time until a call returns is measured. For callbacks in a chain
+of deferreds, this is the time they block the reactor, which is what
+makes it lag.
+
+Next to that, the profiler can sample the process with C{cProfile} on
+demand. L{ProfilerService} installs a profiler, and on C{SIGUSR2} writes
+out a report and toggles sampling. C{SIGUSR1} is left alone, as twistd
+uses it to rotate the log.
+"""
+
+import cProfile
+import heapq
+import pstats
+import signal
+import time
+from cStringIO import StringIO
+
+from twisted.application import service
+from twisted.internet import reactor
+from twisted.python import log
+
+# Number of keys, stages and calls to report on.
+TOP = 20
+
+_profiler = None
+
+def install(profiler):
+    """
+    Make C{profiler} time all calls through L{call}.
+    """
+    global _profiler
+    _profiler = profiler
+
+
+
+def uninstall():
+    global _profiler
+    _profiler = None
+
+
+
+def getProfiler():
+    """
+    Return the installed profiler, or C{None}.
+    """
+    return _profiler
+
+
+
+def call(stage, key, f, *args, **kwargs):
+    """
+    Call C{f}, timing it as a stage of the work for C{key}, if profiling.
+    """
+    if _profiler is None:
+        return f(*args, **kwargs)
+    else:
+        return _profiler.call(stage, key, f, *args, **kwargs)
+
+
+
+def wrap(stage, key, f):
+    """
+    Return a function that calls C{f} through L{call}.
+
+    This is useful for timing callbacks of deferreds.
+    """
+    def wrapper(*args, **kwargs):
+        return call(stage, key, f, *args, **kwargs)
+    return wrapper
+
+
+
+class Timing(object):
+    """
+    Number of calls and their total and maximum duration.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+
+
+class Profiler(object):
+    """
+    Keep track of the time spent per stage and per key.
+
+    @ivar stages: timings per stage.
+    @type stages: C{dict}
+    @ivar keys: timings per key, over all stages.
+    @type keys: C{dict}
+    @ivar slowest: the slowest calls, as a heap of tuples of duration,
+        stage and key.
+    @type slowest: C{list}
+    @ivar top: the number of keys, stages and calls to report on.
+    @type top: C{int}
+    @ivar sampler: the C{cProfile} profiler, while sampling.
+    """
+
+    def __init__(self, top=TOP, timer=time.time):
+        self.top = top
+        self.timer = timer
+        self.sampler = None
+        self.reset()
+
+
+    def reset(self):
+        """
+        Forget all timings.
+        """
+        self.stages = {}
+        self.keys = {}
+        self.slowest = []
+
+
+    def call(self, stage, key, f, *args, **kwargs):
+        start = self.timer()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.record(stage, key, self.timer() - start)
+
+
+    def record(self, stage, key, duration):
+        """
+        Record the duration of a call.
+        """
+        for timings, name in ((self.stages, stage), (self.keys, key)):
+            try:
+                timing = timings[name]
+            except KeyError:
+                timing = timings[name] = Timing()
+            timing.add(duration)
+
+        item = (duration, stage, key)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+
+    def startSampling(self):
+        """
+        Start sampling with C{cProfile}.
+        """
+        if self.sampler is None:
+            self.sampler = cProfile.Profile()
+            self.sampler.enable()
+
+
+    def stopSampling(self):
+        """
+        Stop sampling with C{cProfile}.
+
+        @return: the functions that took most time, formatted as text, or
+            C{None} if the profiler was not sampling.
+        @rtype: C{str}
+        """
+        if self.sampler is None:
+            return None
+
+        sampler, self.sampler = self.sampler, None
+        sampler.disable()
+
+        output = StringIO()
+        stats = pstats.Stats(sampler, stream=output)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        return output.getvalue()
+
+
+    def toggleSampling(self):
+        """
+        Start sampling, or stop sampling and return the result.
+        """
+        if self.sampler is None:
+            self.startSampling()
+            return None
+        else:
+            return self.stopSampling()
+
+
+    def report(self):
+        """
+        Format the timings per stage, the slowest keys and the slowest calls.
+
+        @rtype: C{str}
+        """
+        lines = ["Stages:",
+                 "  %-20s %8s %10s %10s %10s" % ('stage', 'calls', 'total',
+                                                 'mean', 'max')]
+        lines.extend(self._formatTimings(self.stages))
+
+        lines.append("Slowest %d keys:" % self.top)
+        lines.append("  %-20s %8s %10s %10s %10s" % ('key', 'calls', 'total',
+                                                     'mean', 'max'))
+        lines.extend(self._formatTimings(self.keys))
+
+        lines.append("Slowest %d calls:" % self.top)
+        for duration, stage, key in sorted(self.slowest, reverse=True):
+            lines.append("  %10.4f %-20s %s" % (duration, stage, key))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def _formatTimings(self, timings):
+        items = sorted(timings.iteritems(),
+                       key=lambda (name, timing): timing.total,
+                       reverse=True)[:self.top]
+        return ["  %-20s %8d %10.4f %10.4f %10.4f" % (
+                    name, timing.count, timing.total,
+                    timing.total / timing.count, timing.max)
+                for name, timing in items]
+
+
+
+class ProfilerService(service.Service):
+    """
+    Service that installs a profiler while running.
+
+    On C{SIGUSR2}, a report of the timings is written, and sampling with
+    C{cProfile} is toggled. When the service stops, a final report is
+    written. Reports are written to the log, or appended to a file, if
+    given.
+
+    @ivar profiler: the profiler.
+    @type profiler: L{Profiler}
+    @ivar path: file to append reports to, or C{None}.
+    @type path: C{str}
+    """
+
+    def __init__(self, profiler, path=None, reactor=reactor):
+        self.profiler = profiler
+        self.path = path
+        self.reactor = reactor
+        self._previousHandler = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+        install(self.profiler)
+
+        self._previousHandler = signal.signal(signal.SIGUSR2,
+                                              self._signalHandler)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        signal.signal(signal.SIGUSR2, self._previousHandler or signal.SIG_DFL)
+        self._previousHandler = None
+
+        samples = self.profiler.stopSampling()
+        if samples:
+            self.write("cProfile samples", samples)
+        self.dump()
+        uninstall()
+
+
+    def _signalHandler(self, signum, frame):
+        self.reactor.callFromThread(self.dumpAndToggle)
+
+
+    def dumpAndToggle(self):
+        """
+        Write a report of the timings and toggle sampling.
+        """
+        self.dump()
+        self.toggleSampling()
+
+
+    def toggleSampling(self):
+        samples = self.profiler.toggleSampling()
+        if samples is None:
+            log.msg("Profiling: started sampling")
+        else:
+            self.write("cProfile samples", samples)
+
+
+    def dump(self):
+        self.write("Stage timings", self.profiler.report())
+
+
+    def write(self, title, text):
+        """
+        Write a report to the log, or to the file.
+        """
+        if self.path is None:
+            log.msg("Profiling: %s\n%s" % (title, text))
+            return
+
+        output = open(self.path, 'a')
+        try:
+            output.write("%s %s\n%s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                          title, text))
+        finally:
+            output.close()
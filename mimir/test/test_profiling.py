@@ -0,0 +1,212 @@
+# Copyright (c) 2012 Ralph Meijer
+# See LICENSE for details
+
+"""
+Tests for L{mimir.profiling}.
+"""
+
+import os
+import signal
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from mimir import profiling
+
+class FakeTimer(object):
+    """
+    Timer that advances a fixed step on every call.
+    """
+
+    def __init__(self, step=1.0):
+        self.now = 0.0
+        self.step = step
+
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+
+class CallTest(unittest.TestCase):
+
+    def tearDown(self):
+        profiling.uninstall()
+
+
+    def test_notInstalled(self):
+        """
+        Without a profiler, functions are simply called.
+        """
+        self.assertIdentical(None, profiling.getProfiler())
+        self.assertEquals(3, profiling.call('add', 'key', lambda a, b: a + b,
+                                            1, b=2))
+
+
+    def test_installed(self):
+        """
+        With a profiler, calls are timed per stage and key.
+        """
+        profiler = profiling.Profiler(timer=FakeTimer())
+        profiling.install(profiler)
+        self.assertEquals(3, profiling.call('add', 'key', lambda a, b: a + b,
+                                            1, b=2))
+        self.assertEquals(1, profiler.stages['add'].count)
+        self.assertEquals(1.0, profiler.keys['key'].total)
+
+
+    def test_wrap(self):
+        """
+        Wrapped functions are timed when called.
+        """
+        profiler = profiling.Profiler(timer=FakeTimer())
+        f = profiling.wrap('add', 'key', lambda a, b: a + b)
+        profiling.install(profiler)
+        self.assertEquals(3, f(1, 2))
+        self.assertEquals(1, profiler.stages['add'].count)
+
+
+    def test_exception(self):
+        """
+        Calls that raise an exception are timed, too.
+        """
+        profiler = profiling.Profiler(timer=FakeTimer())
+        profiling.install(profiler)
+        self.assertRaises(ZeroDivisionError, profiling.call, 'div', 'key',
+                          lambda: 1 / 0)
+        self.assertEquals(1, profiler.stages['div'].count)
+
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = profiling.Profiler(top=2)
+
+
+    def test_record(self):
+        """
+        Durations are kept per stage and per key.
+        """
+        self.profiler.record('parse', 'a', 1.0)
+        self.profiler.record('parse', 'b', 3.0)
+        self.profiler.record('write', 'a', 2.0)
+
+        parse = self.profiler.stages['parse']
+        self.assertEquals((2, 4.0, 3.0), (parse.count, parse.total, parse.max))
+        a = self.profiler.keys['a']
+        self.assertEquals((2, 3.0, 2.0), (a.count, a.total, a.max))
+
+
+    def test_slowest(self):
+        """
+        Only the slowest calls are kept.
+        """
+        self.profiler.record('parse', 'a', 1.0)
+        self.profiler.record('parse', 'b', 3.0)
+        self.profiler.record('write', 'a', 2.0)
+        self.assertEquals([(3.0, 'parse', 'b'), (2.0, 'write', 'a')],
+                          sorted(self.profiler.slowest, reverse=True))
+
+
+    def test_report(self):
+        """
+        The report lists the slowest stages, keys and calls.
+        """
+        self.profiler.record('parse', 'a', 1.0)
+        self.profiler.record('write', 'b', 3.0)
+        self.profiler.record('store', 'c', 2.0)
+        report = self.profiler.report()
+
+        self.assertIn('write', report)
+        self.assertNotIn('parse', report)
+        self.assertTrue(report.index('write') < report.index('store'))
+
+
+    def test_reset(self):
+        self.profiler.record('parse', 'a', 1.0)
+        self.profiler.reset()
+        self.assertEquals({}, self.profiler.stages)
+        self.assertEquals([], self.profiler.slowest)
+
+
+    def test_sampling(self):
+        """
+        Sampling returns the statistics of cProfile when stopped.
+        """
+        self.assertIdentical(None, self.profiler.stopSampling())
+        self.assertIdentical(None, self.profiler.toggleSampling())
+        sorted(range(10))
+        samples = self.profiler.toggleSampling()
+        self.assertIn('function calls', samples)
+        self.assertIdentical(None, self.profiler.sampler)
+
+
+
+class ProfilerServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.callFromThread = self.callFromThread
+        self.profiler = profiling.Profiler()
+        self.path = self.mktemp()
+        self.service = profiling.ProfilerService(self.profiler, self.path,
+                                                 self.clock)
+
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.clock.callLater(0, f, *args, **kwargs)
+
+
+    def tearDown(self):
+        if self.service.running:
+            self.service.stopService()
+
+
+    def test_startStop(self):
+        """
+        The profiler is installed while running, and reports when stopped.
+        """
+        self.service.startService()
+        self.assertIdentical(self.profiler, profiling.getProfiler())
+        profiling.call('parse', 'key', lambda: None)
+        self.service.stopService()
+
+        self.assertIdentical(None, profiling.getProfiler())
+        self.assertIn('parse', open(self.path).read())
+
+
+    def test_signals(self):
+        """
+        C{SIGUSR2} writes a report and toggles sampling.
+        """
+        self.service.startService()
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.clock.advance(0)
+        self.assertNotIdentical(None, self.profiler.sampler)
+        self.assertIn('Stage timings', open(self.path).read())
+
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.clock.advance(0)
+        self.assertIdentical(None, self.profiler.sampler)
+        self.assertIn('cProfile samples', open(self.path).read())
+
+
+    def test_logRotation(self):
+        """
+        C{SIGUSR1}, that twistd rotates the log on, is left alone.
+        """
+        handler = signal.getsignal(signal.SIGUSR1)
+        self.service.startService()
+        self.assertIdentical(handler, signal.getsignal(signal.SIGUSR1))
+
+
+    def test_restoreHandler(self):
+        """
+        The previous handler of C{SIGUSR2} is restored when stopped.
+        """
+        handler = signal.getsignal(signal.SIGUSR2)
+        self.service.startService()
+        self.service.stopService()
+        self.assertIdentical(handler, signal.getsignal(signal.SIGUSR2))
@@ -40,13 +40,17 @@ setup(name='mimir',
           'mimir.aggregator',
           'mimir.aggregator.test',
           'mimir.monitor',
+          'mimir.test',
           'twisted.plugins',
       ],
-      package_data={'twisted.plugins': ['twisted/plugins/mimir_aggregator.py',
+      package_data={'mimir.aggregator.test': ['feeds/*.xml',
+                                              'feeds/expected/*.xml'],
+                    'twisted.plugins': ['twisted/plugins/mimir_aggregator.py',
                                         'twisted/plugins/mimir_monitor.py']},
       data_files=[('share/mimir', ['db/monitor.sql'])],
       zip_safe=False,
-      install_requires = ['wokkel >= 0.4.0',
+      install_requires = ['Twisted >= 13.1',
+                          'wokkel >= 0.4.0',
                           'simplejson',
                           'FeedParser'],
 )